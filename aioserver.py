@@ -0,0 +1,219 @@
+import asyncio
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xmlrpc.client import gzip_decode
+from xmlrpc.server import SimpleXMLRPCDispatcher, SimpleXMLRPCRequestHandler
+
+MAX_BODY = 16 * 1024 * 1024 #Largest request body accepted, bigger ones get a 413
+MAX_HEADERS = 100
+
+
+# Raised for a request the server answers with an error status and then closes the connection
+class BadRequest(Exception):
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+# XML-RPC server on asyncio, a drop-in for SimpleXMLRPCServer in server.py
+# Functions are registered the same way (register_function, register_multicall_functions, ...).
+# Every connection is a coroutine instead of a thread and stays open between calls (HTTP/1.1
+# keep-alive) until the client closes it or it is idle for idle_timeout seconds. The registered
+# functions block (locks, disk, Wikipedia), so calls run on a pool of worker threads.
+# GET requests are answered for the paths in requestHandler.get_paths, like RequestHandler in server.py.
+class AsyncXMLRPCServer(SimpleXMLRPCDispatcher):
+    def __init__(self, addr, requestHandler=SimpleXMLRPCRequestHandler, logRequests=True,
+                 allow_none=False, encoding=None, use_builtin_types=False, workers=16, idle_timeout=60.0,
+                 reuse_port=False):
+        super().__init__(allow_none, encoding, use_builtin_types)
+        self.rpc_paths = requestHandler.rpc_paths
+        self.get_paths = getattr(requestHandler, 'get_paths', {}) #path -> function returning (content type, body) for GET
+        self.logRequests = logRequests
+        self.idle_timeout = idle_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Call')
+        self.stats_lock = threading.Lock()
+        self.stats_counts = {'connections': 0, 'connections_open': 0, 'requests': 0, 'reused': 0, 'errors': 0}
+        #Bind now like SimpleXMLRPCServer does, so a port in use is reported before the server starts
+        self.socket = socket.create_server(addr, backlog=1024, reuse_port=reuse_port)
+        self.loop = None
+        self.stopped = None
+        self.writers = {} #Open connections, writer -> task handling it
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.server_close()
+
+    # Runs until shutdown() is called or the process gets SIGINT/SIGTERM, which raise KeyboardInterrupt
+    # here after the connections are closed, the same as for SimpleXMLRPCServer
+    def serve_forever(self):
+        handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            interrupted = asyncio.run(self._serve())
+        finally:
+            for signum, handler in handlers.items(): #The event loop leaves its own handlers behind
+                signal.signal(signum, handler)
+        if interrupted:
+            raise KeyboardInterrupt
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        interrupted = []
+        def interrupt():
+            interrupted.append(True)
+            self.stopped.set()
+        if threading.current_thread() is threading.main_thread(): #Signals can only be handled there
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self.loop.add_signal_handler(signum, interrupt)
+        server = await asyncio.start_server(self._connection, sock=self.socket, limit=64 * 1024, backlog=1024)
+        await self.stopped.wait()
+        server.close()
+        for writer in list(self.writers): #Idle keep-alive connections would otherwise keep waiting
+            writer.close()
+        if self.writers: #Let calls that are running finish and their connections close
+            await asyncio.wait(list(self.writers.values()), timeout=10)
+        await server.wait_closed()
+        return bool(interrupted)
+
+    # Stop serve_forever from another thread
+    def shutdown(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def server_close(self):
+        self.socket.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _connection(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) #Answers are written in one go, don't hold them back
+        peer = writer.get_extra_info('peername')
+        with self.stats_lock:
+            self.stats_counts['connections'] += 1
+            self.stats_counts['connections_open'] += 1
+        self.writers[writer] = asyncio.current_task()
+        served = 0
+        try:
+            while True:
+                try:
+                    keep_alive = await self._request(reader, writer, peer, served)
+                except BadRequest as e:
+                    with self.stats_lock:
+                        self.stats_counts['errors'] += 1
+                    self._respond(writer, e.status, e.reason, b'', False)
+                    await writer.drain()
+                    break
+                if keep_alive is None: #Client closed the connection or went quiet
+                    break
+                served += 1
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.pop(writer, None)
+            with self.stats_lock:
+                self.stats_counts['connections_open'] -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    # Read and answer one request, returns whether to keep the connection open, None if there was no request
+    async def _request(self, reader, writer, peer, served):
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        except (asyncio.TimeoutError, ValueError):
+            return None
+        if not line.strip():
+            return None
+        try:
+            method, path, version = line.decode('latin-1').split()
+        except ValueError:
+            raise BadRequest(400, "Bad Request")
+        headers = {}
+        while True:
+            try:
+                line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+            except (asyncio.TimeoutError, ValueError):
+                raise BadRequest(400, "Bad Request")
+            if line in (b'\r\n', b'\n'):
+                break
+            if not line:
+                return None
+            if len(headers) >= MAX_HEADERS or b':' not in line:
+                raise BadRequest(400, "Bad Request")
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+        if method == 'GET':
+            if path not in self.get_paths:
+                raise BadRequest(404, "Not Found")
+            content_type, body = await self.loop.run_in_executor(self.executor, self.get_paths[path])
+            self._respond(writer, 200, "OK", body, keep_alive, content_type)
+            if self.logRequests:
+                self._log(peer, method, path, version)
+            return keep_alive
+        if method != 'POST':
+            raise BadRequest(501, "Unsupported method")
+        if self.rpc_paths and path not in self.rpc_paths:
+            raise BadRequest(404, "Not Found")
+        try:
+            length = int(headers.get('content-length', ''))
+        except ValueError:
+            raise BadRequest(411, "Length Required")
+        if length < 0 or length > MAX_BODY:
+            raise BadRequest(413, "Payload Too Large")
+        data = await reader.readexactly(length)
+        encoding = headers.get('content-encoding', 'identity').lower()
+        if encoding == 'gzip':
+            try:
+                data = gzip_decode(data)
+            except ValueError:
+                raise BadRequest(400, "Bad Request")
+        elif encoding != 'identity':
+            raise BadRequest(501, f"encoding {encoding!r} not supported")
+
+        with self.stats_lock:
+            self.stats_counts['requests'] += 1
+            if served:
+                self.stats_counts['reused'] += 1
+        #Registered functions block, run them on a worker thread
+        response = await self.loop.run_in_executor(self.executor, self._marshaled_dispatch, data, None, path)
+        self._respond(writer, 200, "OK", response, keep_alive)
+        if self.logRequests:
+            self._log(peer, method, path, version)
+        return keep_alive
+
+    def _respond(self, writer, status, reason, body, keep_alive, content_type='text/xml'):
+        head = (f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+
+    # Same line as BaseHTTPRequestHandler.log_request
+    def _log(self, peer, method, path, version):
+        host = peer[0] if peer else '-'
+        when = time.strftime("%d/%b/%Y %H:%M:%S")
+        sys.stderr.write(f'{host} - - [{when}] "{method} {path} {version}" 200 -\n')
+
+    # Connection numbers for getServerStats
+    def async_stats(self):
+        with self.stats_lock:
+            return dict(self.stats_counts)
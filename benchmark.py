@@ -0,0 +1,350 @@
+import argparse
+import datetime
+import glob
+import http.client
+import json
+import os
+import random
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
+import wikistub
+from rpcclient import RPCClient
+
+SERVER_URL = "http://localhost:3000/RPC2"
+DEFAULT_MIX = "saveNote=20,getnotes=40,getTopics=20,getwikipedia=10,getNotesPage=5,searchNotes=5"
+WIKI_TOPICS = ["Python", "XML-RPC", "Distributed Systems", "Web Services", "Multithreading"]
+WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliet"]
+
+
+# One call of each kind the benchmark can make, rng picks the arguments
+# A call that returns an error message instead of raising counts as an error too
+def op_save_note(proxy, rng, topics):
+    date = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    text = ' '.join(rng.choices(WORDS, k=8))
+    result = proxy.saveNote(rng.choice(topics), f"Note-{rng.randint(1, 1000000)}", text, date)
+    return result == "Note saved successfully"
+
+
+def op_get_notes(proxy, rng, topics):
+    result = proxy.getnotes(rng.choice(topics))
+    return isinstance(result, list) or result == "No notes found" #Topic may not have been saved to yet
+
+
+def op_get_topics(proxy, rng, topics):
+    return isinstance(proxy.getTopics(), list)
+
+
+def op_get_wikipedia(proxy, rng, topics):
+    result = proxy.getwikipedia(rng.choice(WIKI_TOPICS))
+    return isinstance(result, str) and result.startswith("Topics wikipedia page")
+
+
+def op_get_notes_page(proxy, rng, topics):
+    result = proxy.getNotesPage(rng.choice(topics), 50, "", True)
+    return isinstance(result, dict) or result == "No notes found"
+
+
+def op_search_notes(proxy, rng, topics):
+    result = proxy.searchNotes(' '.join(rng.sample(WORDS, 2)), 20)
+    return isinstance(result, list) or result == "No notes found"
+
+
+OPERATIONS = {
+    'saveNote': op_save_note,
+    'getnotes': op_get_notes,
+    'getTopics': op_get_topics,
+    'getwikipedia': op_get_wikipedia,
+    'getNotesPage': op_get_notes_page,
+    'searchNotes': op_search_notes,
+}
+
+
+# "saveNote=20,getnotes=80" -> (['saveNote', 'getnotes'], [20.0, 80.0])
+def parse_mix(text):
+    names, weights = [], []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}, choose from {', '.join(OPERATIONS)}")
+        try:
+            weights.append(float(weight or 1))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"bad weight for {name}: {weight!r}")
+        names.append(name)
+    if not names or sum(weights) <= 0:
+        raise argparse.ArgumentTypeError("the mix needs at least one operation with a weight above 0")
+    return names, weights
+
+
+# Latencies and errors per method, shared by all the threads making calls
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {} #method -> list of seconds for calls that worked
+        self.errors = {} #method -> number of calls that failed
+        self.error_kinds = {} #"method: reason" -> count, to show what went wrong
+        self.recording = True
+
+    def record(self, method, latency, ok, reason=None):
+        with self.lock:
+            if not self.recording:
+                return
+            self.latencies.setdefault(method, [])
+            self.errors.setdefault(method, 0)
+            if ok:
+                self.latencies[method].append(latency)
+            else:
+                self.errors[method] += 1
+                key = f"{method}: {reason or 'unexpected result'}"
+                self.error_kinds[key] = self.error_kinds.get(key, 0) + 1
+
+    def reset(self): #End of warm-up
+        with self.lock:
+            self.latencies.clear()
+            self.errors.clear()
+            self.error_kinds.clear()
+
+    def stop(self):
+        with self.lock:
+            self.recording = False
+
+    def summary(self, elapsed):
+        with self.lock:
+            methods = {}
+            everything = []
+            for method in sorted(self.latencies):
+                latencies = sorted(self.latencies[method])
+                everything.extend(latencies)
+                methods[method] = summarize(latencies, self.errors[method], elapsed)
+            everything.sort()
+            total = summarize(everything, sum(self.errors.values()), elapsed)
+            return {'methods': methods, 'total': total, 'errors': dict(self.error_kinds)}
+
+
+# Nearest-rank percentile of a sorted list
+def percentile(values, p):
+    if not values:
+        return 0.0
+    rank = max(1, int(-(-p * len(values) // 100))) #ceil(p/100 * n)
+    return values[rank - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        'count': len(latencies),
+        'errors': errors,
+        'ops_per_sec': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+    }
+
+
+# Make one call and record it, latency counts from start (the scheduled time in open loop)
+def call(proxy, method, rng, topics, recorder, start):
+    try:
+        ok = OPERATIONS[method](proxy, rng, topics)
+        reason = None
+    except xmlrpc.client.Fault as e:
+        ok, reason = False, f"fault {e.faultString[:60]}"
+    except xmlrpc.client.ProtocolError as e:
+        ok, reason = False, f"HTTP {e.errcode}"
+    except (OSError, http.client.HTTPException, xmlrpc.client.ResponseError) as e:
+        ok, reason = False, type(e).__name__
+    recorder.record(method, time.perf_counter() - start, ok, reason)
+    return ok
+
+
+# Closed loop: each of workers threads makes a call as soon as its last one returned
+def run_closed(args, client, recorder, names, weights):
+    deadline = time.perf_counter() + args.warmup + args.duration
+    def worker(seed):
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            method = rng.choices(names, weights)[0]
+            call(client, method, rng, args.topic_names, recorder, time.perf_counter())
+    threads = [threading.Thread(target=worker, args=(args.seed + i,), daemon=True) for i in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+# Open loop: calls start at a fixed rate whether or not earlier ones returned, so a slow server
+# shows up as growing latency instead of fewer calls. Latency is measured from when a call was
+# due, time it spent waiting for a free thread counts too.
+def run_open(args, client, recorder, names, weights):
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='Call')
+    rng = random.Random(args.seed)
+    stop = time.perf_counter() + args.warmup + args.duration
+    dropped = [0]
+    outstanding = [0]
+    lock = threading.Lock()
+    def scheduler():
+        due = time.perf_counter()
+        while due < stop:
+            now = time.perf_counter()
+            if due > now:
+                time.sleep(due - now)
+            with lock:
+                full = outstanding[0] >= args.max_outstanding #The server is far behind, don't queue without limit
+                if not full:
+                    outstanding[0] += 1
+            if full:
+                dropped[0] += 1
+            else:
+                method = rng.choices(names, weights)[0]
+                executor.submit(run_one, method, random.Random(rng.random()), due)
+            due += rng.expovariate(args.rate) if args.poisson else 1.0 / args.rate
+    def run_one(method, call_rng, due):
+        try:
+            call(client, method, call_rng, args.topic_names, recorder, due)
+        finally:
+            with lock:
+                outstanding[0] -= 1
+    thread = threading.Thread(target=scheduler, daemon=True)
+    thread.start()
+    thread.dropped = dropped
+    thread.executor = executor
+    return [thread]
+
+
+# Start server.py from a copy of this directory, with a fresh database and the Wikipedia stub
+def spawn_server(args, stub_port):
+    workdir = tempfile.mkdtemp(prefix='notes-bench-')
+    here = os.path.dirname(os.path.abspath(__file__))
+    for path in glob.glob(os.path.join(here, '*.py')):
+        shutil.copy(path, workdir)
+    command = [sys.executable, 'server.py', '--wikipedia-url', f"http://localhost:{stub_port}/w/api.php"]
+    command += shlex.split(args.server_args)
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    process = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with status {process.returncode}, see {workdir}/server.log")
+        try:
+            socket.create_connection(('localhost', 3000), timeout=0.5).close()
+            return process, workdir
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start within 30 seconds")
+
+
+def stop_server(process, workdir, keep):
+    process.send_signal(signal.SIGTERM) #Same clean shutdown as Ctrl+C
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    if not keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(report, out=sys.stdout):
+    config = report['config']
+    print(f"\n--- {config['mode']} loop, {config['duration']} s"
+          + (f", {config['rate']} calls/s" if config['mode'] == 'open' else f", {config['workers']} workers") + " ---", file=out)
+    print(f"{'method':<14}{'calls':>8}{'errors':>8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}", file=out)
+    rows = list(report['methods'].items()) + [('total', report['total'])]
+    for method, s in rows:
+        print(f"{method:<14}{s['count']:>8}{s['errors']:>8}{s['ops_per_sec']:>10.1f}"
+              f"{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}{s['p99_ms']:>10.2f}{s['max_ms']:>10.2f}", file=out)
+    if report.get('dropped'):
+        print(f"{report['dropped']} calls not started because {config['max_outstanding']} were already outstanding", file=out)
+    for kind, count in sorted(report['errors'].items(), key=lambda item: -item[1]):
+        print(f"  {count} x {kind}", file=out)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Load generator for the notes XML-RPC server")
+    parser.add_argument('--url', default=SERVER_URL, help=f"server to test (default {SERVER_URL})")
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed',
+                        help="closed: --workers threads call back to back, open: calls start at --rate per second")
+    parser.add_argument('--workers', type=int, default=16,
+                        help="threads making calls, in open mode the most calls in flight (default 16)")
+    parser.add_argument('--rate', type=float, default=100, help="calls per second in open mode (default 100)")
+    parser.add_argument('--poisson', action='store_true', help="random (Poisson) arrivals in open mode instead of evenly spaced")
+    parser.add_argument('--max-outstanding', type=int, default=10000,
+                        help="open mode skips calls while this many are started but not finished (default 10000)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds to measure (default 10)")
+    parser.add_argument('--warmup', type=float, default=1, help="seconds to run before measuring (default 1)")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"operations and their weights (default {DEFAULT_MIX})")
+    parser.add_argument('--topics', type=int, default=20, help="number of topics notes are saved to and read from (default 20)")
+    parser.add_argument('--no-keep-alive', action='store_true', help="new connection for every call")
+    parser.add_argument('--timeout', type=float, default=30, help="seconds before a call counts as failed (default 30)")
+    parser.add_argument('--seed', type=int, default=1, help="random seed (default 1)")
+    parser.add_argument('--json', metavar='FILE', help="also write the results as JSON to FILE (- for stdout)")
+    parser.add_argument('--spawn', action='store_true',
+                        help="start server.py (port 3000) with a fresh database and a local Wikipedia stub for the run")
+    parser.add_argument('--server-args', default='', help="extra arguments for the spawned server, e.g. \"--server-mode pool\"")
+    parser.add_argument('--stub-port', type=int, default=3001, help="port for the Wikipedia stub with --spawn (default 3001)")
+    parser.add_argument('--stub-delay', type=float, default=0.0, help="seconds the Wikipedia stub waits before answering (default 0)")
+    parser.add_argument('--keep-workdir', action='store_true', help="keep the spawned server's directory (database and log)")
+    args = parser.parse_args(argv)
+    names, weights = args.mix
+    args.topic_names = [f"Bench-{i}" for i in range(args.topics)]
+
+    stub = process = client = None
+    if args.spawn:
+        stub = wikistub.make_server(args.stub_port, delay=args.stub_delay)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        process, workdir = spawn_server(args, args.stub_port)
+    try:
+        #No retries, every failed call should show up in the report. pool_size=0 closes each connection after its call
+        client = RPCClient(args.url, pool_size=args.workers if not args.no_keep_alive else 0, timeout=args.timeout, retries=0)
+        recorder = Recorder()
+        runner = run_open if args.mode == 'open' else run_closed
+        threads = runner(args, client, recorder, names, weights)
+        time.sleep(args.warmup)
+        recorder.reset()
+        start = time.perf_counter()
+        time.sleep(args.duration)
+        recorder.stop() #Calls still in flight are left out, they would only count towards the next second
+        elapsed = time.perf_counter() - start
+        report = recorder.summary(elapsed)
+        for thread in threads:
+            thread.join(timeout=60)
+        dropped = getattr(threads[0], 'dropped', [0])[0]
+        if hasattr(threads[0], 'executor'):
+            threads[0].executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        if client is not None:
+            client.close() #Idle keep-alive connections would hold up the server's shutdown
+        if process is not None:
+            stop_server(process, workdir, args.keep_workdir)
+            if args.keep_workdir:
+                print(f"Server directory kept in {workdir}", file=sys.stderr if args.json == '-' else sys.stdout)
+        if stub is not None:
+            stub.shutdown()
+
+    report['config'] = {'mode': args.mode, 'workers': args.workers, 'rate': args.rate, 'poisson': args.poisson,
+                        'duration': args.duration, 'warmup': args.warmup, 'max_outstanding': args.max_outstanding,
+                        'mix': dict(zip(names, weights)), 'topics': args.topics, 'keep_alive': not args.no_keep_alive,
+                        'url': args.url, 'spawn': args.spawn, 'server_args': args.server_args}
+    report['dropped'] = dropped
+    report['elapsed'] = elapsed
+    print_report(report, sys.stderr if args.json == '-' else sys.stdout) #Only the JSON on stdout, for jq
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
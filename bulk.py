@@ -0,0 +1,365 @@
+import calendar
+import csv
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+from persistence import atomic_write, journal_entries, journal_generations, remove_journals
+from storage import (MANIFEST, SELECT_TOPIC_ID, INSERT_TOPIC, INSERT_NOTE, connect_sqlite, manifest_json,
+                     note_xml, parse_epoch, shard_of, shard_path, xml_attr, SCHEMA)
+
+FIELDS = ['topic', 'note', 'text', 'date']
+DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+NOTES_PER_CHUNK = 1000 #Notes joined into one write when producing XML
+
+# Temporary database used to group imported notes by topic on disk instead of in memory
+SORT_SCHEMA = """
+CREATE TABLE topics (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, shard INTEGER);
+CREATE TABLE notes (topic_id INTEGER NOT NULL, name TEXT, text TEXT, timestamp TEXT);
+"""
+SORTED_NOTES = ("SELECT topics.name, notes.name, notes.text, notes.timestamp FROM topics "
+                "JOIN notes ON notes.topic_id = topics.id ORDER BY topics.id, notes.rowid")
+SORTED_SHARD_NOTES = ("SELECT topics.name, notes.name, notes.text, notes.timestamp FROM topics "
+                      "JOIN notes ON notes.topic_id = topics.id WHERE topics.shard = ? ORDER BY topics.id, notes.rowid")
+# Adds the notes after id ? to the search index of a SQLite database, see import_sqlite
+FILL_SEARCH = "INSERT INTO notes_fts (rowid, name, text) SELECT id, name, text FROM notes WHERE id > ?"
+FTS_TRIGGER = SCHEMA[SCHEMA.index('CREATE TRIGGER'):].strip().rstrip(';')
+
+
+# Import and export of notes as JSONL or CSV, used by dbtool.py
+# Everything is streamed: files are read and written a row at a time, notes going into an XML
+# database are grouped by topic in a temporary SQLite file next to it, so memory use doesn't
+# grow with the number of notes.
+
+
+# True if date is DD/MM/YYYY HH:MM:SS as the server's saveNote accepts it
+# The zero padded form clients send is checked by hand, anything else goes to strptime like in the server
+def valid_date(date):
+    if (len(date) == 19 and date[2] == '/' and date[5] == '/' and date[10] == ' ' and date[13] == ':'
+            and date[16] == ':'):
+        digits = date[0:2] + date[3:5] + date[6:10] + date[11:13] + date[14:16] + date[17:19]
+        if digits.isascii() and digits.isdigit():
+            day, month, year = int(date[0:2]), int(date[3:5]), int(date[6:10])
+            if 1 <= month <= 12 and year >= 1 and date[11:13] < '24' and date[14:16] < '60' and date[17:19] < '60':
+                if 1 <= day <= (29 if month == 2 and calendar.isleap(year) else DAYS[month - 1]):
+                    return True
+    try:
+        datetime.datetime.strptime(date, "%d/%m/%Y %H:%M:%S")
+        return True
+    except (ValueError, TypeError):
+        return False
+
+
+# Error message for a row that can't be imported, None if it is fine
+# Same rules as saveNote, except that text may be empty (old notes can have none)
+def check_row(topic, note, text, date):
+    if not isinstance(topic, str) or not isinstance(note, str) or not isinstance(text, str) or not isinstance(date, str):
+        return "topic, note, text and date should be strings"
+    if not topic.strip() or not note.strip():
+        return "topic and note cannot be empty"
+    if not valid_date(date):
+        return f"incorrect date {date!r}, should be DD/MM/YYYY HH:MM:SS"
+    return None
+
+
+def format_of(path, fmt):
+    if fmt:
+        return fmt
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+def open_input(path):
+    if path == '-':
+        return open(sys.stdin.fileno(), encoding='utf-8', newline='', closefd=False)
+    return open(path, encoding='utf-8', newline='')
+
+
+def open_output(path):
+    if path == '-':
+        return open(sys.stdout.fileno(), 'w', encoding='utf-8', newline='', closefd=False)
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+# (line number, row) for every row of a JSONL or CSV file, row is a list of 4 values or an error message
+# JSONL lines are {"topic", "note", "text", "date"} objects or [topic, note, text, date] lists,
+# CSV files have those four columns with an optional header line
+def read_rows(f, fmt):
+    if fmt == 'csv':
+        for number, row in enumerate(csv.reader(f), 1):
+            if number == 1 and [value.strip().lower() for value in row] == FIELDS:
+                continue
+            if not row:
+                continue
+            yield number, row if len(row) == 4 else f"expected 4 columns, got {len(row)}"
+        return
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError as e:
+            yield number, f"invalid JSON: {e}"
+            continue
+        if isinstance(value, dict):
+            yield number, [value.get(field) for field in FIELDS]
+        elif isinstance(value, list) and len(value) == 4:
+            yield number, value
+        else:
+            yield number, "expected an object with topic, note, text and date"
+
+
+# Write (topic, note, text, date) rows as JSONL or CSV, returns the number written
+def write_rows(f, fmt, rows, progress=None):
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        for row in rows:
+            writer.writerow(['' if value is None else value for value in row])
+            count += 1
+            if progress and count % 100000 == 0:
+                progress(count)
+        return count
+    for topic, note, text, date in rows:
+        f.write(json.dumps({'topic': topic, 'note': note, 'text': text, 'date': date}, ensure_ascii=False))
+        f.write('\n')
+        count += 1
+        if progress and count % 100000 == 0:
+            progress(count)
+    return count
+
+
+# (topic, note, text, date) of every note in database.xml and its journals, the file is streamed
+def xml_rows(path):
+    if not os.path.exists(path):
+        return
+    gen = 0
+    root = None
+    topic = None
+    depth = 0
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = elem
+                gen = int(elem.get('journal', '0'))
+            elif depth == 2 and elem.tag == 'topic':
+                topic = elem.get('name')
+            continue
+        if depth == 3 and elem.tag == 'note' and topic is not None:
+            yield topic, elem.get('name'), elem.findtext('text'), elem.findtext('timestamp')
+        elif depth == 2:
+            topic = None
+            root.clear() #Done with this topic
+        depth -= 1
+    for entry in journal_entries(path, gen):
+        yield entry['topic'], entry['note'], entry['text'], entry['date']
+
+
+# Every note of a sharded database
+def sharded_rows(directory):
+    with open(os.path.join(directory, MANIFEST), encoding='utf-8') as f:
+        shards = json.load(f)['shards']
+    for number in range(shards):
+        yield from xml_rows(shard_path(directory, number))
+
+
+# Every note of an SQLite database, in the order they were saved
+def sqlite_rows(path):
+    if not os.path.exists(path):
+        return
+    conn = sqlite3.connect(path)
+    try:
+        yield from conn.execute("SELECT topics.name, notes.name, notes.text, notes.timestamp FROM notes "
+                                "JOIN topics ON topics.id = notes.topic_id ORDER BY notes.id")
+    finally:
+        conn.close()
+
+
+def store_rows(storage, path):
+    if storage == 'sqlite':
+        return sqlite_rows(path)
+    if storage == 'xml-sharded':
+        return sharded_rows(path)
+    return xml_rows(path)
+
+
+# Write every note of the store to a JSONL or CSV file, returns the number of notes
+def export_notes(storage, path, out, fmt, progress=None):
+    with open_output(out) as f:
+        return write_rows(f, fmt, store_rows(storage, path), progress)
+
+
+# Validated rows of a file as (topic, note, text, date), bad rows are passed to reject(line, message)
+def valid_rows(source, fmt, reject):
+    with open_input(source) as f:
+        for number, row in read_rows(f, fmt):
+            error = row if isinstance(row, str) else check_row(*row)
+            if error:
+                reject(number, error)
+                continue
+            yield row
+
+
+# Count rows going past and report progress every 100000
+class Counter:
+    def __init__(self, progress):
+        self.progress = progress
+        self.count = 0
+
+    def __call__(self, rows):
+        for row in rows:
+            yield row
+            self.count += 1
+            if self.progress and self.count % 100000 == 0:
+                self.progress(self.count)
+
+
+# Add the notes of a JSONL or CSV file to a database, returns (notes imported, rows rejected)
+# storage is 'xml' (database.xml, also read by xml-lazy), 'xml-sharded' (a shard folder, shards is used
+# when it doesn't exist yet) or 'sqlite'. The server must not be running.
+# Bad rows are skipped and passed to reject(line, message). progress(count) is called every 100000 notes.
+def import_notes(storage, path, source, fmt, shards=16, reject=None, progress=None):
+    rejected = 0
+    def on_reject(number, message):
+        nonlocal rejected
+        rejected += 1
+        if reject:
+            reject(number, message)
+    counter = Counter(progress)
+    rows = counter(valid_rows(source, fmt, on_reject))
+    if storage == 'sqlite':
+        import_sqlite(path, rows)
+    else:
+        import_xml(storage, path, rows, shards)
+    return counter.count, rejected
+
+
+# Inserted in batches of one transaction each, topic ids are remembered instead of looked up every time
+def import_sqlite(path, rows, batch_size=10000):
+    conn = connect_sqlite(path)
+    conn.execute("PRAGMA synchronous=NORMAL") #WAL stays consistent, only the last batch can be lost in a power cut
+    conn.execute("PRAGMA cache_size=-131072") #128 MB, the indexes of a big database stay in memory
+    conn.executescript(SCHEMA)
+    topic_ids = {}
+    try:
+        batch = iter(rows)
+        while True:
+            # The search index is filled once per batch instead of by the trigger for every note, which
+            # takes less than half the time. The trigger is back before the commit, so other connections
+            # never see notes missing from the search index.
+            conn.execute("BEGIN")
+            start = conn.execute("SELECT IFNULL(MAX(id), 0) FROM notes").fetchone()[0]
+            conn.execute("DROP TRIGGER notes_fts_insert")
+            added = 0
+            for topic, note, text, date in batch:
+                topic_id = topic_ids.get(topic)
+                if topic_id is None:
+                    row = conn.execute(SELECT_TOPIC_ID, (topic,)).fetchone()
+                    topic_id = topic_ids[topic] = row[0] if row is not None else conn.execute(INSERT_TOPIC, (topic,)).lastrowid
+                conn.execute(INSERT_NOTE, (topic_id, note, text, date, parse_epoch(date)))
+                added += 1
+                if added == batch_size:
+                    break
+            conn.execute(FILL_SEARCH, (start,))
+            conn.execute(FTS_TRIGGER)
+            conn.execute("COMMIT")
+            if added < batch_size:
+                return
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+# The notes already in the database and the imported ones are collected in a temporary SQLite file,
+# which sorts them by topic on disk, then the XML file(s) are written again from it in one pass
+def import_xml(storage, path, rows, shards):
+    order = () #Topics in the order they were created, shards are read one after another
+    if storage == 'xml-sharded':
+        try:
+            with open(os.path.join(path, MANIFEST), encoding='utf-8') as f:
+                manifest = json.load(f)
+            shards, order = manifest['shards'], manifest['topics']
+            existing = sharded_rows(path)
+        except FileNotFoundError: #New sharded database
+            existing = ()
+        os.makedirs(path, exist_ok=True)
+        directory = path
+    else:
+        existing = xml_rows(path)
+        directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.import-', suffix='.db')
+    os.close(fd)
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.execute("PRAGMA journal_mode=OFF") #Thrown away at the end, nothing to protect
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.executescript(SORT_SCHEMA)
+        topic_ids = {}
+        def topic_id(topic):
+            if topic not in topic_ids:
+                topic_ids[topic] = conn.execute(
+                    "INSERT INTO topics (name, shard) VALUES (?, ?)", (topic, shard_of(topic, shards))).lastrowid
+            return topic_ids[topic]
+        def add(rows):
+            for topic, note, text, date in rows:
+                yield topic_id(topic), note, text, date
+        conn.execute("BEGIN")
+        for topic in order: #Ids keep the manifest's order, the new manifest is written in id order
+            topic_id(topic)
+        conn.executemany("INSERT INTO notes VALUES (?, ?, ?, ?)", add(existing))
+        conn.executemany("INSERT INTO notes VALUES (?, ?, ?, ?)", add(rows))
+        conn.execute("CREATE INDEX notes_topic ON notes(topic_id)")
+        conn.execute("CREATE INDEX topics_shard ON topics(shard, id)")
+        conn.execute("COMMIT")
+        if storage == 'xml-sharded':
+            for number in range(shards):
+                write_xml(shard_path(path, number), conn.execute(SORTED_SHARD_NOTES, (number,)))
+            atomic_write(os.path.join(path, MANIFEST),
+                         manifest_json(shards, [row[0] for row in conn.execute("SELECT name FROM topics ORDER BY id")]))
+        else:
+            write_xml(path, conn.execute(SORTED_NOTES))
+    finally:
+        conn.close()
+        os.unlink(tmp)
+
+
+# Replace an XML database file with rows sorted by topic, its journals are folded in
+# The new file starts a journal generation after every existing journal, so if we stop before the
+# old journals are removed the server removes them instead of replaying them twice
+def write_xml(path, rows):
+    gens = journal_generations(path)
+    gen = gens[-1] + 1 if gens else 0
+    atomic_write(path, xml_chunks(gen, rows))
+    remove_journals(path, gen)
+
+
+# Same layout as notes_xml, a chunk of notes at a time
+def xml_chunks(gen, rows):
+    head = b'<data journal="%d"' % gen
+    current = None
+    chunk = []
+    for topic, note, text, date in rows:
+        if current is None:
+            chunk.append(head + b'>\n')
+        if topic != current:
+            if current is not None:
+                chunk.append(b'</topic>\n')
+            chunk.append(b'<topic' + xml_attr('name', topic) + b'>\n')
+            current = topic
+        chunk.append(note_xml(note, text, date))
+        if len(chunk) >= NOTES_PER_CHUNK:
+            yield b''.join(chunk)
+            chunk = []
+    if current is None:
+        yield head + b' />\n'
+        return
+    chunk.append(b'</topic>\n</data>\n')
+    yield b''.join(chunk)
@@ -0,0 +1,53 @@
+import itertools
+import threading
+from collections import deque
+
+
+# Version of a notes store, for getTopics(sinceVersion) and waitForChanges
+# The version goes up by one for every note saved. The last keep notes are remembered with
+# their version so a client can ask for what it missed; a client that is further behind than
+# that (or has a version from a database that was replaced) is told to start over instead.
+class ChangeFeed:
+    def __init__(self, version=0, keep=10000):
+        self.cond = threading.Condition()
+        self.version = version
+        self.topics_version = version #Version of the last note that started a new topic
+        self.recent = deque(maxlen=keep) #(version, topic, name, text, date, started the topic)
+        self.closed = False
+
+    # Record saved notes given as (topic, name, text, date, started a new topic)
+    # Caller holds the store's write lock so versions follow the order notes were added in
+    def add(self, notes):
+        with self.cond:
+            for topic, name, text, date, new in notes:
+                self.version += 1
+                if new:
+                    self.topics_version = self.version
+                self.recent.append((self.version, topic, name, text, date, new))
+            self.cond.notify_all()
+
+    # Block until the version is not since any more, timeout seconds have passed or the feed is closed
+    def wait(self, since, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.version != since or self.closed, timeout)
+
+    # Wake up every wait() and don't block in it any more, the server is shutting down
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    # Notes saved after version since, at most limit of them
+    # Returns (version, new topics, notes as (topic, name, text, date), reset), version is that of the
+    # last note returned. reset means since is too old or unknown, the client has to reload everything.
+    def changes(self, since, limit):
+        with self.cond:
+            if since == self.version:
+                return self.version, [], [], False
+            oldest = self.recent[0][0] if self.recent else self.version + 1
+            if since > self.version or since < oldest - 1:
+                return self.version, [], [], True
+            skip = since - (oldest - 1)
+            entries = list(itertools.islice(self.recent, skip, skip + limit))
+        return (entries[-1][0], [entry[1] for entry in entries if entry[5]],
+                [entry[1:5] for entry in entries], False)
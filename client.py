@@ -1,8 +1,9 @@
-import xmlrpc.client
 import datetime
+from rpcclient import RPCClient
 
 
-server = xmlrpc.client.ServerProxy('http://localhost:3000/RPC2') #Connect to server
+server = RPCClient('http://localhost:3000/RPC2') #Connect to server, connections are kept open between calls
+topicsCache = {'version': -1, 'topics': []} #Topics from the last getTopics call and the version they are from
 
 
 # Function to add a note
@@ -74,9 +75,13 @@ def wikipediainfo():
 # Function to display topics and a check to skip next function if there are no connection to the server
 def displayTopics():
     try:
-        topics = server.getTopics() #Get all topics
-        if type(topics) == str:#Check if there are any topics
-            print(topics) 
+        result = server.getTopics(topicsCache['version']) #Topics are only sent again if new ones were added
+        if type(result) == dict:
+            topicsCache['version'] = result['version']
+            topicsCache['topics'] = result['topics']
+        topics = topicsCache['topics']
+        if type(result) == str and result != "Not modified": #Error from the server
+            print(result) 
         elif len(topics) == 0: #If there are no topics
             print("No topics found")
             return False
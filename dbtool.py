@@ -0,0 +1,103 @@
+import argparse
+import sys
+import time
+from storage import migrate_xml_to_sqlite, shard_xml
+from bulk import import_notes, export_notes, format_of
+
+DEFAULT_PATHS = {'xml': 'database.xml', 'xml-sharded': 'database.shards', 'sqlite': 'notes.db'}
+
+
+# Command line tool for working with the notes database offline, while the server is stopped
+def migrate(args):
+    start = time.time()
+    def progress(count):
+        print(f"{count} notes copied ({count / (time.time() - start):.0f} notes/s)")
+    try:
+        count, undated = migrate_xml_to_sqlite(args.source, args.target, progress=progress)
+    except Exception as e:
+        print(f"Migration failed: {e}")
+        sys.exit(1)
+    print(f"Copied {count} notes from {args.source} to {args.target} in {time.time() - start:.2f} seconds"
+          + (f", {undated} without a valid timestamp (getNotesBetween won't find them)" if undated else ""))
+
+
+def shard(args):
+    start = time.time()
+    try:
+        count = shard_xml(args.source, args.target, args.shards)
+    except Exception as e:
+        print(f"Sharding failed: {e}")
+        sys.exit(1)
+    print(f"Copied {count} notes from {args.source} into {args.shards} shards in {args.target} "
+          f"in {time.time() - start:.2f} seconds")
+
+
+# Progress goes to stderr so exporting to stdout (-) still works
+def rate_printer(start, verb):
+    def progress(count):
+        print(f"{count} notes {verb} ({count / (time.time() - start):.0f} rows/s)", file=sys.stderr)
+    return progress
+
+
+def bulk_import(args):
+    start = time.time()
+    path = args.path or DEFAULT_PATHS[args.storage]
+    shown = []
+    def reject(line, message):
+        if len(shown) < 10:
+            print(f"Skipping line {line}: {message}", file=sys.stderr)
+        shown.append(line)
+    try:
+        count, rejected = import_notes(args.storage, path, args.file, format_of(args.file, args.format),
+                                       shards=args.shards, reject=reject, progress=rate_printer(start, "imported"))
+    except Exception as e:
+        print(f"Import failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    elapsed = time.time() - start
+    print(f"Imported {count} notes into {path} in {elapsed:.2f} seconds ({count / elapsed:.0f} rows/s)"
+          + (f", skipped {rejected} bad rows" if rejected else ""))
+
+
+def bulk_export(args):
+    start = time.time()
+    path = args.path or DEFAULT_PATHS[args.storage]
+    try:
+        count = export_notes(args.storage, path, args.file, format_of(args.file, args.format),
+                             progress=rate_printer(start, "exported"))
+    except Exception as e:
+        print(f"Export failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    elapsed = time.time() - start
+    print(f"Exported {count} notes from {path} in {elapsed:.2f} seconds ({count / elapsed:.0f} rows/s)", file=sys.stderr)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Offline tools for the notes database")
+    commands = parser.add_subparsers(dest='command', required=True)
+    cmd = commands.add_parser('migrate', help="copy database.xml (and its journal) into an SQLite database")
+    cmd.add_argument('source', nargs='?', default='database.xml', help="XML database (default database.xml)")
+    cmd.add_argument('target', nargs='?', default='notes.db', help="SQLite database to create (default notes.db)")
+    cmd.set_defaults(func=migrate)
+    cmd = commands.add_parser('shard', help="split database.xml (and its journal) into shard files for --storage xml-sharded")
+    cmd.add_argument('source', nargs='?', default='database.xml', help="XML database (default database.xml)")
+    cmd.add_argument('target', nargs='?', default='database.shards', help="folder to create (default database.shards)")
+    cmd.add_argument('--shards', type=int, default=16, help="number of shard files (default 16)")
+    cmd.set_defaults(func=shard)
+    for name, func, help_text in (('import', bulk_import, "add the notes of a JSONL or CSV file to a database"),
+                                  ('export', bulk_export, "write every note of a database to a JSONL or CSV file")):
+        cmd = commands.add_parser(name, help=help_text)
+        cmd.add_argument('file', help="JSONL or CSV file, - for stdin/stdout")
+        cmd.add_argument('--format', choices=['jsonl', 'csv'], help="file format (default: csv for .csv files, else jsonl)")
+        cmd.add_argument('--storage', choices=['xml', 'xml-sharded', 'sqlite'], default='xml',
+                         help="database to use, xml is also what xml-lazy reads (default xml)")
+        cmd.add_argument('--path', help="database.xml, shard folder or SQLite file "
+                                        "(default database.xml, database.shards or notes.db)")
+        if name == 'import':
+            cmd.add_argument('--shards', type=int, default=16, help="shard files for a new xml-sharded database (default 16)")
+        cmd.set_defaults(func=func)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,144 @@
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+# Raised by submit() when max_queued jobs are already waiting
+class QueueFull(Exception):
+    pass
+
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    description TEXT NOT NULL,
+    state TEXT NOT NULL,
+    result TEXT NOT NULL,
+    submitted REAL NOT NULL,
+    finished REAL NOT NULL
+);
+"""
+SAVE_JOB = ("INSERT OR REPLACE INTO jobs (id, description, state, result, submitted, finished) "
+            "VALUES (:id, :description, :state, :result, :submitted, :finished)")
+SELECT_JOB = "SELECT id, description, state, result, submitted, finished FROM jobs WHERE id = ?"
+EXPIRE_JOBS = "DELETE FROM jobs WHERE finished > 0 AND finished < ?"
+
+
+# Runs slow work (Wikipedia lookups) on a fixed number of background threads
+# so request threads can answer right away with a job id.
+# Finished jobs are kept for keep_seconds so clients can pick up the result.
+# With shared_path every change to a job is also written to an SQLite table there, so
+# server processes sharing the file can answer for each other's jobs.
+class JobQueue:
+    def __init__(self, workers=4, max_queued=1000, keep_seconds=600.0, shared_path=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Job')
+        self.max_queued = max_queued
+        self.keep_seconds = keep_seconds
+        self.lock = threading.Lock()
+        self.jobs = {} #job id -> job dict, oldest first
+        self.finished = deque() #(finish time, job id) in the order jobs finished, for _expire
+        self.futures = {} #job id -> Future of a job that hasn't finished
+        self.queued = 0
+        self.running = 0
+        self.shared = None
+        if shared_path is not None:
+            self.shared = sqlite3.connect(shared_path, timeout=30, check_same_thread=False)
+            self.shared.execute("PRAGMA journal_mode=WAL")
+            self.shared.executescript(JOBS_SCHEMA)
+            self.shared_lock = threading.Lock() #One connection, used by one thread at a time
+
+    # Queue func(*args) and return the id of the job
+    # func returns the message that becomes the job's result
+    def submit(self, description, func, *args):
+        with self.lock:
+            self._expire()
+            if self.queued >= self.max_queued:
+                raise QueueFull("Too many jobs queued, try again later")
+            job_id = uuid.uuid4().hex
+            job = self.jobs[job_id] = {'id': job_id, 'description': description, 'state': 'queued',
+                                       'result': '', 'submitted': time.time(), 'finished': 0.0}
+            self.queued += 1
+            self._share(job)
+            self.futures[job_id] = self.executor.submit(self._run, job_id, func, args)
+        return job_id
+
+    def _run(self, job_id, func, args):
+        with self.lock:
+            job = self.jobs[job_id]
+            job['state'] = 'running'
+            self.queued -= 1
+            self.running += 1
+            self._share(job)
+        try:
+            result = func(*args)
+            state = 'done'
+        except Exception as e:
+            result = f"Error: {e}"
+            state = 'failed'
+        with self.lock:
+            job['result'] = result
+            job['state'] = state
+            job['finished'] = time.time()
+            self.running -= 1
+            self.finished.append((job['finished'], job_id))
+            self.futures.pop(job_id, None)
+            self._share(job)
+
+    # Drop finished jobs older than keep_seconds, caller holds self.lock
+    # Only looks at the jobs that finished first, so a submit doesn't walk every kept job
+    def _expire(self):
+        cutoff = time.time() - self.keep_seconds
+        expired = False
+        while self.finished and self.finished[0][0] < cutoff:
+            del self.jobs[self.finished.popleft()[1]]
+            expired = True
+        if self.shared is not None and expired:
+            with self.shared_lock, self.shared:
+                self.shared.execute(EXPIRE_JOBS, (cutoff,))
+
+    # Write a job to the shared table, caller holds self.lock
+    def _share(self, job):
+        if self.shared is not None:
+            with self.shared_lock, self.shared:
+                self.shared.execute(SAVE_JOB, job)
+
+    # Copy of the job dict, None if there is no such job (or it expired)
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        if self.shared is None:
+            return None
+        with self.shared_lock: #Maybe another server process has it
+            row = self.shared.execute(SELECT_JOB, (job_id,)).fetchone()
+        if row is None or (row[5] and row[5] < time.time() - self.keep_seconds):
+            return None
+        return dict(zip(('id', 'description', 'state', 'result', 'submitted', 'finished'), row))
+
+    # Jobs waiting for a worker, being worked on and kept (all of them, finished or not) in this process
+    def stats(self):
+        with self.lock:
+            return {'queued': self.queued, 'running': self.running, 'kept': len(self.jobs)}
+
+    # Cancel the jobs that are still queued and wait up to timeout seconds for the running ones,
+    # they save notes so the store has to stay open until this returns
+    # Only jobs that were cancelled or didn't finish in time are marked failed
+    def shutdown(self, timeout=10.0):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock: #wait() doesn't count a Future cancelled this way as done, leave those out
+            running = [future for future in self.futures.values() if not future.cancelled()]
+        wait(running, timeout)
+        with self.lock: #Other processes would otherwise see these jobs waiting forever
+            for job_id, future in self.futures.items():
+                job = self.jobs[job_id]
+                result = "Error: server stopped" if future.cancelled() else "Error: server stopped before the job finished"
+                job.update(state='failed', result=result, finished=time.time())
+                self._share(job)
+            if self.shared is not None: #A job that finishes after all can't write to it any more
+                with self.shared_lock:
+                    self.shared.close()
+                self.shared = None
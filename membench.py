@@ -0,0 +1,89 @@
+import argparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from storage import load_notes, indent, note_xml, topic_start_tag
+
+WORDS = ["note", "topic", "server", "client", "wikipedia", "python", "thread", "lock",
+         "memory", "index", "search", "storage", "journal", "snapshot", "record", "benchmark"]
+
+
+# Resident set size of this process in bytes
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError: #No /proc, peak size is the best we have
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def make_database(path, notes, topics):
+    rng = random.Random(1)
+    per_topic = max(1, notes // topics)
+    with open(path, 'wb') as f:
+        f.write(b'<data journal="0">\n')
+        written = 0
+        t = 0
+        while written < notes:
+            f.write(topic_start_tag(f"Topic {t}") + b'\n')
+            for i in range(min(per_topic, notes - written)):
+                text = ' '.join(rng.choices(WORDS, k=rng.randint(5, 20)))
+                date = f"{rng.randint(1, 28):02}/{rng.randint(1, 12):02}/{rng.randint(2000, 2025)} " \
+                       f"{rng.randint(0, 23):02}:{rng.randint(0, 59):02}:{rng.randint(0, 59):02}"
+                f.write(note_xml(f"Note {written}", text, date))
+                written += 1
+            f.write(b'</topic>\n')
+            t += 1
+        f.write(b'</data>\n')
+
+
+# Runs in the child process, prints bytes used and seconds taken
+def measure(mode, path):
+    before = rss()
+    start = time.perf_counter()
+    if mode == 'elements':
+        root = ET.parse(path).getroot()
+        indent(root)
+    else:
+        gen, topics = load_notes(path)
+    elapsed = time.perf_counter() - start
+    print(rss() - before, elapsed)
+
+
+# Memory benchmark for the in-memory XML storage
+# Writes a database.xml with the given number of notes, then loads it in a fresh process per
+# representation and reports how much the resident set size grew, scaled to a million notes:
+#   elements - ElementTree elements, how XMLStorage used to keep notes
+#   records  - Note records, how XMLStorage keeps them now
+# Indexes (time, search) are left out, they are the same for both.
+def main(argv):
+    parser = argparse.ArgumentParser(description="Compare memory used by ElementTree elements and Note records")
+    parser.add_argument('--notes', type=int, default=1000000, help="number of notes to load (default 1000000)")
+    parser.add_argument('--topics', type=int, default=1000, help="number of topics (default 1000)")
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        measure(*args.child)
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'database.xml')
+        print(f"Writing {args.notes} notes in {args.topics} topics...")
+        make_database(path, args.notes, args.topics)
+        print(f"database.xml is {os.path.getsize(path) / 2 ** 20:.1f} MiB")
+        print(f"{'Representation':<16}{'RSS growth':>14}{'per million notes':>20}{'load time':>12}")
+        for mode in ('elements', 'records'):
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode, path],
+                                 check=True, capture_output=True, text=True).stdout.split()
+            used, elapsed = int(out[0]), float(out[1])
+            per_million = used * 1000000 / args.notes
+            print(f"{mode:<16}{used / 2 ** 20:>11.1f} MiB{per_million / 2 ** 20:>16.1f} MiB{elapsed:>10.2f} s")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
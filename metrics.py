@@ -0,0 +1,205 @@
+import threading
+import time
+import contextlib
+
+# Upper bounds in seconds of the latency histogram buckets, everything slower goes in +Inf
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Latency histogram with fixed buckets, the caller holds the lock of the Metrics it belongs to
+class Histogram:
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1) #Last one is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Running totals per bucket, what Prometheus expects
+    def cumulative(self):
+        result = []
+        running = 0
+        for count in self.counts:
+            running += count
+            result.append(running)
+        return result
+
+    # Estimate of the p-th percentile, interpolated inside its bucket like Prometheus' histogram_quantile
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        running = 0
+        for i, count in enumerate(self.counts):
+            if count and running + count >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - running) / count, self.max)
+            running += count
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'avg_ms': self.total / self.count * 1000 if self.count else 0.0,
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': self.max * 1000,
+            'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'], self.cumulative())),
+        }
+
+
+# Counters and histograms for the server
+# Calls are counted per XML-RPC method (count, errors, calls running right now, latency), and the
+# time spent in stages of a call that are worth watching on their own, like writing the database
+# to disk or waiting for Wikipedia, is recorded per stage.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.methods = {} #method -> {'count', 'errors', 'in_flight', 'latency'}
+        self.stages = {} #stage -> Histogram
+        self.sources = {} #name -> (function returning a dict of numbers, keys that are counters)
+
+    def _method(self, method):
+        entry = self.methods.get(method)
+        if entry is None:
+            entry = self.methods[method] = {'count': 0, 'errors': 0, 'in_flight': 0, 'latency': Histogram()}
+        return entry
+
+    def call_started(self, method):
+        with self.lock:
+            self._method(method)['in_flight'] += 1
+        return time.perf_counter()
+
+    def call_finished(self, method, started, error):
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            entry = self._method(method)
+            entry['in_flight'] -= 1
+            entry['count'] += 1
+            if error:
+                entry['errors'] += 1
+            entry['latency'].observe(elapsed)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    # with metrics.timer('snapshot_write'): ... records how long the block took, also when it raises
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    # Numbers another part of the server keeps itself, like the job queue, read when stats are asked for
+    # func returns a dict of numbers and states (strings), the keys in counters only ever go up, other numbers are gauges
+    def add_source(self, name, func, counters=()):
+        with self.lock:
+            self.sources[name] = (func, frozenset(counters))
+
+    def _read_sources(self):
+        with self.lock:
+            sources = sorted(self.sources.items())
+        return [(name, func(), counters) for name, (func, counters) in sources] #Outside the lock, they take their own
+
+    # Everything as plain dicts, for the system.stats XML-RPC method
+    def snapshot(self):
+        with self.lock:
+            methods = {}
+            for method, entry in sorted(self.methods.items()):
+                methods[method] = entry['latency'].summary()
+                methods[method].update(count=entry['count'], errors=entry['errors'], in_flight=entry['in_flight'])
+            stages = {stage: histogram.summary() for stage, histogram in sorted(self.stages.items())}
+            in_flight = sum(entry['in_flight'] for entry in self.methods.values())
+        result = {'uptime': time.time() - self.started, 'in_flight': in_flight, 'methods': methods, 'stages': stages}
+        for name, values, counters in self._read_sources():
+            result[name] = values
+        return result
+
+    # Prometheus text format (version 0.0.4) for GET /metrics
+    def prometheus(self):
+        lines = []
+        def histogram_lines(name, label, value, histogram):
+            for bound, count in zip([str(bound) for bound in BUCKETS] + ['+Inf'], histogram.cumulative()):
+                lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {count}')
+            lines.append(f'{name}_sum{{{label}="{value}"}} {histogram.total!r}')
+            lines.append(f'{name}_count{{{label}="{value}"}} {histogram.count}')
+
+        with self.lock:
+            methods = sorted((label_value(method), entry) for method, entry in self.methods.items())
+            lines.append('# HELP notes_process_start_time_seconds When the server started, in seconds since the epoch.')
+            lines.append('# TYPE notes_process_start_time_seconds gauge')
+            lines.append(f'notes_process_start_time_seconds {self.started!r}')
+            for name, key, kind, help_text in (
+                    ('notes_rpc_calls_total', 'count', 'counter', 'XML-RPC calls finished.'),
+                    ('notes_rpc_errors_total', 'errors', 'counter',
+                     'XML-RPC calls that raised a fault or returned an "Error ..." message.'),
+                    ('notes_rpc_in_flight', 'in_flight', 'gauge', 'XML-RPC calls running right now.')):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for method, entry in methods:
+                    lines.append(f'{name}{{method="{method}"}} {entry[key]}')
+            lines.append('# HELP notes_rpc_duration_seconds Time to run an XML-RPC call.')
+            lines.append('# TYPE notes_rpc_duration_seconds histogram')
+            for method, entry in methods:
+                histogram_lines('notes_rpc_duration_seconds', 'method', method, entry['latency'])
+            lines.append('# HELP notes_stage_duration_seconds Time spent in parts of a call or in background work, '
+                         'like writing the database or asking Wikipedia.')
+            lines.append('# TYPE notes_stage_duration_seconds histogram')
+            for stage, histogram in sorted(self.stages.items()):
+                histogram_lines('notes_stage_duration_seconds', 'stage', label_value(stage), histogram)
+        for source, values, counters in self._read_sources():
+            for key, value in sorted(values.items()):
+                if isinstance(value, str): #A state, like the Wikipedia breaker's, as a gauge that is always 1
+                    lines.append(f'# TYPE notes_{source}_{key} gauge')
+                    lines.append(f'notes_{source}_{key}{{state="{label_value(value)}"}} 1')
+                    continue
+                name = f'notes_{source}_{key}_total' if key in counters else f'notes_{source}_{key}'
+                lines.append(f'# TYPE {name} {"counter" if key in counters else "gauge"}')
+                lines.append(f'{name} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+
+def label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# The server's metrics, storage and the Wikipedia lookup record their stages here
+metrics = Metrics()
+
+
+# Mix-in for XML-RPC servers (anything with SimpleXMLRPCDispatcher's _dispatch) that records every call
+# A call counts as an error if it raises (a fault for the client) or returns an "Error ..." message,
+# which is how the server's methods report failures. Names that aren't registered are counted
+# together as "(unknown)" so clients can't fill the table with made up method names.
+class MetricsMixIn:
+    def _dispatch(self, method, params):
+        name = method if method in self.funcs else '(unknown)'
+        started = metrics.call_started(name)
+        error = True
+        try:
+            result = super()._dispatch(method, params)
+            error = isinstance(result, str) and result.startswith('Error')
+            return result
+        finally:
+            metrics.call_finished(name, started, error)
@@ -5,7 +5,7 @@ import time
 import sys
 import random
 import logging
-import socket
+from rpcclient import RPCClient
 
 # Configure basic logging - switched to more minimal format for successful tests
 logging.basicConfig(
@@ -27,36 +27,20 @@ results = {
     'TestInvalidParameters': {'success': 0, 'failure': 0}
 }
 
-# Create server proxy with timeout parameters
-server = xmlrpc.client.ServerProxy('http://localhost:3000/RPC2', 
-                                  transport=xmlrpc.client.Transport(use_builtin_types=True),
-                                  allow_none=True)
+# One client for all test threads, it keeps connections open between calls and retries failed calls
+server = RPCClient('http://localhost:3000/RPC2', pool_size=32, timeout=30, backoff=0.5,
+                   allow_none=True, use_builtin_types=True)
 
 # Function to call server method with retry mechanism
 def call_with_retry(method, *args, max_retries=3):
-    for attempt in range(max_retries):
-        try:
-            # Create a fresh connection for each attempt
-            proxy = xmlrpc.client.ServerProxy('http://localhost:3000/RPC2', 
-                                            transport=xmlrpc.client.Transport(use_builtin_types=True),
-                                            allow_none=True)
-            method_to_call = getattr(proxy, method)
-            return method_to_call(*args)
-        except socket.timeout:
-            with print_lock:
-                logging.warning(f"Attempt {attempt+1}/{max_retries}: Connection timed out, retrying...")
-            time.sleep(0.5 * (attempt + 1))  # Exponential backoff
-        except (ConnectionRefusedError, OSError) as e:
-            with print_lock:
-                logging.warning(f"Attempt {attempt+1}/{max_retries}: Connection refused ({e}), retrying...")
-            time.sleep(0.5 * (attempt + 1))
-        except xmlrpc.client.Fault as e:
-            # This is a server-side error, no need to retry
-            return f"Server error: {e}"
-        except Exception as e:
-            with print_lock:
-                logging.warning(f"Attempt {attempt+1}/{max_retries}: Error: {e}, retrying...")
-            time.sleep(0.5 * (attempt + 1))
+    try:
+        return server.call(method, *args, retries=max_retries - 1)
+    except xmlrpc.client.Fault as e:
+        # This is a server-side error, no need to retry
+        return f"Server error: {e}"
+    except Exception as e:
+        with print_lock:
+            logging.warning(f"{method}: {e}")
     
     return f"Failed after {max_retries} attempts"
 
@@ -339,6 +323,23 @@ def main(args):
                     print(f"{test_name}: {counts['success']} properly handled errors, {counts['failure']} unexpected successes ({success_rate:.1f}% proper error handling)")
                 else:
                     print(f"{test_name}: {counts['success']} successful, {counts['failure']} failed ({success_rate:.1f}% success rate)")
+
+        # Show how long the server's calls waited for the notes lock during the test
+        stats = call_with_retry('getLockStats')
+        if isinstance(stats, dict):
+            print("\n--- Server Lock Contention ---")
+            for side in ('read', 'write'):
+                s = stats[side]
+                print(f"{side}: {s['acquired']} acquired, {s['contended']} contended, "
+                      f"avg wait {s['wait_avg'] * 1000:.3f} ms, max wait {s['wait_max'] * 1000:.3f} ms")
+
+        # Show how the server's worker pool coped (only in --server-mode pool)
+        stats = call_with_retry('getServerStats')
+        if isinstance(stats, dict) and stats.get('mode') == 'pool':
+            print("\n--- Server Worker Pool ---")
+            print(f"{stats['accepted']} connections accepted, {stats['rejected']} turned away (503), "
+                  f"queue peak {stats['queue_high']}/{stats['max_queued']}, "
+                  f"avg queue wait {stats['wait_avg'] * 1000:.3f} ms, max queue wait {stats['wait_max'] * 1000:.3f} ms")
         
     except (IndexError, ValueError):
         print("Usage: python multiclient.py <number_of_clients>")
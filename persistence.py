@@ -0,0 +1,348 @@
+import os
+import glob
+import json
+import time
+import tempfile
+import threading
+import logging
+from metrics import metrics
+
+UMASK = os.umask(0) #Only readable by setting it, done once at import before any threads start
+os.umask(UMASK)
+
+
+# Write data to path so that readers only ever see the old or the new file
+# Data goes to a temp file in the same folder, gets fsynced and is renamed over the old file
+def atomic_write(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if isinstance(data, bytes):
+                f.write(data)
+            else: #Iterable of chunks, lets big files be written without holding them in memory
+                for chunk in data:
+                    f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        try: #Keep permissions of the old file, mkstemp creates files only readable by us
+            os.chmod(tmp, os.stat(path).st_mode)
+        except FileNotFoundError: #New file, same permissions open() would give it
+            os.chmod(tmp, 0o666 & ~UMASK)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    fsync_dir(directory)
+
+
+# fsync the folder so a rename survives a crash (not supported on every platform)
+def fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Group commit write-behind for the database file
+# Writers call mark_dirty() while they hold the tree lock, a background thread
+# snapshots the data with serialize() and writes it to disk when flush_threshold
+# changes are pending or flush_interval seconds have passed
+class SnapshotWriter:
+    def __init__(self, path, serialize, lock, flush_interval=1.0, flush_threshold=100):
+        self.path = path
+        self.serialize = serialize
+        self.lock = lock #Lock that protects the data serialize() reads
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock() #Only one flush at a time so an older snapshot never replaces a newer one
+        self.change_no = 0 #Number of the last change made in memory
+        self.flushed_no = 0 #Number of the last change that is on disk
+        self.failed_no = 0 #Changes up to this number were in a flush that failed
+        self.urgent = False #Somebody is waiting for a flush
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='SnapshotWriter', daemon=True)
+        self.thread.start()
+
+    # Stop the background thread and write whatever is still pending
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    # Record changes, must be called while holding self.lock
+    # The whole file is rewritten on flush so only the number of changes matters
+    # Returns a ticket that can be passed to wait_durable()
+    def mark_dirty(self, *changes):
+        with self.cond:
+            self.change_no += max(len(changes), 1)
+            if self.change_no - self.flushed_no >= self.flush_threshold:
+                self.cond.notify_all()
+            return self.change_no
+
+    # Block until the change with the given ticket is on disk
+    # Returns False if the flush failed or timeout ran out
+    def wait_durable(self, ticket, timeout=None):
+        if self.thread is None: #No background thread, flush ourselves
+            self.flush()
+        with self.cond:
+            if self.flushed_no < ticket:
+                self.urgent = True
+                self.cond.notify_all()
+            self.cond.wait_for(lambda: self.flushed_no >= ticket or self.failed_no >= ticket, timeout)
+            return self.flushed_no >= ticket
+
+    def pending(self):
+        with self.cond:
+            return self.change_no - self.flushed_no
+
+    # Write a snapshot of the current data if there are changes not on disk yet
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                with self.cond:
+                    upto = self.change_no
+                    if upto == self.flushed_no:
+                        return True
+                with metrics.timer('snapshot_serialize'):
+                    data = self.serialize() #Only the in memory copy is done under the lock
+            try:
+                with metrics.timer('snapshot_write'):
+                    atomic_write(self.path, data)
+            except Exception:
+                logging.exception("Writing %s failed", self.path)
+                with self.cond:
+                    self.failed_no = max(self.failed_no, upto)
+                    self.cond.notify_all()
+                return False
+            with self.cond:
+                self.flushed_no = upto
+                self.cond.notify_all()
+            return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.stopped or self.urgent or
+                                   self.change_no - self.flushed_no >= self.flush_threshold,
+                                   self.flush_interval)
+                if self.stopped:
+                    return
+                self.urgent = False
+            self.flush()
+
+
+# Journal files live next to the database and are numbered by generation
+# The snapshot (database.xml) stores the first generation it does not contain
+# in the journal attribute of its root element
+def journal_path(path, gen):
+    return f"{path}.{gen}.journal"
+
+
+def journal_generations(path):
+    gens = []
+    for name in glob.glob(glob.escape(path) + '.*.journal'):
+        try:
+            gens.append(int(name[len(path) + 1:-len('.journal')]))
+        except ValueError:
+            pass
+    return sorted(gens)
+
+
+# Apply every journal entry with generation >= start_gen to the data with apply(entry)
+# Returns the next free generation number and the number of entries applied
+def replay_journals(path, start_gen, apply):
+    next_gen = start_gen
+    for gen in journal_generations(path):
+        if gen >= start_gen:
+            next_gen = gen + 1
+    count = 0
+    for entry in journal_entries(path, start_gen):
+        apply(entry)
+        count += 1
+    return next_gen, count
+
+
+# Every entry of the journals with generation >= start_gen, in order, read a line at a time
+def journal_entries(path, start_gen):
+    for gen in journal_generations(path):
+        if gen < start_gen: #Already part of the snapshot
+            continue
+        with open(journal_path(path, gen), 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: #Last line was cut short by a crash, nothing after it was acknowledged
+                    logging.warning("Ignoring incomplete entry at the end of %s", journal_path(path, gen))
+                    break
+                yield entry
+
+
+# Remove journals that are fully contained in the snapshot
+def remove_journals(path, below_gen):
+    for gen in journal_generations(path):
+        if gen < below_gen:
+            try:
+                os.unlink(journal_path(path, gen))
+            except FileNotFoundError:
+                pass
+
+
+# Append-only journal, an alternative to SnapshotWriter
+# Every change is appended to the journal as one JSON line, so a save writes only
+# the bytes of that note. A background thread fsyncs the journal every sync_interval
+# seconds (or right away when somebody waits) and compacts the journals into a new
+# snapshot when they grow past compact_size bytes or compact_interval seconds pass.
+# serialize(gen) must return the snapshot (bytes or an iterable of bytes) with gen
+# stored as its journal generation, on_compacted(gen) is called once it is on disk.
+class JournalWriter:
+    def __init__(self, path, serialize, lock, gen, sync_interval=1.0,
+                 compact_interval=60.0, compact_size=16 * 1024 * 1024, on_compacted=None):
+        self.path = path
+        self.serialize = serialize
+        self.on_compacted = on_compacted
+        self.lock = lock #Lock that protects the data serialize() reads
+        self.sync_interval = sync_interval
+        self.compact_interval = compact_interval
+        self.compact_size = compact_size
+        self.cond = threading.Condition()
+        self.compact_lock = threading.Lock()
+        self.file_lock = threading.Lock() #Keeps the journal file open while it is fsynced
+        self.gen = gen
+        self.file = open(journal_path(path, gen), 'ab')
+        #Journals left over from before the last restart count towards compaction too
+        self.journal_size = sum(os.path.getsize(journal_path(path, g)) for g in journal_generations(path))
+        self.change_no = 0 #Number of the last change appended to the journal
+        self.synced_no = 0 #Number of the last change that is fsynced
+        self.failed_no = 0
+        self.last_compact = time.monotonic()
+        self.urgent = False
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='JournalWriter', daemon=True)
+        self.thread.start()
+
+    # Stop the background thread, fold the journal into the snapshot and close it
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.journal_size:
+            self.compact()
+        self.sync()
+        with self.cond:
+            self.file.close()
+            if self.journal_size == 0: #Nothing was written since the last compaction
+                remove_journals(self.path, self.gen + 1)
+
+    # Append changes (dicts) to the journal, must be called while holding self.lock
+    # Returns a ticket that can be passed to wait_durable()
+    def mark_dirty(self, *changes):
+        start = time.perf_counter()
+        data = b''.join(json.dumps(change, ensure_ascii=False).encode('utf-8') + b'\n' for change in changes)
+        with self.cond:
+            self.file.write(data)
+            self.file.flush() #Hand the bytes to the OS, a crash of the server alone loses nothing
+            self.journal_size += len(data)
+            self.change_no += len(changes)
+            ticket = self.change_no
+        metrics.observe('journal_append', time.perf_counter() - start)
+        return ticket
+
+    # Block until the change with the given ticket is fsynced
+    def wait_durable(self, ticket, timeout=None):
+        if self.thread is None:
+            self.sync()
+        with self.cond:
+            if self.synced_no < ticket:
+                self.urgent = True
+                self.cond.notify_all()
+            self.cond.wait_for(lambda: self.synced_no >= ticket or self.failed_no >= ticket, timeout)
+            return self.synced_no >= ticket
+
+    def pending(self):
+        with self.cond:
+            return self.change_no - self.synced_no
+
+    # fsync everything appended so far, waiters of all those changes are released together
+    def sync(self):
+        with self.file_lock:
+            with self.cond:
+                upto = self.change_no
+                if upto == self.synced_no:
+                    return True
+                fd = self.file.fileno()
+            try:
+                with metrics.timer('journal_fsync'):
+                    os.fsync(fd) #Appends can go on while we wait for the disk
+            except OSError:
+                logging.exception("Syncing journal of %s failed", self.path)
+                with self.cond:
+                    self.failed_no = max(self.failed_no, upto)
+                    self.cond.notify_all()
+                return False
+            with self.cond:
+                self.synced_no = max(self.synced_no, upto)
+                self.cond.notify_all()
+            return True
+
+    # Write a new snapshot containing everything in the journals and drop the old journals
+    def compact(self):
+        with self.compact_lock, metrics.timer('journal_compact'):
+            with self.lock:
+                with self.file_lock, self.cond: #Switch to a new journal, the snapshot covers everything before it
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    self.synced_no = self.change_no
+                    self.cond.notify_all()
+                    self.file.close()
+                    self.gen += 1
+                    self.file = open(journal_path(self.path, self.gen), 'ab')
+                    self.journal_size = 0
+                    gen = self.gen
+                data = self.serialize(gen)
+            self.last_compact = time.monotonic()
+            try:
+                atomic_write(self.path, data)
+            except Exception: #Old journals are kept and replayed on the next start
+                logging.exception("Compacting journal into %s failed", self.path)
+                return False
+            if self.on_compacted:
+                self.on_compacted(gen)
+            remove_journals(self.path, gen)
+            return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.stopped or self.urgent, self.sync_interval)
+                if self.stopped:
+                    return
+                self.urgent = False
+                compact = self.journal_size >= self.compact_size or (
+                    self.journal_size and time.monotonic() - self.last_compact >= self.compact_interval)
+            self.sync()
+            if compact:
+                self.compact()
@@ -0,0 +1,124 @@
+import queue
+import select
+import threading
+import time
+
+OVERLOAD_BODY = b"Server busy, try again shortly\n"
+# Sent straight from the accept loop when every worker is busy and the queue is full
+OVERLOAD_RESPONSE = (b"HTTP/1.0 503 Service Unavailable\r\n"
+                     b"Retry-After: 1\r\n"
+                     b"Content-Type: text/plain\r\n"
+                     b"Content-Length: " + str(len(OVERLOAD_BODY)).encode('ascii') + b"\r\n"
+                     b"Connection: close\r\n\r\n" + OVERLOAD_BODY)
+
+
+# Mix-in for socketserver servers, use instead of ThreadingMixIn
+# Connections are handled by a fixed number of worker threads. Accepted connections wait
+# in a queue of at most max_queued, when it is full new connections get a 503 right away
+# instead of a thread, so a burst of clients can't pile up thousands of threads.
+class PooledMixIn:
+    request_queue_size = 128 #Listen backlog, the accept loop takes connections off it quickly
+
+    def __init__(self, *args, workers=16, max_queued=64, keepalive_wait=1.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keepalive_wait = keepalive_wait
+        self.pool_lock = threading.Lock()
+        self.pool_counts = {'accepted': 0, 'rejected': 0, 'started': 0, 'busy': 0, 'queue_high': 0,
+                            'wait_total': 0.0, 'wait_max': 0.0}
+        self.requests = queue.Queue(max_queued)
+        self.max_queued = max_queued
+        self.closed = False
+        self.workers = [threading.Thread(target=self._work, name=f'Worker-{i}', daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    # Called by serve_forever for every accepted connection
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address, time.perf_counter()))
+        except queue.Full:
+            with self.pool_lock:
+                self.pool_counts['rejected'] += 1
+            self.reject(request)
+            return
+        depth = self.requests.qsize()
+        with self.pool_lock:
+            self.pool_counts['accepted'] += 1
+            if depth > self.pool_counts['queue_high']:
+                self.pool_counts['queue_high'] = depth
+
+    def _work(self):
+        while True:
+            item = self.requests.get()
+            if item is None: #Server is closing
+                return
+            request, client_address, queued_at = item
+            waited = time.perf_counter() - queued_at
+            with self.pool_lock:
+                self.pool_counts['started'] += 1
+                self.pool_counts['busy'] += 1
+                self.pool_counts['wait_total'] += waited
+                if waited > self.pool_counts['wait_max']:
+                    self.pool_counts['wait_max'] = waited
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self.pool_lock:
+                    self.pool_counts['busy'] -= 1
+
+    # Answer 503 without reading the whole request, a slow client can't hold up the accept loop
+    def reject(self, request):
+        try:
+            request.setblocking(False)
+            try: #Read what the client already sent, closing with unread data resets the connection
+                while request.recv(65536):
+                    pass
+            except (BlockingIOError, InterruptedError):
+                pass
+            request.settimeout(0.1)
+            request.sendall(OVERLOAD_RESPONSE)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def pool_stats(self):
+        with self.pool_lock:
+            result = dict(self.pool_counts)
+        result['wait_avg'] = result['wait_total'] / result['started'] if result['started'] else 0.0
+        result['workers'] = len(self.workers)
+        result['queued'] = self.requests.qsize()
+        result['max_queued'] = self.max_queued
+        return result
+
+    # Workers finish the connections already queued, then stop
+    def server_close(self):
+        super().server_close()
+        if self.closed: #with statement closes again on the way out
+            return
+        self.closed = True
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join(5)
+
+
+# Mix-in for the request handler of a PooledMixIn server
+# With HTTP/1.1 keep-alive a worker stays with its connection between calls. It only waits
+# keepalive_wait seconds for the next call and gives the connection up right away when other
+# connections are waiting for a worker, so idle clients can't keep all the workers to themselves.
+class PooledRequestHandlerMixIn:
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if self.server.requests.qsize():
+                break
+            readable, _, _ = select.select([self.connection], [], [], self.server.keepalive_wait)
+            if not readable:
+                break
+            self.handle_one_request()
@@ -0,0 +1,52 @@
+import os
+import signal
+import sys
+import time
+
+
+# Pre-fork: the calling process becomes a supervisor for count worker processes
+# Returns the worker number (0 .. count-1) in each worker, which goes on to start its own server.
+# The supervisor never returns: it restarts workers that die, and on SIGINT/SIGTERM it passes
+# SIGTERM on to the workers, waits for them to shut down cleanly and exits.
+# Must be called before any threads are started, fork only copies the calling thread.
+def fork_workers(count, restart_delay=1.0):
+    children = {} #pid -> worker number
+    def spawn(number):
+        pid = os.fork()
+        if pid == 0:
+            return True
+        children[pid] = number
+        return False
+
+    for number in range(count):
+        if spawn(number):
+            return number
+
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        number = children.pop(pid, None)
+        if number is None or stopping:
+            continue
+        print(f"Worker {number} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+        time.sleep(restart_delay) #Don't spin if a worker dies right away every time
+        if stopping:
+            continue
+        if spawn(number):
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            return number
+    sys.exit(0)
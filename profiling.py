@@ -0,0 +1,169 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+
+METHOD_NAME = re.compile(rb'<methodName>\s*([^<\s]+)\s*</methodName>')
+TOP = 40 #Functions and allocation sites listed in the text reports
+
+
+# Profiles every Nth call of each XML-RPC method with cProfile and, if it is tracing, tracemalloc
+# Profiles of the same method are added up, allocations are summed per traceback and the snapshot
+# of the sampled call with the highest memory peak is kept. tracemalloc has to be started when the
+# server starts (--profile-memory), stopping it while other threads allocate can crash Python before
+# 3.12.9, so the traces are cleared when a sampled call starts instead. Only one call is sampled at
+# a time, so a call that comes up for sampling while another one is being profiled is skipped.
+class Profiler:
+    def __init__(self, every=0, directory='profiles'):
+        self.lock = threading.Lock()
+        self.sampling = threading.Lock()
+        self.every = every #0 is off
+        self.directory = directory
+        self.methods = {}
+
+    def _method(self, method):
+        entry = self.methods.get(method)
+        if entry is None:
+            entry = self.methods[method] = {'calls': 0, 'samples': 0, 'skipped': 0, 'time': 0.0, 'stats': None,
+                                            'allocated': {}, 'peak': 0, 'snapshot': None}
+        return entry
+
+    # Count a call, True if it should be profiled and then the caller must call finish() afterwards
+    def start(self, method):
+        with self.lock:
+            entry = self._method(method)
+            entry['calls'] += 1
+            if not self.every or entry['calls'] % self.every:
+                return False
+        if not self.sampling.acquire(blocking=False):
+            with self.lock:
+                entry['skipped'] += 1
+            return False
+        if tracemalloc.is_tracing():
+            tracemalloc.clear_traces() #Only what this call allocates, also resets the peak
+        return True
+
+    # Store what was measured during a sampled call, profile is None if cProfile couldn't run
+    def finish(self, method, profile, elapsed):
+        try:
+            snapshot = None
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot().filter_traces(
+                    (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)))
+                peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            self.sampling.release()
+        allocated = snapshot.statistics('traceback') if snapshot is not None else []
+        with self.lock:
+            entry = self._method(method)
+            entry['samples'] += 1
+            entry['time'] += elapsed
+            if profile is not None:
+                if entry['stats'] is None:
+                    entry['stats'] = pstats.Stats(profile, stream=io.StringIO())
+                else:
+                    entry['stats'].add(profile)
+            for stat in allocated:
+                sizes = entry['allocated'].setdefault(stat.traceback, [0, 0])
+                sizes[0] += stat.size
+                sizes[1] += stat.count
+            if snapshot is not None and peak >= entry['peak']:
+                entry['peak'] = peak
+                entry['snapshot'] = snapshot
+
+    # Sampling every Nth call, 0 turns it off, returns the old setting
+    def configure(self, every):
+        with self.lock:
+            old, self.every = self.every, every
+        return old
+
+    def summary(self):
+        with self.lock:
+            return {method: {'calls': entry['calls'], 'samples': entry['samples'], 'skipped': entry['skipped'],
+                             'avg_ms': entry['time'] / entry['samples'] * 1000 if entry['samples'] else 0.0,
+                             'peak_bytes': entry['peak']}
+                    for method, entry in sorted(self.methods.items())}
+
+    # Write what was collected to a new folder in directory, returns its path and the files in it
+    # Per sampled method: <method>.pstats (for pstats or snakeviz), <method>.txt (slowest functions and
+    # biggest allocations) and <method>.snapshot (tracemalloc.Snapshot.load, the call with the highest peak)
+    def dump(self, reset=False):
+        with self.lock: #Copies, sampled calls keep adding to the originals
+            methods = {}
+            for method, entry in self.methods.items():
+                if entry['samples']:
+                    methods[method] = dict(entry, allocated=list(entry['allocated'].items()), stats=None)
+                    if entry['stats'] is not None:
+                        methods[method]['stats'] = pstats.Stats(stream=io.StringIO())
+                        methods[method]['stats'].add(entry['stats'])
+            if reset:
+                self.methods = {}
+        folder = os.path.join(self.directory, time.strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}')
+        os.makedirs(folder, exist_ok=True)
+        files = []
+        for method, entry in sorted(methods.items()):
+            name = re.sub(r'[^\w.-]', '_', method)
+            report = io.StringIO()
+            report.write(f"{method}: {entry['calls']} calls, {entry['samples']} profiled, {entry['skipped']} skipped, "
+                         f"{entry['time'] / entry['samples'] * 1000:.2f} ms average, "
+                         f"{entry['peak'] / 1024:.1f} KiB highest peak\n\n")
+            if entry['stats'] is not None:
+                path = os.path.join(folder, name + '.pstats')
+                entry['stats'].dump_stats(path)
+                files.append(path)
+                entry['stats'].stream = report
+                entry['stats'].sort_stats('cumulative').print_stats(TOP)
+            if entry['snapshot'] is None:
+                report.write("Memory wasn't traced, start the server with --profile-memory\n")
+            else:
+                report.write(f"Memory still allocated at the end of the calls, biggest {TOP}:\n")
+            biggest = sorted(entry['allocated'], key=lambda item: item[1][0], reverse=True)[:TOP]
+            for traceback, (size, count) in biggest:
+                report.write(f"\n{size / 1024:.1f} KiB in {count} blocks\n")
+                report.write('\n'.join(traceback.format(most_recent_first=True)) + '\n')
+            path = os.path.join(folder, name + '.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(report.getvalue())
+            files.append(path)
+            if entry['snapshot'] is not None:
+                path = os.path.join(folder, name + '.snapshot')
+                entry['snapshot'].dump(path)
+                files.append(path)
+        return folder, files
+
+
+# The server's profiler, off until --profile-every or system.setProfiling turns it on
+profiler = Profiler()
+
+
+# Mix-in for XML-RPC servers that profiles sampled calls
+# It wraps _marshaled_dispatch, so parsing the request and building the response are profiled as
+# well as the method itself. With sampling off a call only pays for one attribute check.
+class ProfilingMixIn:
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        if not profiler.every:
+            return super()._marshaled_dispatch(data, dispatch_method, path)
+        match = METHOD_NAME.search(data, 0, 1024)
+        method = match.group(1).decode('utf-8', 'replace') if match else '(unknown)'
+        if method not in self.funcs:
+            method = '(unknown)'
+        if not profiler.start(method):
+            return super()._marshaled_dispatch(data, dispatch_method, path)
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            try:
+                profile.enable()
+            except ValueError: #A debugger or another profiler is running, measure memory only
+                profile = None
+                return super()._marshaled_dispatch(data, dispatch_method, path)
+            try:
+                return super()._marshaled_dispatch(data, dispatch_method, path)
+            finally:
+                profile.disable()
+        finally:
+            profiler.finish(method, profile, time.perf_counter() - started)
@@ -0,0 +1,181 @@
+import http.client
+import random
+import socket
+import threading
+import time
+import urllib.parse
+import xmlrpc.client
+
+# Calls that change something on the server. They are only retried when the server can't have
+# run them (connection refused, 503 from a full server, a stale keep-alive connection).
+UNSAFE_METHODS = {'saveNote', 'saveNotes', 'getwikipedia', 'getwikipediaAsync', 'system.multicall'}
+RETRY_STATUS = {502, 503, 504}
+
+
+# Error from a connection that was reused from the pool and turned out to be closed by the server
+class StaleConnection(Exception):
+    pass
+
+
+# Thread-safe XML-RPC client with a pool of keep-alive connections
+# Use it like ServerProxy: client.saveNote(...), client.system.listMethods(), xmlrpc.client.MultiCall(client).
+# Up to pool_size idle connections are kept for reuse, any number of threads can make calls at the
+# same time (extra connections are opened as needed). Every call times out after timeout seconds and
+# failed calls are retried up to retries times with exponential backoff and jitter.
+class RPCClient:
+    def __init__(self, url, pool_size=8, timeout=10.0, retries=2, backoff=0.1, max_backoff=2.0,
+                 allow_none=False, use_builtin_types=False):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f"unsupported XML-RPC protocol {parts.scheme!r}")
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/RPC2'
+        self.url = url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.allow_none = allow_none
+        self.use_builtin_types = use_builtin_types
+        self.lock = threading.Lock()
+        self.idle = [] #Connections ready for reuse, most recently used last
+        self.stats_counts = {'calls': 0, 'retries': 0, 'connections': 0, 'reused': 0, 'stale': 0}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _Method(self, name)
+
+    # Call method with args, timeout and retries override the client's settings for this call
+    def call(self, method, *args, timeout=None, retries=None):
+        body = xmlrpc.client.dumps(args, method, allow_none=self.allow_none).encode('utf-8')
+        unsafe = method in UNSAFE_METHODS
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        with self.lock:
+            self.stats_counts['calls'] += 1
+        while True:
+            try:
+                return self._request(body, self.timeout if timeout is None else timeout)
+            except StaleConnection:
+                with self.lock:
+                    self.stats_counts['stale'] += 1
+                continue #The server closed it while it was idle, the call never reached it, try a new one
+            except xmlrpc.client.ProtocolError as e:
+                if e.errcode not in RETRY_STATUS or attempt >= retries:
+                    raise
+                if unsafe and e.errcode != 503: #503 comes from a full server before the call runs
+                    raise
+                wait = self._backoff(attempt, e.headers.get('Retry-After') if e.headers else None)
+            except (ConnectionRefusedError, socket.gaierror):
+                if attempt >= retries:
+                    raise
+                wait = self._backoff(attempt)
+            except (OSError, http.client.HTTPException):
+                if unsafe or attempt >= retries: #Might have run already, don't run it twice
+                    raise
+                wait = self._backoff(attempt)
+            attempt += 1
+            with self.lock:
+                self.stats_counts['retries'] += 1
+            time.sleep(wait)
+
+    # Exponential backoff with jitter so retries from many threads don't arrive together
+    def _backoff(self, attempt, retry_after=None):
+        wait = min(self.max_backoff, self.backoff * (2 ** attempt)) * random.uniform(0.5, 1.5)
+        if retry_after:
+            try:
+                wait = max(wait, min(float(retry_after), self.max_backoff))
+            except ValueError:
+                pass
+        return wait
+
+    def _request(self, body, timeout):
+        conn, reused = self._get(timeout)
+        keep = False
+        try:
+            try:
+                conn.putrequest('POST', self.path, skip_accept_encoding=True)
+                conn.putheader('Content-Type', 'text/xml')
+                conn.putheader('Content-Length', str(len(body)))
+                conn.putheader('User-Agent', xmlrpc.client.Transport.user_agent)
+                conn.endheaders(body)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                if reused:
+                    raise StaleConnection()
+                raise
+            data = response.read()
+            keep = not response.will_close
+            if response.status != 200:
+                raise xmlrpc.client.ProtocolError(self.url, response.status, response.reason,
+                                                  dict(response.getheaders()))
+            parser, unmarshaller = xmlrpc.client.getparser(use_builtin_types=self.use_builtin_types)
+            parser.feed(data)
+            parser.close()
+            result = unmarshaller.close()
+            return result[0] if len(result) == 1 else result
+        finally:
+            if keep:
+                self._put(conn)
+            else:
+                conn.close()
+
+    # A connection from the pool (reused=True) or a new one
+    def _get(self, timeout):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+            if conn is not None:
+                self.stats_counts['reused'] += 1
+            else:
+                self.stats_counts['connections'] += 1
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = cls(self.host, self.port, timeout=timeout)
+            conn.connect()
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) #Headers and body go out separately
+            return conn, False
+        conn.timeout = timeout
+        conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.stats_counts)
+            result['idle'] = len(self.idle)
+            return result
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# client.system.listMethods -> _Method(client, 'system').listMethods -> call('system.listMethods')
+class _Method:
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, name):
+        return _Method(self._client, f"{self._name}.{name}")
+
+    def __call__(self, *args):
+        return self._client.call(self._name, *args)
@@ -0,0 +1,95 @@
+import threading
+import time
+
+
+# One side (read or write) of an RWLock, usable in a with statement
+class _LockSide:
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+# Readers/writer lock: any number of readers at the same time or one writer
+# Writers are preferred, new readers wait while a writer is waiting so a steady
+# stream of reads can't starve saveNote.
+# Counts acquisitions and time spent waiting for the lock on each side.
+class RWLock:
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0 #Readers holding the lock
+        self._writer = False #A writer holds the lock
+        self._writers_waiting = 0
+        self._stats = {side: {'acquired': 0, 'contended': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+                       for side in ('read', 'write')}
+        self._read_side = _LockSide(self.acquire_read, self.release_read)
+        self._write_side = _LockSide(self.acquire_write, self.release_write)
+
+    # with lock.read(): ...
+    def read(self):
+        return self._read_side
+
+    # with lock.write(): ...
+    def write(self):
+        return self._write_side
+
+    def acquire_read(self):
+        start = time.perf_counter()
+        with self._cond:
+            contended = self._writer or self._writers_waiting > 0
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+            self._record('read', contended, time.perf_counter() - start)
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        start = time.perf_counter()
+        with self._cond:
+            contended = self._writer or self._readers > 0
+            self._writers_waiting += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+            self._record('write', contended, time.perf_counter() - start)
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    # Caller holds self._cond
+    def _record(self, side, contended, waited):
+        stats = self._stats[side]
+        stats['acquired'] += 1
+        if contended:
+            stats['contended'] += 1
+        stats['wait_total'] += waited
+        if waited > stats['wait_max']:
+            stats['wait_max'] = waited
+
+    # Snapshot of the contention counters, wait times are in seconds
+    def stats(self):
+        with self._cond:
+            result = {side: dict(values) for side, values in self._stats.items()}
+            for values in result.values():
+                values['wait_avg'] = values['wait_total'] / values['acquired'] if values['acquired'] else 0.0
+            result['readers_active'] = self._readers
+            result['writer_active'] = self._writer
+            result['writers_waiting'] = self._writers_waiting
+            return result
@@ -0,0 +1,104 @@
+import argparse
+import itertools
+import math
+import random
+import statistics
+import sys
+import time
+from searchindex import SearchIndex, count_in
+
+
+# Word i of the vocabulary is picked with probability proportional to 1 / (i + 1), like words in text
+def make_words(vocabulary):
+    words = [f"word{i}" for i in range(vocabulary)]
+    return words, list(itertools.accumulate(1 / (i + 1) for i in range(vocabulary)))
+
+
+def build_index(notes, words, cum_weights, rng):
+    index = SearchIndex()
+    for number in range(notes):
+        name = ' '.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(1, 4)))
+        text = ' '.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(5, 30)))
+        index.add(name, text, number)
+    return index
+
+
+# What SearchIndex.search did before it pruned: score every note of the rarest word, then take the best
+def exhaustive(index, query, limit):
+    words = set(query.split())
+    postings = []
+    for word in words:
+        groups = index.postings.get(word)
+        if groups is None:
+            return []
+        postings.append((sum(len(numbers) for numbers in groups.values()), sorted(groups.items(), reverse=True)))
+    postings.sort(key=lambda posting: posting[0])
+    weights = [math.log(1 + len(index) / size) for size, groups in postings]
+    scored = []
+    for count, numbers in postings[0][1]:
+        for number in numbers:
+            score = count * weights[0]
+            for (size, groups), weight in zip(postings[1:], weights[1:]):
+                found = count_in(groups, number)
+                if not found:
+                    break
+                score += found * weight
+            else:
+                scored.append((score, number))
+    return [index.refs[number] for score, number in sorted(scored, reverse=True)[:limit]]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+# Search benchmark for the XML engines' inverted index
+# Builds a SearchIndex over generated notes (word frequencies follow Zipf's law) and runs queries
+# of 1, 2 and 4 words: taken from the most common words (every word is in many notes), picked by
+# frequency like the notes themselves, and one rarer word with common ones. Each query is answered by
+# SearchIndex.search and by scoring every candidate, the results must be the same.
+def main(argv):
+    parser = argparse.ArgumentParser(description="Time searchNotes queries on the in-memory search index")
+    parser.add_argument('--notes', type=int, default=1000000, help="number of notes to index (default 1000000)")
+    parser.add_argument('--vocabulary', type=int, default=50000, help="number of different words (default 50000)")
+    parser.add_argument('--queries', type=int, default=50, help="queries per kind (default 50)")
+    parser.add_argument('--limit', type=int, default=20, help="results per query, like searchNotes (default 20)")
+    args = parser.parse_args(argv)
+    rng = random.Random(1)
+    words, cum_weights = make_words(args.vocabulary)
+    print(f"Indexing {args.notes} notes...")
+    start = time.perf_counter()
+    index = build_index(args.notes, words, cum_weights, rng)
+    print(f"Indexed in {time.perf_counter() - start:.1f} s")
+    print(f"{'Query':<25}{'pruned p50':>12}{'p95':>10}{'max':>10}{'exhaustive p50':>16}{'p95':>11}")
+    for size in (1, 2, 4):
+        for kind in ('common', 'by frequency', 'rare + common'):
+            pruned = []
+            full = []
+            for i in range(args.queries):
+                if kind == 'common':
+                    query = ' '.join(rng.sample(words[:20], size))
+                elif kind == 'by frequency':
+                    query = ' '.join(rng.choices(words, cum_weights=cum_weights, k=size))
+                else: #One word in a few hundred notes or fewer, the others in most notes
+                    query = ' '.join([rng.choice(words[1000:5000])] + rng.sample(words[:20], size - 1))
+                result, elapsed = timed(index.search, query, args.limit)
+                pruned.append(elapsed)
+                expected, elapsed = timed(exhaustive, index, query, args.limit)
+                full.append(elapsed)
+                if result != expected:
+                    sys.exit(f"Different results for {query!r}")
+            label = f"{size} word{'s' if size > 1 else ''}, {kind}"
+            print(f"{label:<25}{statistics.median(pruned):>9.2f} ms{percentile(pruned, 95):>7.2f} ms"
+                  f"{max(pruned):>7.2f} ms{statistics.median(full):>13.2f} ms{percentile(full, 95):>8.2f} ms")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
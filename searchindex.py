@@ -0,0 +1,178 @@
+import re
+import math
+import heapq
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+WORD = re.compile(r'\w+')
+NAME_WEIGHT = 2 #A word in the note name counts as much as two in the text
+DIRECT_PROBES = 20000 #Up to this many lookups in the other words a search scores every note of the rarest word
+
+
+# Lower case words of a string, the same for notes and queries
+def tokenize(text):
+    return WORD.findall(text.casefold()) if text else []
+
+
+# Inverted index over note names and text for searchNotes
+# Every note gets a number in the order it was added, refs[number] is whatever the storage needs
+# to find the note. For every word postings holds the numbers of the notes containing it, grouped
+# by how often the word is in them: count -> array of note numbers (always increasing, notes are
+# only added). Picking one group of every query word fixes the score of the notes in all of them,
+# so a search goes through these combinations best score first, takes the newest notes of each and
+# stops as soon as the next combination scores lower than the results it has (MaxScore-style).
+# When the rarest word is in few notes it is cheaper to score each of them, which is what a query
+# with no or few matches does anyway.
+class SearchIndex:
+    def __init__(self):
+        self.refs = []
+        self.postings = {} #word -> {count: array of note numbers}
+
+    def add(self, name, text, ref):
+        number = len(self.refs)
+        self.refs.append(ref)
+        counts = Counter(tokenize(text))
+        for word in tokenize(name):
+            counts[word] += NAME_WEIGHT
+        for word, count in counts.items():
+            groups = self.postings.get(word)
+            if groups is None:
+                groups = self.postings[word] = {}
+            numbers = groups.get(count)
+            if numbers is None:
+                numbers = groups[count] = array('l')
+            numbers.append(number)
+
+    # refs of the notes containing every word of query, best match first, at most limit of them
+    # Notes are scored with tf-idf, newer notes first when the score is the same
+    def search(self, query, limit):
+        words = set(tokenize(query))
+        if not words or limit < 1:
+            return []
+        postings = []
+        for word in words:
+            groups = self.postings.get(word)
+            if groups is None: #AND, a missing word means no results
+                return []
+            postings.append((sum(len(numbers) for numbers in groups.values()), groups))
+        postings.sort(key=lambda posting: posting[0]) #Rarest word first
+        total = len(self.refs)
+        weights = [math.log(1 + total / size) for size, groups in postings]
+        groups = [sorted(word_groups.items(), reverse=True) for size, word_groups in postings] #Highest count first
+        best = [] #Heap of (score, number), the worst of the results so far on top
+        if len(postings) > 1 and postings[0][0] * (len(postings) - 1) <= DIRECT_PROBES:
+            probes = [sorted(word_groups.items(), key=lambda group: -len(group[1])) for size, word_groups in postings]
+            score_all(groups[0], probes[1:], weights, best, limit)
+        else:
+            score_combinations(groups, weights, best, limit)
+        return [self.refs[number] for score, number in sorted(best, reverse=True)]
+
+    def __len__(self):
+        return len(self.refs)
+
+
+# Score every note of the rarest word (first_groups), looking it up in the groups of the other words
+# probes holds those largest group first, the one a note is most likely in. weights are per query
+# word as in SearchIndex.search, best is the heap of results
+def score_all(first_groups, probes, weights, best, limit):
+    for count, numbers in first_groups:
+        for number in numbers:
+            score = count * weights[0]
+            for word_groups, weight in zip(probes, weights[1:]):
+                found = count_in(word_groups, number)
+                if not found:
+                    break
+                score += found * weight
+            else:
+                keep(best, limit, (score, number))
+
+
+# Go through the combinations of one group per word, best score first
+# A combination is a tuple with the position of the group of every word, the one after it for
+# a word is the group with the next lower count, which never scores higher. The notes in all groups
+# of a combination are worked out word by word and kept per prefix of the combination, most share
+# theirs with the ones before and it is usually empty long before the last word.
+def score_combinations(groups, weights, best, limit):
+    def score(combination):
+        total = groups[0][combination[0]][0] * weights[0] #Added up in the same order as score_all
+        for word in range(1, len(groups)):
+            total += groups[word][combination[word]][0] * weights[word]
+        return total
+    common = {} #Prefix of a combination -> the notes in all its groups, an array for a single group
+    def notes_in(prefix):
+        found = common.get(prefix)
+        if found is None:
+            numbers = groups[len(prefix) - 1][prefix[-1]][1]
+            if len(prefix) == 1:
+                found = numbers
+            else:
+                before = notes_in(prefix[:-1])
+                if len(before) * 20 < len(numbers): #Cheaper to look the few up than to go through numbers
+                    found = set()
+                    for number in before:
+                        pos = bisect_left(numbers, number)
+                        if pos < len(numbers) and numbers[pos] == number:
+                            found.add(number)
+                elif isinstance(before, set):
+                    found = before.intersection(numbers)
+                else:
+                    found = set(numbers).intersection(before) if len(numbers) < len(before) else set(before).intersection(numbers)
+            common[prefix] = found
+        return found
+    first = (0,) * len(groups)
+    todo = [(-score(first), first)]
+    seen = {first}
+    while todo:
+        negative, combination = heapq.heappop(todo)
+        if len(best) == limit and -negative < best[0][0]:
+            break #The rest score lower still
+        if len(combination) == 2: #Two groups, the newest notes in both are found quicker from the end
+            newest = newest_in_both(groups[0][combination[0]][1], groups[1][combination[1]][1], limit)
+        elif len(combination) == 1:
+            newest = reversed(groups[0][combination[0]][1][-limit:])
+        else:
+            newest = heapq.nlargest(limit, notes_in(combination))
+        for number in newest: #Newest first, they win ties
+            item = (-negative, number)
+            if len(best) == limit and item < best[0]:
+                break #Older notes with the same score can't make it either
+            keep(best, limit, item)
+        for word in range(len(combination)):
+            if combination[word] + 1 < len(groups[word]):
+                following = combination[:word] + (combination[word] + 1,) + combination[word + 1:]
+                if following not in seen:
+                    seen.add(following)
+                    heapq.heappush(todo, (-score(following), following))
+
+
+# Up to limit numbers in both arrays, the highest first
+def newest_in_both(numbers, others, limit):
+    if len(others) < len(numbers):
+        numbers, others = others, numbers
+    found = []
+    for i in range(len(numbers) - 1, -1, -1):
+        number = numbers[i]
+        pos = bisect_left(others, number)
+        if pos < len(others) and others[pos] == number:
+            found.append(number)
+            if len(found) == limit:
+                break
+    return found
+
+
+# Add (score, number) to the heap of results if it is one of the best limit
+def keep(best, limit, item):
+    if len(best) < limit:
+        heapq.heappush(best, item)
+    elif item > best[0]:
+        heapq.heapreplace(best, item)
+
+
+# How often a word is in note number, 0 if it isn't, groups is a list of (count, numbers)
+def count_in(groups, number):
+    for count, numbers in groups:
+        pos = bisect_left(numbers, number)
+        if pos < len(numbers) and numbers[pos] == number:
+            return count
+    return 0
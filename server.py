@@ -1,71 +1,280 @@
-import xml.etree.ElementTree as ET
-import requests
 import datetime
+import base64
+import json
+import argparse
+import signal
+import os
+import socket
+import threading
+import tracemalloc
 from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 from socketserver import ThreadingMixIn
+from storage import XMLStorage, LazyXMLStorage, ShardedXMLStorage, SQLiteStorage, InvalidCursor, parse_epoch
+from wiki import WikiLookup, WIKIPEDIA_API
+from jobs import JobQueue, QueueFull
+from pool import PooledMixIn, PooledRequestHandlerMixIn
+from aioserver import AsyncXMLRPCServer
+from prefork import fork_workers
+from metrics import metrics, MetricsMixIn
+from profiling import profiler, ProfilingMixIn
 Database = 'database.xml'
-# Server that can handle multiple requests at the same time
-class THreadingSimpleXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+
+# Command line options for choosing the storage engine and tuning how often the database is written to disk
+parser = argparse.ArgumentParser(description="XML-RPC notes server")
+parser.add_argument('--storage', choices=['xml', 'xml-lazy', 'xml-sharded', 'sqlite'], default='xml',
+                    help="xml keeps notes in database.xml, xml-lazy does too but only reads a topic from the "
+                         "file when it is asked for, xml-sharded splits the topics over many XML files so a save "
+                         "only writes one of them, sqlite uses an indexed SQLite database (default xml)")
+parser.add_argument('--shard-dir', default='database.shards',
+                    help="xml-sharded storage: folder of the shard files, fill it from database.xml with "
+                         "'python dbtool.py shard' (default database.shards)")
+parser.add_argument('--shards', type=int, default=16,
+                    help="xml-sharded storage: number of shard files for a new database (default 16)")
+parser.add_argument('--load-workers', type=int, default=None,
+                    help="xml-sharded storage: processes reading shards at startup (default: number of CPUs the server may use)")
+parser.add_argument('--cache-mb', type=float, default=64,
+                    help="xml-lazy storage: memory budget in MB for topics read from database.xml (default 64)")
+parser.add_argument('--sqlite-path', default='notes.db',
+                    help="sqlite storage: database file, fill it from database.xml with "
+                         "'python dbtool.py migrate' (default notes.db)")
+parser.add_argument('--flush-interval', type=float, default=1.0,
+                    help="seconds between writes of pending notes to disk (default 1.0)")
+parser.add_argument('--flush-threshold', type=int, default=100,
+                    help="write to disk as soon as this many notes are pending (default 100)")
+parser.add_argument('--persistence', choices=['batch', 'journal'], default='batch',
+                    help="batch rewrites database.xml in batches, journal appends each note to a journal "
+                         "that is folded into database.xml in the background (default batch)")
+parser.add_argument('--compact-interval', type=float, default=60.0,
+                    help="journal mode: seconds between folding the journal into database.xml (default 60)")
+parser.add_argument('--compact-size', type=int, default=16 * 1024 * 1024,
+                    help="journal mode: fold the journal into database.xml once it is this many bytes (default 16 MiB)")
+parser.add_argument('--wikipedia-url', default=WIKIPEDIA_API,
+                    help=f"opensearch API to ask for Wikipedia pages, e.g. a local wikistub.py (default {WIKIPEDIA_API})")
+parser.add_argument('--wiki-cache-ttl', type=float, default=3600,
+                    help="seconds a Wikipedia page found for a topic is remembered (default 3600)")
+parser.add_argument('--wiki-cache-negative-ttl', type=float, default=300,
+                    help="seconds a topic without a Wikipedia page is remembered (default 300)")
+parser.add_argument('--wiki-cache-size', type=int, default=1000,
+                    help="most topics kept in the Wikipedia cache (default 1000)")
+parser.add_argument('--wiki-pool-size', type=int, default=10,
+                    help="most open keep-alive connections to Wikipedia (default 10)")
+parser.add_argument('--wiki-connect-timeout', type=float, default=3.05,
+                    help="seconds to wait for a connection to Wikipedia (default 3.05)")
+parser.add_argument('--wiki-read-timeout', type=float, default=10,
+                    help="seconds to wait for Wikipedia to answer (default 10)")
+parser.add_argument('--wiki-retries', type=int, default=2,
+                    help="times a failed Wikipedia request is retried, with exponential backoff (default 2)")
+parser.add_argument('--wiki-backoff', type=float, default=0.2,
+                    help="seconds to wait before the first retry, doubled for each one after (default 0.2)")
+parser.add_argument('--wiki-breaker-failures', type=int, default=5,
+                    help="failed Wikipedia requests in a row before lookups fail fast (default 5)")
+parser.add_argument('--wiki-breaker-reset', type=float, default=30,
+                    help="seconds to fail fast before trying Wikipedia again (default 30)")
+parser.add_argument('--job-workers', type=int, default=4,
+                    help="background threads running getwikipediaAsync jobs (default 4)")
+parser.add_argument('--job-queue-size', type=int, default=1000,
+                    help="most getwikipediaAsync jobs waiting to run, more are refused (default 1000)")
+parser.add_argument('--job-keep', type=float, default=600,
+                    help="seconds a finished job's result can still be fetched (default 600)")
+parser.add_argument('--max-page-size', type=int, default=1000,
+                    help="most notes getNotesPage returns in one call (default 1000)")
+parser.add_argument('--max-page-bytes', type=int, default=1024 * 1024,
+                    help="getNotesPage stops adding notes to a page once they add up to this many bytes (default 1 MiB)")
+parser.add_argument('--max-wait', type=float, default=30,
+                    help="longest timeout waitForChanges accepts, in seconds (default 30)")
+parser.add_argument('--profile-every', type=int, default=0,
+                    help="profile every Nth call of each method with cProfile, 0 is off (default 0), "
+                         "system.setProfiling changes it while running")
+parser.add_argument('--profile-memory', type=int, nargs='?', const=5, default=0, metavar='FRAMES',
+                    help="trace memory with tracemalloc so profiled calls also record their allocations, keeping "
+                         "FRAMES stack frames each (default 5), every call gets slower while it is on")
+parser.add_argument('--profile-dir', default='profiles',
+                    help="folder system.dumpProfile writes profiles to (default profiles)")
+parser.add_argument('--server-mode', choices=['threads', 'pool', 'asyncio'], default='threads',
+                    help="threads: a new thread per connection (default), pool: a fixed number of worker threads, "
+                         "asyncio: keep-alive connections on an event loop, calls run on worker threads")
+parser.add_argument('--pool-workers', type=int, default=16,
+                    help="worker threads in pool and asyncio mode (default 16)")
+parser.add_argument('--idle-timeout', type=float, default=60,
+                    help="seconds an idle keep-alive connection stays open (default 60)")
+parser.add_argument('--pool-queue-size', type=int, default=64,
+                    help="connections that can wait for a worker in pool mode, more get a 503 (default 64)")
+parser.add_argument('--workers', type=int, default=1,
+                    help="server processes sharing port 3000, more than 1 needs --storage sqlite (default 1)")
+args = parser.parse_args()
+if args.shards < 1:
+    parser.error("--shards must be at least 1")
+if args.profile_every < 0:
+    parser.error("--profile-every can't be negative")
+if args.profile_memory < 0:
+    parser.error("--profile-memory needs at least 1 frame")
+if args.workers > 1 and args.storage != 'sqlite':
+    parser.error("--workers needs --storage sqlite, the XML engines can't be shared between processes")
+profiler.every = args.profile_every
+profiler.directory = args.profile_dir
+if args.profile_memory:
+    tracemalloc.start(args.profile_memory) #Before any threads, see Profiler
+# Server that can handle multiple requests at the same time, every call is counted in metrics and sampled
+# calls are profiled. When it closes, open keep-alive connections stop taking calls and the calls
+# that are running finish, so every note a client was told is saved reaches the store before it closes.
+class THreadingSimpleXMLRPCServer(ProfilingMixIn, MetricsMixIn, ThreadingMixIn, SimpleXMLRPCServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.open_lock = threading.Lock()
+        self.open_requests = set() #Sockets of connections being handled
+
+    def process_request(self, request, client_address):
+        with self.open_lock:
+            self.open_requests.add(request)
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        with self.open_lock:
+            self.open_requests.discard(request)
+        super().shutdown_request(request)
+
+    # Shutting down the read side ends idle connections right away (they read the end of the stream),
+    # a call that is running still writes its answer. ThreadingMixIn then joins the connection threads.
+    def server_close(self):
+        with self.open_lock:
+            for request in self.open_requests:
+                try:
+                    request.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        super().server_close()
+# Server with a fixed number of worker threads that turns connections away when they are all busy
+class PooledXMLRPCServer(ProfilingMixIn, MetricsMixIn, PooledMixIn, SimpleXMLRPCServer):
     pass
+class MeteredAsyncXMLRPCServer(ProfilingMixIn, MetricsMixIn, AsyncXMLRPCServer):
+    pass
+# Page for Prometheus to scrape
+def metricsPage():
+    return 'text/plain; version=0.0.4; charset=utf-8', metrics.prometheus().encode('utf-8')
 # Request handler for the server
 class RequestHandler(SimpleXMLRPCRequestHandler):
     rpc_paths = ('/RPC2',)
+    get_paths = {'/metrics': metricsPage} #Plain HTTP GET pages next to /RPC2
+    protocol_version = 'HTTP/1.1' #Keep connections open between calls
+    disable_nagle_algorithm = True #Headers and body are written separately, don't let them wait for an ACK
+    timeout = args.idle_timeout #Close keep-alive connections that are idle this long
+
+    def do_GET(self):
+        page = self.get_paths.get(self.path)
+        if page is None:
+            self.report_404()
+            return
+        content_type, body = page()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+# In pool mode a keep-alive connection holds on to its worker, it is given up when others are waiting
+class PooledRequestHandler(PooledRequestHandlerMixIn, RequestHandler):
+    pass
+
+worker = None
+if args.workers > 1:
+    # Processes share the port with SO_REUSEPORT, the kernel spreads connections across them.
+    # Notes are shared through the SQLite database, which handles locking between processes,
+    # and background jobs through a table in it so any process can answer getJobStatus.
+    SQLiteStorage(args.sqlite_path).close() #Create the schema once instead of in every process
+    print(f"Starting {args.workers} server processes")
+    worker = fork_workers(args.workers)
+    THreadingSimpleXMLRPCServer.allow_reuse_port = True
+    PooledXMLRPCServer.allow_reuse_port = True
+
+# Open the notes store, XML creates database.xml if one doesn't exist
+# Before the server, whose pool workers are threads: xml-sharded forks processes to read the shards
+if args.storage == 'sqlite':
+    store = SQLiteStorage(args.sqlite_path)
+elif args.storage == 'xml-sharded':
+    store = ShardedXMLStorage(args.shard_dir, shards=args.shards, persistence=args.persistence,
+                              flush_interval=args.flush_interval, flush_threshold=args.flush_threshold,
+                              compact_interval=args.compact_interval, compact_size=args.compact_size,
+                              load_workers=args.load_workers)
+elif args.storage == 'xml-lazy': #Always journals, the file is only rewritten when the journal is compacted
+    store = LazyXMLStorage(Database, flush_interval=args.flush_interval, compact_interval=args.compact_interval,
+                           compact_size=args.compact_size, cache_bytes=int(args.cache_mb * 1024 * 1024))
+else:
+    store = XMLStorage(Database, persistence=args.persistence, flush_interval=args.flush_interval,
+                       flush_threshold=args.flush_threshold, compact_interval=args.compact_interval,
+                       compact_size=args.compact_size)
+if args.profile_memory:
+    tracemalloc.clear_traces() #Loading the notes isn't part of any call
+if getattr(store, 'replayed', 0):
+    print(f"Replayed {store.replayed} notes from the journal")
+
+if args.server_mode == 'pool':
+    server = PooledXMLRPCServer(('localhost', 3000), requestHandler=PooledRequestHandler,
+                                workers=args.pool_workers, max_queued=args.pool_queue_size)
+elif args.server_mode == 'asyncio':
+    server = MeteredAsyncXMLRPCServer(('localhost', 3000), requestHandler=RequestHandler,
+                               workers=args.pool_workers, idle_timeout=args.idle_timeout,
+                               reuse_port=worker is not None)
+else:
+    server = THreadingSimpleXMLRPCServer(('localhost', 3000), requestHandler=RequestHandler)
 
 # Server that can handle multiple requests at the same time
-with THreadingSimpleXMLRPCServer(('localhost', 3000),
-                        requestHandler=RequestHandler) as server:
+with server:
     server.register_introspection_functions()
-    # Initialize the database or creates if one doesn't exist
-    try:
-        tree = ET.parse(Database)
-        root = tree.getroot()
-    except (ET.ParseError, FileNotFoundError):
-        root = ET.Element('data')
-        tree = ET.ElementTree(root)
-        tree.write(Database, encoding="utf-8")
-
-    # This Function is used to indent the xml file for better readability
-    #Adds line breaks to xml file
-    def indent(elem):
-       for subelem in elem:
-           indent(subelem)
-       if len(elem):
-           elem.text = '\n'
-           elem.tail = '\n'
-       else:
-           elem.tail = '\n'
+    server.register_multicall_functions() #system.multicall runs many calls in one HTTP request
                 
+    # Check a note before it is saved, returns an error message or None if the note is fine
+    def checkNote(topic, note, text, date):
+        if topic.strip() == "" or note.strip() == "" or text.strip() == "":
+            return "Topic, Note or Text cannot be empty"
+        elif not isinstance(topic, str) or not isinstance(note, str) or not isinstance(text, str):
+            return "Topic, Note and Text should be strings"
+        try:
+            datetime.datetime.strptime(date, "%d/%m/%Y %H:%M:%S")
+        except ValueError:
+            return "Incorrect date format, should be DD/MM/YYYY HH:MM:SS"
+        return None
+
     # Function to create a new note/topic and save it to database
-    def saveNote(topic, note, text, date):
+    # If wait is true the call returns only after the note is written to disk
+    def saveNote(topic, note, text, date, wait=False):
         try: #Check if input is valid
-            if topic.strip() == "" or note.strip() == "" or text.strip() == "":
-                return "Topic, Note or Text cannot be empty"
-            elif not isinstance(topic, str) or not isinstance(note, str) or not isinstance(text, str):
-                return "Topic, Note and Text should be strings"
-            try:
-                datetime.datetime.strptime(date, "%d/%m/%Y %H:%M:%S")
-            except ValueError:
-                return "Incorrect date format, should be DD/MM/YYYY HH:MM:SS"
-            root = tree.getroot() #Get root of xml file
-            temptopic = None
-            for temp in root.findall('topic'): #Check if topic already exists
-                if temp.get('name') == topic:
-                    temptopic = temp
-                    break
-            if temptopic is None: #If topic doesn't exist, create a new one
-                temptopic = ET.SubElement(root, 'topic')
-                temptopic.set('name', topic)
-            tempnote = ET.SubElement(temptopic, 'note') #Create a new note
-            tempnote.set('name', note)
-            ET.SubElement(tempnote, 'text').text = text
-            ET.SubElement(tempnote, 'timestamp').text = date
-            indent(root) #Indent the xml file
-            tree.write(Database, encoding="utf-8") #Save the xml file
+            error = checkNote(topic, note, text, date)
+            if error:
+                return error
+            ticket = store.save_note(topic, note, text, date) #Saved to disk in the background
+            if wait and not store.wait_durable(ticket):
+                return "Error saving note: could not write database to disk"
             return "Note saved successfully"
         except Exception as e:
             return f"Error saving note: {e}"
     
     server.register_function(saveNote, 'saveNote')
+    # Function to save many notes in one call, each note is [topic, note, text, date]
+    # Valid notes are stored together under one lock and written to disk in one flush
+    # Returns one message per note, in the same order
+    def saveNotes(notes, wait=False):
+        try:
+            results = []
+            valid = []
+            for item in notes:
+                try:
+                    topic, note, text, date = item
+                    error = checkNote(topic, note, text, date)
+                except Exception as e:
+                    error = f"Error saving note: {e}"
+                if error:
+                    results.append(error)
+                else:
+                    results.append("Note saved successfully")
+                    valid.append((topic, note, text, date))
+            if valid:
+                ticket = store.save_notes(valid)
+                if wait and not store.wait_durable(ticket):
+                    return "Error saving notes: could not write database to disk"
+            return results
+        except Exception as e:
+            return f"Error saving notes: {e}"
+
+    server.register_function(saveNotes, 'saveNotes')
     # Function to get notes by topic
     def getnotes(topic):
         try: #Check if input is valid
@@ -74,72 +283,288 @@ with THreadingSimpleXMLRPCServer(('localhost', 3000),
             elif not isinstance(topic, str):
                 return "Topic should be a string"
             
-            root = tree.getroot() #Get root of xml file
-            notes = []
-            for tempname in root.findall('topic'): # Check if topic exists
-                if tempname.get('name') == topic:
-                    break
-            if tempname.get('name') != topic: #If topic doesn't exist, return error
+            notes = store.get_notes(topic) #Get all notes for the topic
+            if notes is None: #If topic doesn't exist, return error
                 return "No notes found"
-            for tempnote in tempname.findall('note'): #Get all notes for the topic
-                notes.append((tempnote.get('name'), tempnote.find('text').text, tempnote.find('timestamp').text))
             return notes #Return all notes
         except Exception as e: 
             return f"Error getting notes: {e}"
     
     server.register_function(getnotes, 'getnotes')
+    # Function to get the notes of many topics in one call
+    # Returns what getnotes would return for each topic, in the same order
+    def getNotesForTopics(topics):
+        try:
+            return [getnotes(topic) for topic in topics]
+        except Exception as e:
+            return f"Error getting notes: {e}"
+
+    server.register_function(getNotesForTopics, 'getNotesForTopics')
+    # Cursors are opaque to clients, inside they hold where the last page ended and in which order
+    def makeCursor(after, newestFirst):
+        return base64.urlsafe_b64encode(json.dumps([after, bool(newestFirst)]).encode()).decode()
+
+    def readCursor(cursor, newestFirst):
+        after, newest = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(after, int) or newest != bool(newestFirst):
+            raise ValueError("cursor does not belong to this query")
+        return after
+
+    # Function to get the notes of a topic a page at a time
+    # Pass the returned cursor to get the next page, it is "" after the last page
+    # Returns {'notes': [...], 'cursor': str, 'total': number of notes in the topic}
+    def getNotesPage(topic, limit=100, cursor="", newestFirst=False):
+        try: #Check if input is valid
+            if topic.strip() == "":
+                return "Topic cannot be empty"
+            elif not isinstance(topic, str):
+                return "Topic should be a string"
+            if not isinstance(limit, int) or limit < 1:
+                return "Limit should be a positive number"
+            try:
+                after = readCursor(cursor, newestFirst) if cursor else None
+            except Exception:
+                return "Invalid cursor"
+            try:
+                page = store.get_page(topic, after, min(limit, args.max_page_size), newestFirst, args.max_page_bytes)
+            except InvalidCursor:
+                return "Invalid cursor"
+            if page is None: #If topic doesn't exist, return error
+                return "No notes found"
+            notes, after, total = page
+            return {'notes': notes, 'cursor': makeCursor(after, newestFirst) if after is not None else "",
+                    'total': total}
+        except Exception as e:
+            return f"Error getting notes: {e}"
+
+    server.register_function(getNotesPage, 'getNotesPage')
+    # Function to get the notes saved between two dates (DD/MM/YYYY HH:MM:SS, both included), oldest first
+    # topic "" means all topics, each note comes back as [topic, name, text, timestamp]
+    def getNotesBetween(topic, start, end, limit=100):
+        try: #Check if input is valid
+            if not isinstance(topic, str):
+                return "Topic should be a string"
+            try:
+                startTime = datetime.datetime.strptime(start, "%d/%m/%Y %H:%M:%S")
+                endTime = datetime.datetime.strptime(end, "%d/%m/%Y %H:%M:%S")
+            except (ValueError, TypeError):
+                return "Incorrect date format, should be DD/MM/YYYY HH:MM:SS"
+            if startTime > endTime:
+                return "Start date should not be after end date"
+            if not isinstance(limit, int) or limit < 1:
+                return "Limit should be a positive number"
+            notes = store.get_notes_between(topic if topic.strip() else None, parse_epoch(start), parse_epoch(end),
+                                            min(limit, args.max_page_size))
+            if notes is None: #If topic doesn't exist, return error
+                return "No notes found"
+            return notes
+        except Exception as e:
+            return f"Error getting notes: {e}"
+
+    server.register_function(getNotesBetween, 'getNotesBetween')
+    # Function to search all notes for words in their name or text, a note must contain every word
+    # Best matches come first, each note comes back as [topic, name, text, timestamp]
+    def searchNotes(query, limit=20):
+        try: #Check if input is valid
+            if not isinstance(query, str):
+                return "Query should be a string"
+            elif query.strip() == "":
+                return "Query cannot be empty"
+            if not isinstance(limit, int) or limit < 1:
+                return "Limit should be a positive number"
+            notes = store.search(query, min(limit, args.max_page_size))
+            if not notes:
+                return "No notes found"
+            return notes
+        except Exception as e:
+            return f"Error searching notes: {e}"
+
+    server.register_function(searchNotes, 'searchNotes')
     # Function to get all topics
-    def getTopics():
+    # With sinceVersion it returns {'version': ..., 'topics': [...]}, or "Not modified" if no topic was added
+    # after that version, pass the returned version the next time
+    def getTopics(sinceVersion=None):
         try:
-            root = tree.getroot() #Get root of xml file
-            topics = []
-            for temp in root.findall('topic'): #Get all topics
-                topics.append(temp.get('name'))
-            return topics #Return all topics
+            if sinceVersion is None:
+                return store.get_topics() #Return all topics
+            if not isinstance(sinceVersion, int) or isinstance(sinceVersion, bool):
+                return "Version should be a number"
+            result = store.get_topics_since(sinceVersion)
+            if result is None:
+                return "Not modified"
+            version, topics = result
+            return {'version': version, 'topics': topics}
         except Exception as e:
             return f"Error getting topics: {e}"
         
     server.register_function(getTopics, 'getTopics')
+    # Function to get every topic with its number of notes, as [topic, count] in the order topics were created
+    def getTopicCounts():
+        try:
+            return store.get_topic_counts()
+        except Exception as e:
+            return f"Error getting topics: {e}"
+
+    server.register_function(getTopicCounts, 'getTopicCounts')
+    # A waiting call holds a worker thread, in pool and asyncio mode half of them are kept for other calls
+    waiters = threading.BoundedSemaphore(max(1, args.pool_workers // 2)) if args.server_mode != 'threads' else None
+    # Function to wait up to timeout seconds for notes saved after version sinceVersion
+    # Returns {'version', 'topics': new topics, 'notes': [[topic, note, text, date], ...], 'reset'} as soon as
+    # there are any, pass the version back for the next call. reset means sinceVersion is too old, reload everything.
+    def waitForChanges(sinceVersion, timeout=30):
+        try: #Check if input is valid
+            if not isinstance(sinceVersion, int) or isinstance(sinceVersion, bool):
+                return "Version should be a number"
+            if not isinstance(timeout, (int, float)) or timeout < 0:
+                return "Timeout should be a number of seconds"
+            timeout = min(timeout, args.max_wait)
+            if waiters is not None and not waiters.acquire(blocking=False):
+                timeout = 0 #Too many calls waiting already, answer right away and let the client call again
+                waiting = False
+            else:
+                waiting = waiters is not None
+            try:
+                version, topics, notes, reset = store.wait_for_changes(sinceVersion, timeout, args.max_page_size)
+            finally:
+                if waiting:
+                    waiters.release()
+            return {'version': version, 'topics': topics, 'notes': [list(note) for note in notes], 'reset': reset}
+        except Exception as e:
+            return f"Error waiting for changes: {e}"
+
+    server.register_function(waitForChanges, 'waitForChanges')
+    # Function to see how long calls wait for the notes lock, times are in seconds
+    def getLockStats():
+        return store.lock_stats()
+
+    server.register_function(getLockStats, 'getLockStats')
+    # Function to see how busy the server is, in pool mode how many connections wait and were turned away,
+    # in asyncio mode how many connections are open and how many calls reused one
+    def getServerStats():
+        if args.server_mode == 'pool':
+            result = server.pool_stats()
+        elif args.server_mode == 'asyncio':
+            result = server.async_stats()
+        else:
+            result = {'threads': threading.active_count()}
+        result['mode'] = args.server_mode
+        result['worker'] = worker if worker is not None else 0
+        result['pid'] = os.getpid()
+        return result
+
+    server.register_function(getServerStats, 'getServerStats')
+    # Function to get call counts, errors and latencies per method and time spent writing to disk
+    # and asking Wikipedia, the same numbers Prometheus gets from GET /metrics
+    def stats():
+        result = metrics.snapshot()
+        result['worker'] = worker if worker is not None else 0
+        result['pid'] = os.getpid()
+        return result
+
+    server.register_function(stats, 'system.stats')
+    # Function to profile every Nth call of each method, 0 turns profiling off
+    def setProfiling(every):
+        if not isinstance(every, int) or every < 0:
+            return "Error: every must be a whole number, 0 or more"
+        old = profiler.configure(every)
+        return f"Profiling every {every} calls per method (was {old})" if every else f"Profiling off (was {old})"
+
+    server.register_function(setProfiling, 'system.setProfiling')
+    # Function to write the profiles collected so far to --profile-dir, reset starts collecting again
+    # With --workers each process profiles the calls it gets, this dumps the one that answers
+    def dumpProfile(reset=False):
+        methods = profiler.summary()
+        if not any(method['samples'] for method in methods.values()):
+            return "Error: no calls have been profiled, turn profiling on with --profile-every or system.setProfiling"
+        folder, files = profiler.dump(reset)
+        return {'directory': os.path.abspath(folder), 'files': [os.path.basename(path) for path in files],
+                'methods': methods, 'pid': os.getpid()}
+
+    server.register_function(dumpProfile, 'system.dumpProfile')
     # Function to get wikipedia information
+    wiki = WikiLookup(args.wikipedia_url, ttl=args.wiki_cache_ttl, negative_ttl=args.wiki_cache_negative_ttl,
+                      max_entries=args.wiki_cache_size, pool_size=args.wiki_pool_size,
+                      connect_timeout=args.wiki_connect_timeout, read_timeout=args.wiki_read_timeout,
+                      retries=args.wiki_retries, backoff=args.wiki_backoff,
+                      breaker_failures=args.wiki_breaker_failures, breaker_reset=args.wiki_breaker_reset)
+    metrics.add_source('wiki', wiki.stats,
+                       counters=('hits', 'misses', 'coalesced', 'upstream_errors', 'retries', 'breaker_rejected'))
+    # Look up the page and save it as a note, errors are raised
+    def wikipediaNote(topic):
+        resURL = wiki.lookup(topic) #Cached, only asks Wikipedia the first time
+        if resURL is None: #Check if there is a wikipedia page for the topic
+            return "No Wikipedia information found"
+        date = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S") #Get current date
+        #On Wikimedia wikis descriptions are disabled due to performance reasons, so the second array only contains empty strings. See T241437.
+        saveNote(topic, resURL, "description is disabled by wikimedia", date) #Save the wikipedia page to the database
+        return f"Topics wikipedia page {resURL}"
+
     def getwikipedia(topic):
         try:
             if topic.strip() == "": #Check if input is valid
                 return "Topic cannot be empty"
             elif not isinstance(topic, str):
                 return "Topic should be a string"
-             
-            URL = "https://en.wikipedia.org/w/api.php" #URL for wikipedia API
-            #Parameters for the API
-            PARAMS = { 
-                "action": "opensearch", 
-                "namespace": "0",
-                "search": topic,
-                "limit": "1",
-                "format": "json"
-            }
-            response = requests.get(url=URL, params=PARAMS) #Get the response from the API
-            data = response.json()
-        
-            if data[3]: #Check if there is a wikipedia page for the topic
-                resURL = data[3][0]
-            else:
-                return "No Wikipedia information found"
-            date = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S") #Get current date
-            #On Wikimedia wikis descriptions are disabled due to performance reasons, so the second array only contains empty strings. See T241437.
-            saveNote(topic, resURL, "description is disabled by wikimedia", date) #Save the wikipedia page to the database
-            return f"Topics wikipedia page {resURL}"
+            return wikipediaNote(topic)
         except Exception as e:
             return f"Error getting wikipedia information: {e}"
     
     server.register_function(getwikipedia, 'getwikipedia')
+    # Same as getwikipedia but runs in the background, returns a job id for getJobStatus right away
+    jobs = JobQueue(workers=args.job_workers, max_queued=args.job_queue_size, keep_seconds=args.job_keep,
+                    shared_path=args.sqlite_path if worker is not None else None)
+    metrics.add_source('jobs', jobs.stats)
+    def getwikipediaAsync(topic):
+        try:
+            if topic.strip() == "": #Check if input is valid
+                return "Topic cannot be empty"
+            elif not isinstance(topic, str):
+                return "Topic should be a string"
+            return jobs.submit(topic, wikipediaNote, topic)
+        except QueueFull as e:
+            return f"Error starting wikipedia job: {e}"
+        except Exception as e:
+            return f"Error getting wikipedia information: {e}"
+
+    server.register_function(getwikipediaAsync, 'getwikipediaAsync')
+    # Function to get the state of a job: queued, running, done or failed, and its result once finished
+    def getJobStatus(jobId):
+        try:
+            job = jobs.status(jobId)
+            if job is None:
+                return "No such job"
+            return job
+        except Exception as e:
+            return f"Error getting job status: {e}"
+
+    server.register_function(getJobStatus, 'getJobStatus')
+    # Function to get the state of many jobs in one call, in the same order as the ids
+    def getJobStatuses(jobIds):
+        try:
+            return [getJobStatus(jobId) for jobId in jobIds]
+        except Exception as e:
+            return f"Error getting job status: {e}"
+
+    server.register_function(getJobStatuses, 'getJobStatuses')
     
     
-    print("Server running on port 3000") 
+    signal.signal(signal.SIGTERM, signal.default_int_handler) #Shut down cleanly on SIGTERM too so pending notes are written
+    if worker is not None:
+        print(f"Server process {worker} (pid {os.getpid()}) running on port 3000")
+    else:
+        print("Server running on port 3000") 
     
     try: #Run the server
         server.serve_forever()
     except KeyboardInterrupt: #Stop the server
         print("Shutting down server...")
-        server.server_close()
+        signal.signal(signal.SIGINT, signal.SIG_IGN) #A second Ctrl+C or SIGTERM must not cut the final write short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        store.stop_waiting() #waitForChanges calls answer now instead of holding up the shutdown
+        server.server_close() #Waits for the calls that are running
+        jobs.shutdown()
+        store.close() #Write notes that are still pending
+        if any(method['samples'] for method in profiler.summary().values()):
+            print(f"Profiles written to {profiler.dump()[0]}")
         print("Server stopped")
         
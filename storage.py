@@ -0,0 +1,1356 @@
+import xml.etree.ElementTree as ET
+import xml.parsers.expat as expat
+from xml.sax.saxutils import quoteattr, escape
+from collections import OrderedDict
+import os
+import sys
+import json
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import calendar
+import time
+import sqlite3
+import queue
+import threading
+import contextlib
+import itertools
+from rwlock import RWLock
+from timeindex import TimeIndex
+from searchindex import SearchIndex, tokenize
+from changefeed import ChangeFeed
+from metrics import metrics
+from persistence import SnapshotWriter, JournalWriter, atomic_write, replay_journals, remove_journals
+
+
+# Raised by get_page for a cursor that doesn't point into the topic, e.g. one the client made up
+class InvalidCursor(ValueError):
+    pass
+
+
+# Storage engines behind the server's saveNote/getnotes/getTopics
+# The server validates input and turns results into messages, engines only store notes
+class Storage:
+    # Store a note, returns a ticket for wait_durable()
+    def save_note(self, topic, note, text, date):
+        raise NotImplementedError
+
+    # Store many notes (topic, note, text, date) in one go, returns a ticket for wait_durable()
+    def save_notes(self, notes):
+        ticket = None
+        for note in notes:
+            ticket = self.save_note(*note)
+        return ticket
+
+    # Block until the change with the given ticket is on disk, False if that failed
+    def wait_durable(self, ticket):
+        return True
+
+    # List of (name, text, timestamp) for a topic in the order they were saved, None if there is no such topic
+    def get_notes(self, topic):
+        raise NotImplementedError
+
+    # One page of a topic's notes: (notes, next, total), None if there is no such topic
+    # after is the next value of the previous page (None for the first page), next is None on the
+    # last page. The page stops at limit notes or once the notes add up to about max_bytes.
+    def get_page(self, topic, after, limit, newest_first=False, max_bytes=1024 * 1024):
+        notes = self.get_notes(topic)
+        if notes is None:
+            return None
+        return paginate(notes, after, limit, newest_first, max_bytes)
+
+    # Notes with start <= timestamp <= end (seconds since the epoch) as (topic, name, text, timestamp),
+    # oldest first and at most limit of them. topic None means all topics. None if there is no such topic.
+    def get_notes_between(self, topic, start, end, limit):
+        raise NotImplementedError
+
+    # Notes whose name or text contain every word of query as (topic, name, text, timestamp),
+    # best match first and at most limit of them
+    def search(self, query, limit):
+        raise NotImplementedError
+
+    # All topic names in the order they were created
+    def get_topics(self):
+        raise NotImplementedError
+
+    # (topic, number of notes) for every topic, in the order they were created
+    def get_topic_counts(self):
+        raise NotImplementedError
+
+    # Version of the store, goes up by one for every note saved
+    # The XML engines keep it in self.feed, a ChangeFeed
+    def version(self):
+        return self.feed.version
+
+    # (version, topics) like get_topics, or None if no topic was added after version since
+    def get_topics_since(self, since):
+        with self.lock.read():
+            if self.feed.topics_version <= since <= self.feed.version:
+                return None
+            return self.feed.version, self._topics()
+
+    # Wait up to timeout seconds for notes saved after version since
+    # Returns (version, new topics, notes as (topic, name, text, date), reset) like ChangeFeed.changes
+    def wait_for_changes(self, since, timeout, limit):
+        self.feed.wait(since, timeout)
+        return self.feed.changes(since, limit)
+
+    # Make wait_for_changes calls return what they have right away, now and from now on
+    # Called when the server shuts down so long polls don't hold it up
+    def stop_waiting(self):
+        self.feed.close()
+
+    # Lock contention numbers for getLockStats
+    def lock_stats(self):
+        return {}
+
+    # Write everything that is pending and release files
+    def close(self):
+        pass
+
+
+# Rough size in bytes a note adds to an XML-RPC response
+def note_size(name, text, date):
+    return len(name or '') + len(text or '') + len(date or '') + 100
+
+
+# Page through a sequence of notes by position, convert turns an item into a (name, text, timestamp) tuple
+def paginate(seq, after, limit, newest_first, max_bytes, convert=None):
+    total = len(seq)
+    if after is not None and not 0 <= after < total: #Negative positions would count from the end
+        raise InvalidCursor(after)
+    if newest_first:
+        positions = range(total - 1 if after is None else after - 1, -1, -1)
+    else:
+        positions = range(0 if after is None else after + 1, total)
+    notes = []
+    size = 0
+    last = None
+    for pos in positions:
+        if len(notes) >= limit:
+            break
+        note = convert(seq[pos]) if convert else tuple(seq[pos])
+        size += note_size(*note)
+        if notes and size > max_bytes: #Always return at least one note so paging moves on
+            break
+        notes.append(note)
+        last = pos
+    more = last is not None and (last > 0 if newest_first else last < total - 1)
+    return notes, last if more else None, total
+
+
+# Notes first to first + len(notes) - 1 of a topic with total notes, for paginate when only the notes a
+# page can reach have been read
+class NoteWindow:
+    def __init__(self, first, notes, total):
+        self.first = first
+        self.notes = notes
+        self.total = total
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, pos):
+        return self.notes[pos - self.first]
+
+
+# (name, text, timestamp) of a <note> element
+def note_tuple(tempnote):
+    return (tempnote.get('name'), tempnote.find('text').text, tempnote.find('timestamp').text)
+
+
+# This Function is used to indent the xml file for better readability
+#Adds line breaks to xml file
+def indent(elem):
+   for subelem in elem:
+       indent(subelem)
+   if len(elem):
+       elem.text = '\n'
+       elem.tail = '\n'
+   else:
+       elem.tail = '\n'
+
+
+# One note in memory, a lot smaller than the three elements ElementTree needs for it
+# The topic name is shared by all notes of a topic, the timestamp is kept as seconds since the
+# epoch. raw keeps the timestamp text when it can't be rebuilt from epoch (not zero padded or
+# not a valid date), so it is written back exactly as it was saved.
+class Note:
+    __slots__ = ('topic', 'name', 'text', 'epoch', 'raw')
+
+    def __init__(self, topic, name, text, date):
+        self.topic = topic
+        self.name = name
+        self.text = text
+        try:
+            self.epoch = parse_epoch(date)
+            self.raw = None if format_date(self.epoch) == date else date
+        except (ValueError, AttributeError, OverflowError, OSError):
+            self.epoch = None
+            self.raw = date
+
+    @property
+    def date(self):
+        return self.raw if self.raw is not None else format_date(self.epoch)
+
+    # Rebuilt from its fields when sent between processes (load_shards), not by parsing the date again
+    def __reduce__(self):
+        return restore_note, (self.topic, self.name, self.text, self.epoch, self.raw)
+
+    # (name, text, timestamp)
+    def values(self):
+        return (self.name, self.text, self.date)
+
+    # (topic, name, text, timestamp)
+    def row(self):
+        return (self.topic, self.name, self.text, self.date)
+
+
+# Note with its fields already worked out, see Note.__reduce__
+def restore_note(topic, name, text, epoch, raw):
+    note = Note.__new__(Note)
+    note.topic = topic
+    note.name = name
+    note.text = text
+    note.epoch = epoch
+    note.raw = raw
+    return note
+
+
+# Read database.xml into Note records without keeping the tree, returns (journal generation, topics)
+# topics lists (name, [Note]) for every <topic> in file order
+def load_notes(path):
+    topics = []
+    gen = 0
+    root = None
+    notes = None
+    depth = 0
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = elem
+                gen = int(elem.get('journal', '0'))
+            elif depth == 2 and elem.tag == 'topic':
+                name = elem.get('name')
+                notes = []
+                topics.append((sys.intern(name) if name is not None else None, notes))
+            continue
+        if depth == 3 and elem.tag == 'note' and notes is not None:
+            text = elem.find('text')
+            timestamp = elem.find('timestamp')
+            notes.append(Note(topics[-1][0], elem.get('name'), text.text if text is not None else None,
+                              timestamp.text if timestamp is not None else None))
+        elif depth == 2:
+            notes = None
+            root.clear() #Done with this topic, don't keep its elements
+        depth -= 1
+    return gen, topics
+
+
+# The whole database in the layout indent() gives it
+def notes_xml(gen, topics):
+    chunks = [b'<data journal="%d"' % gen]
+    if not topics:
+        chunks.append(b' />\n')
+        return b''.join(chunks)
+    chunks.append(b'>\n')
+    for name, notes in topics:
+        if not notes:
+            chunks.append(b'<topic' + xml_attr('name', name) + b' />\n')
+            continue
+        chunks.append(b'<topic' + xml_attr('name', name) + b'>\n')
+        chunks.extend(note_xml(record.name, record.text, record.date) for record in notes)
+        chunks.append(b'</topic>\n')
+    chunks.append(b'</data>\n')
+    return b''.join(chunks)
+
+
+# The whole database.xml held in memory as Note records, XML is only produced when it is written
+# persistence is 'batch' (SnapshotWriter) or 'journal' (JournalWriter)
+class XMLStorage(Storage):
+    def __init__(self, path, persistence='batch', flush_interval=1.0, flush_threshold=100,
+                 compact_interval=60.0, compact_size=16 * 1024 * 1024):
+        self.path = path
+        # Initialize the database or creates if one doesn't exist
+        try:
+            start_gen, self.topics = load_notes(path)
+        except (ET.ParseError, FileNotFoundError):
+            start_gen, self.topics = 0, []
+            with open(path, 'wb') as f:
+                f.write(b'<data />')
+        # Many getnotes/getTopics calls can read the notes at the same time, saveNote waits for them
+        # and has the notes to itself while it adds a note, so nobody sees a half added note
+        self.lock = RWLock()
+        self._build_indexes()
+
+        # Notes saved after the last snapshot are in the journal, apply them on top of it
+        remove_journals(path, start_gen) #Left over from a crash right after a snapshot was written
+        next_gen, self.replayed = replay_journals(path, start_gen, lambda entry: self._add_note(**entry))
+        self.gen = start_gen
+        self.feed = ChangeFeed(sum(len(notes) for name, notes in self.topics)) #Version survives restarts
+
+        if persistence == 'journal':
+            # Each note is appended to a journal, a background thread folds it into database.xml
+            self.writer = JournalWriter(path, self._serialize, self.lock.read(), next_gen,
+                                        sync_interval=flush_interval, compact_interval=compact_interval,
+                                        compact_size=compact_size)
+        else:
+            if self.replayed: #Fold the journal into the snapshot now, batch mode doesn't keep journals
+                atomic_write(path, self._serialize(next_gen))
+                remove_journals(path, next_gen)
+            # Pending changes are written in batches by a background thread instead of on every note
+            self.writer = SnapshotWriter(path, self._serialize, self.lock.read(),
+                                         flush_interval=flush_interval, flush_threshold=flush_threshold)
+        self.writer.start()
+
+    # Indexes over self.topics, built once at startup
+    def _build_indexes(self):
+        # Index of topic name -> list of notes so lookups don't have to scan every topic
+        self.topic_index = {}
+        for name, notes in self.topics:
+            if name not in self.topic_index: #First topic with a name wins, same as the old scan
+                self.topic_index[name] = notes
+
+        # Notes sorted by time, for all topics and for each topic, for getNotesBetween
+        # and the words of every note for searchNotes
+        self.times = TimeIndex()
+        self.topic_times = {}
+        self.search_index = SearchIndex()
+        everything = []
+        for name, notes in self.topic_index.items():
+            pairs = []
+            for record in notes:
+                self.search_index.add(record.name or '', record.text or '', record)
+                if record.epoch is not None: #Notes without a valid timestamp can't be found by time
+                    pairs.append((record.epoch, record))
+            everything.extend(pairs)
+            self.topic_times[name] = TimeIndex()
+            self.topic_times[name].build(pairs)
+        self.times.build(everything)
+
+    # Add a note to its topic and the indexes, caller must hold self.lock for writing
+    # Returns whether the note started a new topic
+    def _add_note(self, topic, note, text, date):
+        notes = self.topic_index.get(topic) #Check if topic already exists
+        new = notes is None
+        if new: #If topic doesn't exist, create a new one
+            topic = sys.intern(topic)
+            notes = self.topic_index[topic] = []
+            self.topics.append((topic, notes))
+            self.topic_times[topic] = TimeIndex()
+        record = Note(topic, note, text, date)
+        notes.append(record)
+        self.search_index.add(note, text, record)
+        self.times.add(record.epoch, record)
+        self.topic_times[topic].add(record.epoch, record)
+        return new
+
+    # Called with self.lock held for reading, writes are locked out while the XML is built
+    def _serialize(self, gen=None):
+        if gen is not None:
+            self.gen = gen #First journal generation not contained in this snapshot
+        return notes_xml(self.gen, self.topics)
+
+    def save_note(self, topic, note, text, date):
+        return self.save_notes([(topic, note, text, date)])
+
+    # All notes are added under one lock and reach the disk in the same flush
+    def save_notes(self, notes):
+        with self.lock.write():
+            self.feed.add([(topic, note, text, date, self._add_note(topic, note, text, date))
+                           for topic, note, text, date in notes])
+            #Background thread saves the notes to disk
+            return self.writer.mark_dirty(*({'topic': topic, 'note': note, 'text': text, 'date': date}
+                                            for topic, note, text, date in notes))
+
+    def wait_durable(self, ticket):
+        return self.writer.wait_durable(ticket)
+
+    def get_notes(self, topic):
+        with self.lock.read():
+            notes = self.topic_index.get(topic)
+            if notes is None:
+                return None
+            return [record.values() for record in notes]
+
+    # Notes are in a list, so a page only touches the notes it returns
+    def get_page(self, topic, after, limit, newest_first=False, max_bytes=1024 * 1024):
+        with self.lock.read():
+            notes = self.topic_index.get(topic)
+            if notes is None:
+                return None
+            return paginate(notes, after, limit, newest_first, max_bytes, Note.values)
+
+    # Binary search in the time index, then only the matching notes are read
+    def get_notes_between(self, topic, start, end, limit):
+        with self.lock.read():
+            index = self.times if topic is None else self.topic_times.get(topic)
+            if index is None:
+                return None
+            return [record.row() for record in index.between(start, end, limit)]
+
+    def search(self, query, limit):
+        with self.lock.read():
+            return [record.row() for record in self.search_index.search(query, limit)]
+
+    def get_topics(self):
+        with self.lock.read():
+            return self._topics()
+
+    # Caller must hold self.lock
+    def _topics(self):
+        return list(self.topic_index) #Index keeps them in the order they were created
+
+    def get_topic_counts(self):
+        with self.lock.read():
+            return [(name, len(notes)) for name, notes in self.topic_index.items()]
+
+    def lock_stats(self):
+        return self.lock.stats()
+
+    def close(self):
+        self.writer.stop() #Write notes that are still pending
+
+
+MANIFEST = 'manifest.json'
+
+
+# File of shard number in a sharded database folder
+def shard_path(directory, number):
+    return os.path.join(directory, f'shard-{number:03d}.xml')
+
+
+# Shard a topic belongs to, crc32 because hash() of a str changes every time Python starts
+def shard_of(topic, count):
+    return zlib.crc32((topic or '').encode('utf-8')) % count
+
+
+# manifest.json: the number of shards and every topic name in the order they were created
+def manifest_json(shards, topics):
+    return json.dumps({'format': 1, 'shards': shards, 'topics': topics}, ensure_ascii=False).encode('utf-8')
+
+
+# (journal generation, topics) of one shard, a shard that was never written is empty
+def load_shard(path):
+    try:
+        return load_notes(path)
+    except FileNotFoundError:
+        return 0, []
+
+
+# CPUs this process may run on, which can be fewer than the machine has (taskset, containers)
+def usable_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError: #Not on every platform
+        return os.cpu_count() or 1
+
+
+# Parse the shard files in up to workers processes at the same time (threads wouldn't help, parsing
+# holds the GIL). Children are forked, so this only works where fork does; otherwise one at a time.
+# Forking copies only the calling thread, so this must run before the process starts other threads
+# (the server opens the store before its workers start). Sending the notes back costs about a third
+# of parsing them, so it only pays off with more than one CPU to run on.
+def load_shards(paths, workers):
+    if workers > 1 and len(paths) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(min(workers, len(paths)), mp_context=multiprocessing.get_context('fork')) as pool:
+            return list(pool.map(load_shard, paths))
+    return [load_shard(path) for path in paths]
+
+
+# One list of (name, notes) from all shards, in the order of names (from the manifest)
+# Topics the manifest doesn't list yet (saved right before a crash) go at the end
+def merge_topics(names, shard_topics):
+    by_name = {}
+    for topics in shard_topics:
+        for entry in topics:
+            by_name.setdefault(entry[0], []).append(entry)
+    merged = []
+    for name in names:
+        merged.extend(by_name.pop(name, ()))
+    for entries in by_name.values():
+        merged.extend(entries)
+    return merged
+
+
+# database.xml split into shard files by topic, so saving a note rewrites (or appends to the journal
+# of) only the shard its topic is in instead of the whole database
+# Each shard file has the same layout as database.xml and gets its own writer, in batch or journal
+# mode like XMLStorage. manifest.json holds the number of shards and the order topics were created
+# in, it is only rewritten when a topic is added. Everything else (indexes, reads) is XMLStorage's.
+# Shards are parsed in parallel at startup, in load_workers processes.
+class ShardedXMLStorage(XMLStorage):
+    def __init__(self, directory, shards=16, persistence='batch', flush_interval=1.0, flush_threshold=100,
+                 compact_interval=60.0, compact_size=16 * 1024 * 1024, load_workers=None):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, MANIFEST)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError: #New database, the number of shards can't change after this
+            manifest = {'shards': shards, 'topics': []}
+            atomic_write(self.manifest_path, manifest_json(shards, []))
+        self.shard_count = manifest['shards']
+        self.paths = [shard_path(directory, number) for number in range(self.shard_count)]
+        loaded = load_shards(self.paths, load_workers if load_workers is not None else usable_cpus())
+        self.shard_gens = [gen for gen, topics in loaded]
+        self.shard_topics = [topics for gen, topics in loaded]
+        self.topics = merge_topics(manifest['topics'], self.shard_topics)
+        self.lock = RWLock()
+        self._build_indexes()
+
+        # Each shard has its own journals, named after the shard file
+        self.writers = []
+        self.replayed = 0
+        for number, path in enumerate(self.paths):
+            remove_journals(path, self.shard_gens[number])
+            next_gen, replayed = replay_journals(path, self.shard_gens[number], lambda entry: self._add_note(**entry))
+            self.replayed += replayed
+            serialize = lambda gen=None, number=number: self._serialize_shard(number, gen)
+            if persistence == 'journal':
+                writer = JournalWriter(path, serialize, self.lock.read(), next_gen, sync_interval=flush_interval,
+                                       compact_interval=compact_interval, compact_size=compact_size)
+            else:
+                if replayed or not os.path.exists(path):
+                    atomic_write(path, serialize(next_gen))
+                    remove_journals(path, next_gen)
+                writer = SnapshotWriter(path, serialize, self.lock.read(),
+                                        flush_interval=flush_interval, flush_threshold=flush_threshold)
+            writer.start()
+            self.writers.append(writer)
+        self.feed = ChangeFeed(sum(len(notes) for name, notes in self.topics))
+        self.manifest_writer = SnapshotWriter(self.manifest_path, self._manifest, self.lock.read(),
+                                              flush_interval=flush_interval, flush_threshold=1)
+        self.manifest_writer.start()
+        if list(self.topic_index) != manifest['topics']: #Topics came from the journals
+            self.manifest_writer.mark_dirty()
+
+    def _add_note(self, topic, note, text, date):
+        new = super()._add_note(topic, note, text, date)
+        if new:
+            self.shard_topics[shard_of(topic, self.shard_count)].append(self.topics[-1])
+        return new
+
+    # Called by a shard's writer with self.lock held for reading
+    def _serialize_shard(self, number, gen=None):
+        if gen is not None:
+            self.shard_gens[number] = gen
+        return notes_xml(self.shard_gens[number], self.shard_topics[number])
+
+    def _manifest(self):
+        return manifest_json(self.shard_count, list(self.topic_index))
+
+    # Only the shards of the notes' topics are written, the ticket lists (shard, ticket) for each
+    def save_notes(self, notes):
+        with self.lock.write():
+            added = [(topic, note, text, date, self._add_note(topic, note, text, date))
+                     for topic, note, text, date in notes]
+            self.feed.add(added)
+            if any(new for topic, note, text, date, new in added):
+                self.manifest_writer.mark_dirty()
+            changes = {}
+            for topic, note, text, date in notes:
+                changes.setdefault(shard_of(topic, self.shard_count), []).append(
+                    {'topic': topic, 'note': note, 'text': text, 'date': date})
+            return [(number, self.writers[number].mark_dirty(*entries)) for number, entries in changes.items()]
+
+    def wait_durable(self, ticket):
+        return all([self.writers[number].wait_durable(shard_ticket) for number, shard_ticket in ticket])
+
+    def close(self):
+        for writer in self.writers:
+            writer.stop()
+        self.manifest_writer.stop()
+
+
+# Split a database.xml (and any journals next to it) into a sharded database in directory
+# Returns the number of notes copied
+def shard_xml(xml_path, directory, shards=16):
+    if os.path.exists(os.path.join(directory, MANIFEST)):
+        raise ValueError(f"{directory} already contains a sharded database")
+    gen, topics = load_notes(xml_path) if os.path.exists(xml_path) else (0, [])
+    index = {}
+    for name, notes in topics:
+        index.setdefault(name, notes)
+    def apply(entry):
+        notes = index.get(entry['topic'])
+        if notes is None:
+            notes = index[entry['topic']] = []
+            topics.append((entry['topic'], notes))
+        notes.append(Note(entry['topic'], entry['note'], entry['text'], entry['date']))
+    replay_journals(xml_path, gen, apply)
+    per_shard = [[] for number in range(shards)]
+    for entry in topics:
+        per_shard[shard_of(entry[0], shards)].append(entry)
+    os.makedirs(directory, exist_ok=True)
+    for number, shard_topics in enumerate(per_shard):
+        atomic_write(shard_path(directory, number), notes_xml(0, shard_topics))
+    atomic_write(os.path.join(directory, MANIFEST), manifest_json(shards, list(index))) #Last, so a half done copy isn't used
+    return sum(len(notes) for name, notes in topics)
+
+
+# database.xml indexed by topic instead of parsed, for files too big to load at startup
+# Startup only scans the file for the byte range of each topic. A topic's notes are read
+# from the file the first time they are asked for and kept in an LRU cache of cache_bytes.
+# New notes always go to the journal and stay in memory until a compaction rewrites the
+# file, copying the bytes of every topic across and adding the new notes at the end of theirs.
+class LazyXMLStorage(Storage):
+    NOTE_OVERHEAD = 200 #Rough size in bytes of the tuple and str objects of a cached note
+
+    def __init__(self, path, flush_interval=1.0, compact_interval=60.0,
+                 compact_size=16 * 1024 * 1024, cache_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.lock = RWLock() #Write side is taken to add notes and to switch to a rewritten file
+        self.file_lock = threading.Lock() #Reads from self.file seek, one at a time
+        self.cache_lock = threading.Lock()
+        self.cache = OrderedDict() #topic -> notes read from the file, least recently used first
+        self.cache_size = 0
+        self.cache_bytes = cache_bytes
+        self.pending = {} #topic -> notes saved since the file was last written
+        self.compacting = None
+        self.new_layout = None
+        self.times = None #Built by the first get_notes_between, refers to notes as (topic, position in topic)
+        self.topic_times = None #topic -> TimeIndex of positions
+        self.search_index = None #Built by the first search, refs are (topic, position in topic)
+        self.index_lock = threading.Lock() #Taken to build an index, others asking for it wait
+        try:
+            start_gen = self._scan()
+        except (expat.ExpatError, FileNotFoundError): #Same as the normal XML storage, start with an empty database
+            with open(path, 'wb') as f:
+                f.write(b'<data />')
+            start_gen = self._scan()
+        self.file = open(path, 'rb')
+
+        remove_journals(path, start_gen)
+        next_gen, self.replayed = replay_journals(path, start_gen, lambda entry: self._add_note(**entry))
+        self.feed = ChangeFeed(sum(span[2] for name, span in self.layout) +
+                               sum(len(notes) for notes in self.pending.values()))
+        self.writer = JournalWriter(path, self._serialize, self.lock.read(), next_gen,
+                                    sync_interval=flush_interval, compact_interval=compact_interval,
+                                    compact_size=compact_size, on_compacted=self._compacted)
+        self.writer.start()
+
+    # Find where every topic starts and ends without building any elements
+    # self.layout lists (name, [start, end, count]) for every <topic> in file order, end is where
+    # </topic> starts (equal to start for a topic with nothing in it, like <topic/>), self.index maps
+    # a name to the first of them
+    def _scan(self):
+        layout = []
+        state = {'depth': 0, 'span': None, 'empty': False, 'gen': 0}
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        def start(tag, attrs):
+            state['depth'] += 1
+            state['empty'] = False
+            if state['depth'] == 1:
+                state['gen'] = int(attrs.get('journal', '0'))
+            elif state['depth'] == 2 and tag == 'topic':
+                state['span'] = [parser.CurrentByteIndex, None, 0]
+                state['empty'] = True
+                layout.append((attrs.get('name'), state['span']))
+            elif state['depth'] == 3 and tag == 'note' and state['span'] is not None:
+                state['span'][2] += 1
+        def data(text):
+            state['empty'] = False
+        def end(tag):
+            if state['depth'] == 2 and tag == 'topic':
+                #For <topic/> expat reports the end after the tag, there is no </topic> to stop at
+                state['span'][1] = state['span'][0] if state['empty'] else parser.CurrentByteIndex
+                state['span'] = None
+                state['empty'] = False
+            state['depth'] -= 1
+        parser.StartElementHandler = start
+        parser.CharacterDataHandler = data
+        parser.EndElementHandler = end
+        with open(self.path, 'rb') as f:
+            parser.ParseFile(f)
+        self._set_layout(layout)
+        return state['gen']
+
+    # (topic, position in topic, name, text, timestamp) of every note in the file, parsed a megabyte
+    # at a time. Only the first topic with a name is read, the one self.index points at. Caller holds
+    # self.lock, so the file isn't switched for a compacted one halfway through.
+    def _file_notes(self):
+        found = []
+        seen = set()
+        state = {'depth': 0, 'topic': None, 'pos': 0, 'note': None, 'field': None}
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        def start(tag, attrs):
+            state['depth'] += 1
+            if state['depth'] == 2 and tag == 'topic':
+                name = attrs.get('name')
+                state['topic'] = name if name not in seen else None
+                state['pos'] = 0
+                seen.add(name)
+            elif state['depth'] == 3 and tag == 'note' and state['topic'] is not None:
+                state['note'] = (attrs.get('name'), [], [])
+            elif state['depth'] == 4 and state['note'] is not None and tag in ('text', 'timestamp'):
+                state['field'] = state['note'][1 if tag == 'text' else 2]
+        def data(text):
+            if state['field'] is not None:
+                state['field'].append(text)
+        def end(tag):
+            if state['depth'] == 3 and state['note'] is not None:
+                name, text, timestamp = state['note']
+                found.append((state['topic'], state['pos'], name, ''.join(text), ''.join(timestamp)))
+                state['note'] = None
+                state['pos'] += 1
+            elif state['depth'] == 4:
+                state['field'] = None
+            state['depth'] -= 1
+        parser.StartElementHandler = start
+        parser.CharacterDataHandler = data
+        parser.EndElementHandler = end
+        offset = 0
+        while True:
+            with self.file_lock:
+                self.file.seek(offset)
+                chunk = self.file.read(1024 * 1024)
+            offset += len(chunk)
+            parser.Parse(chunk, not chunk)
+            yield from found
+            found.clear()
+            if not chunk:
+                return
+
+    # Notes saved since the file was written as (topic, position in topic, name, text, timestamp)
+    # Caller holds self.lock
+    def _pending_notes(self):
+        for topic, notes in self.pending.items():
+            span = self.index.get(topic)
+            first = span[2] if span is not None else 0
+            for i, (name, text, date) in enumerate(notes):
+                yield topic, first + i, name, text, date
+
+    # The time indexes, read from the file the first time they are needed so startup stays a scan
+    # of the topics. Caller holds self.lock, the indexes are kept up to date by _add_note after that.
+    def _time_indexes(self):
+        with self.index_lock:
+            if self.times is None:
+                everything = []
+                per_topic = {}
+                for topic, pos, name, text, date in itertools.chain(self._file_notes(), self._pending_notes()):
+                    pairs = per_topic.setdefault(topic, [])
+                    try:
+                        epoch = parse_epoch(date)
+                    except ValueError: #Not a valid timestamp, can't be found by time
+                        continue
+                    pairs.append((epoch, pos))
+                    everything.append((epoch, (topic, pos)))
+                topic_times = {}
+                for topic, pairs in per_topic.items():
+                    topic_times[topic] = TimeIndex()
+                    topic_times[topic].build(pairs)
+                for topic in self._topics(): #Topics without notes can be asked for too
+                    topic_times.setdefault(topic, TimeIndex())
+                self.topic_times = topic_times
+                self.times = TimeIndex()
+                self.times.build(everything)
+            return self.times, self.topic_times
+
+    # The search index, read from the file the first time it is needed like the time indexes
+    def _search_index(self):
+        with self.index_lock:
+            if self.search_index is None:
+                search = SearchIndex()
+                for topic, pos, name, text, date in itertools.chain(self._file_notes(), self._pending_notes()):
+                    search.add(name or '', text or '', (topic, pos))
+                self.search_index = search
+            return self.search_index
+
+    def _set_layout(self, layout):
+        self.layout = layout
+        self.index = {}
+        for name, span in layout:
+            self.index.setdefault(name, span) #First topic with a name wins, same as the old scan
+
+    # Read and parse one topic from the file, caller holds self.lock for reading
+    def _load(self, span):
+        start, end, count = span
+        if end == start:
+            return []
+        with self.file_lock:
+            self.file.seek(start)
+            data = self.file.read(end - start)
+        temptopic = ET.fromstring(data + b'</topic>')
+        return [note_tuple(tempnote) for tempnote in temptopic.findall('note')]
+
+    def _note_size(self, notes):
+        return sum(len(name or '') + len(text or '') + len(date or '') + self.NOTE_OVERHEAD
+                   for name, text, date in notes)
+
+    # Notes of a topic from the cache, loading them if needed
+    def _cached(self, topic, span):
+        with self.cache_lock:
+            notes = self.cache.get(topic)
+            if notes is not None:
+                self.cache.move_to_end(topic)
+                return notes
+        notes = self._load(span) #Outside cache_lock so different topics load in parallel
+        with self.cache_lock:
+            if topic not in self.cache:
+                self.cache[topic] = notes
+                self.cache_size += self._note_size(notes)
+                while self.cache_size > self.cache_bytes and len(self.cache) > 1: #Evict least recently used
+                    old, old_notes = self.cache.popitem(last=False)
+                    self.cache_size -= self._note_size(old_notes)
+        return notes
+
+    # Caller must hold self.lock for writing, returns whether the note started a new topic
+    def _add_note(self, topic, note, text, date):
+        span = self.index.get(topic)
+        new = span is None and topic not in self.pending
+        pending = self.pending.setdefault(topic, [])
+        pos = (span[2] if span is not None else 0) + len(pending)
+        pending.append((note, text, date))
+        if self.search_index is not None:
+            self.search_index.add(note, text, (topic, pos))
+        if self.times is not None:
+            epoch = parse_epoch(date)
+            self.times.add(epoch, (topic, pos))
+            if topic not in self.topic_times:
+                self.topic_times[topic] = TimeIndex()
+            self.topic_times[topic].add(epoch, pos)
+        return new
+
+    def save_note(self, topic, note, text, date):
+        return self.save_notes([(topic, note, text, date)])
+
+    def save_notes(self, notes):
+        with self.lock.write():
+            self.feed.add([(topic, note, text, date, self._add_note(topic, note, text, date))
+                           for topic, note, text, date in notes])
+            return self.writer.mark_dirty(*({'topic': topic, 'note': note, 'text': text, 'date': date}
+                                            for topic, note, text, date in notes))
+
+    def wait_durable(self, ticket):
+        return self.writer.wait_durable(ticket)
+
+    def get_notes(self, topic):
+        with self.lock.read():
+            return self._notes(topic)
+
+    # Caller must hold self.lock
+    def _notes(self, topic):
+        span = self.index.get(topic)
+        pending = self.pending.get(topic)
+        if span is None and pending is None:
+            return None
+        notes = self._cached(topic, span) if span is not None else []
+        return notes + pending if pending else list(notes)
+
+    # The number of notes is known from the layout, so only the notes the page can reach are read: from
+    # the cache if the topic is in it, otherwise parsed from the topic's part of the file, stopping after
+    # the last one. A topic read this way isn't cached.
+    def get_page(self, topic, after, limit, newest_first=False, max_bytes=1024 * 1024):
+        with self.lock.read():
+            span = self.index.get(topic)
+            pending = self.pending.get(topic, [])
+            if span is None and topic not in self.pending:
+                return None
+            in_file = span[2] if span is not None else 0
+            total = in_file + len(pending)
+            if after is not None and not 0 <= after < total:
+                raise InvalidCursor(after)
+            if newest_first:
+                last = total - 1 if after is None else after - 1
+                first = max(0, last - limit + 1)
+            else:
+                first = 0 if after is None else after + 1
+                last = min(total - 1, first + limit - 1)
+            notes = self._file_range(topic, span, first, min(last, in_file - 1)) if first < in_file else []
+            notes += pending[max(0, first - in_file):max(0, last + 1 - in_file)]
+            return paginate(NoteWindow(first, notes, total), after, limit, newest_first, max_bytes)
+
+    # Notes first to last (positions in the topic, both included) of a topic in the file
+    def _file_range(self, topic, span, first, last):
+        with self.cache_lock:
+            notes = self.cache.get(topic)
+            if notes is not None:
+                self.cache.move_to_end(topic)
+                return notes[first:last + 1]
+        start, end, count = span
+        found = []
+        state = {'depth': 0, 'pos': 0, 'note': None, 'field': None}
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        def begin(tag, attrs):
+            state['depth'] += 1
+            if state['depth'] == 2 and tag == 'note':
+                state['note'] = (attrs.get('name'), [], []) if state['pos'] >= first else None
+            elif state['depth'] == 3 and state['note'] is not None and tag in ('text', 'timestamp'):
+                state['field'] = state['note'][1 if tag == 'text' else 2]
+        def data(text):
+            if state['field'] is not None:
+                state['field'].append(text)
+        def finish(tag):
+            if state['depth'] == 2 and tag == 'note':
+                if state['note'] is not None:
+                    name, text, timestamp = state['note']
+                    found.append((name, ''.join(text) or None, ''.join(timestamp) or None)) #None for <text />, like _load
+                    state['note'] = None
+                state['pos'] += 1
+            elif state['depth'] == 3:
+                state['field'] = None
+            state['depth'] -= 1
+        parser.StartElementHandler = begin
+        parser.CharacterDataHandler = data
+        parser.EndElementHandler = finish
+        offset = start
+        while offset < end and state['pos'] <= last:
+            with self.file_lock:
+                self.file.seek(offset)
+                chunk = self.file.read(min(64 * 1024, end - offset))
+            if not chunk:
+                break
+            offset += len(chunk)
+            parser.Parse(chunk)
+        return found[:last + 1 - first]
+
+    # Only topics that have matching notes are read from the file
+    # The first call reads the whole file to build the time indexes, they stay in memory after that
+    def get_notes_between(self, topic, start, end, limit):
+        with self.lock.read():
+            times, topic_times = self._time_indexes()
+            if topic is None:
+                refs = times.between(start, end, limit)
+            elif topic in topic_times:
+                refs = [(topic, pos) for pos in topic_times[topic].between(start, end, limit)]
+            else:
+                return None
+            return self._resolve(refs)
+
+    # The first call reads the whole file to build the search index, it stays in memory after that
+    def search(self, query, limit):
+        with self.lock.read():
+            return self._resolve(self._search_index().search(query, limit))
+
+    # Notes for a list of (topic, position) refs, each topic is read once, caller must hold self.lock
+    def _resolve(self, refs):
+        loaded = {}
+        result = []
+        for name, pos in refs:
+            if name not in loaded:
+                loaded[name] = self._notes(name)
+            result.append((name,) + tuple(loaded[name][pos]))
+        return result
+
+    def get_topics(self):
+        with self.lock.read():
+            return self._topics()
+
+    # Caller must hold self.lock
+    def _topics(self):
+        return list(self.index) + [topic for topic in self.pending if topic not in self.index]
+
+    # Counted from the layout and the pending notes, no topic is read
+    def get_topic_counts(self):
+        with self.lock.read():
+            return [(topic, (self.index[topic][2] if topic in self.index else 0) + len(self.pending.get(topic, ())))
+                    for topic in self._topics()]
+
+    # Called by the journal writer with self.lock held for reading
+    # Remembers which notes go into the new file and returns the file as a stream of chunks
+    def _serialize(self, gen):
+        self.compacting = {topic: list(notes) for topic, notes in self.pending.items()}
+        return self._rewrite(open(self.path, 'rb'), gen, list(self.layout), self.compacting)
+
+    def _rewrite(self, src, gen, layout, pending):
+        new_layout = []
+        pos = 0
+        with src:
+            head = f'<data journal="{gen}">\n'.encode('utf-8')
+            yield head
+            pos += len(head)
+            added = set()
+            for name, (start, end, count) in layout:
+                notes = pending.get(name) if name not in added else None #New notes go to the first topic with the name
+                added.add(name)
+                new_start = pos
+                if end == start: #<topic/> has nothing to copy
+                    chunk = topic_start_tag(name) + b'\n'
+                    yield chunk
+                    pos += len(chunk)
+                else:
+                    src.seek(start)
+                    left = end - start
+                    while left:
+                        chunk = src.read(min(left, 1024 * 1024))
+                        if not chunk:
+                            raise IOError(f"{self.path} is shorter than expected")
+                        left -= len(chunk)
+                        pos += len(chunk)
+                        yield chunk
+                for note in notes or ():
+                    chunk = note_xml(*note)
+                    yield chunk
+                    pos += len(chunk)
+                new_layout.append((name, [new_start, pos, count + len(notes or ())]))
+                yield b'</topic>\n'
+                pos += len(b'</topic>\n')
+            for name, notes in pending.items(): #Topics that are not in the file yet
+                if name in added:
+                    continue
+                new_start = pos
+                chunk = topic_start_tag(name) + b'\n' + b''.join(note_xml(*note) for note in notes)
+                yield chunk
+                pos += len(chunk)
+                new_layout.append((name, [new_start, pos, len(notes)]))
+                yield b'</topic>\n'
+                pos += len(b'</topic>\n')
+            yield b'</data>\n'
+        self.new_layout = new_layout
+
+    # The rewritten file is in place, switch to it and forget the notes it now contains
+    def _compacted(self, gen):
+        with self.lock.write():
+            self._set_layout(self.new_layout)
+            for topic, notes in self.compacting.items():
+                rest = self.pending[topic][len(notes):]
+                if rest:
+                    self.pending[topic] = rest
+                else:
+                    del self.pending[topic]
+                with self.cache_lock:
+                    cached = self.cache.get(topic)
+                    if cached is not None:
+                        self.cache[topic] = cached + notes
+                        self.cache_size += self._note_size(notes)
+            old, self.file = self.file, open(self.path, 'rb')
+            old.close()
+            self.compacting = self.new_layout = None
+
+    def lock_stats(self):
+        return self.lock.stats()
+
+    def close(self):
+        self.writer.stop()
+        self.file.close()
+
+
+# <topic name="..."> with the name escaped
+def topic_start_tag(name):
+    return b'<topic name=' + quoteattr(name).encode('utf-8') + b'>'
+
+
+ATTR_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#09;'} #Besides & < >, as ElementTree escapes attributes
+
+
+# One <note> element in the same layout indent() gives the rest of the file
+# Escaped the same way ElementTree does, without building elements
+def note_xml(note, text, date):
+    return b''.join((b'<note', xml_attr('name', note), b'>\n', xml_text('text', text),
+                     xml_text('timestamp', date), b'</note>\n'))
+
+
+# ' name="value"', empty if value is None
+def xml_attr(name, value):
+    if value is None:
+        return b''
+    return f' {name}="{escape(value, ATTR_ENTITIES)}"'.encode('utf-8')
+
+
+# <tag>text</tag> on its own line, <tag /> when there is no text
+def xml_text(tag, text):
+    if not text:
+        return f'<{tag} />\n'.encode('utf-8')
+    return f'<{tag}>{escape(text)}</{tag}>\n'.encode('utf-8')
+
+
+# epoch is NULL for a note whose timestamp isn't a DD/MM/YYYY HH:MM:SS date (only migrated notes can have
+# one), getNotesBetween doesn't find those
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS topics (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    topic_id INTEGER NOT NULL REFERENCES topics(id),
+    name TEXT NOT NULL,
+    text TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    epoch INTEGER
+);
+CREATE INDEX IF NOT EXISTS notes_topic ON notes(topic_id, id);
+CREATE INDEX IF NOT EXISTS notes_epoch ON notes(epoch);
+CREATE INDEX IF NOT EXISTS notes_topic_epoch ON notes(topic_id, epoch);
+CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(name, text, content='notes', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+    INSERT INTO notes_fts (rowid, name, text) VALUES (new.id, new.name, new.text);
+END;
+"""
+
+# Statements are kept as constants so sqlite3's statement cache prepares each one only once per connection
+SELECT_TOPIC_ID = "SELECT id FROM topics WHERE name = ?"
+INSERT_TOPIC = "INSERT INTO topics (name) VALUES (?)"
+EPOCH_NOT_NULL = "SELECT \"notnull\" FROM pragma_table_info('notes') WHERE name = 'epoch'"
+INSERT_NOTE = "INSERT INTO notes (topic_id, name, text, timestamp, epoch) VALUES (?, ?, ?, ?, ?)"
+SELECT_NOTES = "SELECT name, text, timestamp FROM notes WHERE topic_id = ? ORDER BY id"
+SELECT_TOPICS = "SELECT name FROM topics ORDER BY id"
+COUNT_TOPIC_NOTES = ("SELECT topics.name, COUNT(notes.id) FROM topics LEFT JOIN notes ON notes.topic_id = topics.id "
+                     "GROUP BY topics.id ORDER BY topics.id")
+COUNT_NOTES = "SELECT COUNT(*) FROM notes WHERE topic_id = ?"
+SELECT_BETWEEN = ("SELECT topics.name, notes.name, notes.text, notes.timestamp FROM notes "
+                  "JOIN topics ON topics.id = notes.topic_id "
+                  "WHERE notes.epoch BETWEEN ? AND ? ORDER BY notes.epoch, notes.id LIMIT ?")
+SELECT_TOPIC_BETWEEN = ("SELECT ?, name, text, timestamp FROM notes "
+                        "WHERE topic_id = ? AND epoch BETWEEN ? AND ? ORDER BY epoch, id LIMIT ?")
+SEARCH_NOTES = ("SELECT topics.name, notes.name, notes.text, notes.timestamp FROM notes_fts "
+                "JOIN notes ON notes.id = notes_fts.rowid JOIN topics ON topics.id = notes.topic_id "
+                "WHERE notes_fts MATCH ? ORDER BY bm25(notes_fts, 2.0, 1.0), notes.id DESC LIMIT ?")
+SELECT_PAGE_ASC = "SELECT id, name, text, timestamp FROM notes WHERE topic_id = ? AND id > ? ORDER BY id LIMIT ?"
+SELECT_PAGE_DESC = "SELECT id, name, text, timestamp FROM notes WHERE topic_id = ? AND id < ? ORDER BY id DESC LIMIT ?"
+NOTE_IN_TOPIC = "SELECT 1 FROM notes WHERE id = ? AND topic_id = ?"
+SELECT_VERSION = "SELECT COALESCE(MAX(id), 0) FROM notes"
+SELECT_TOPICS_VERSION = "SELECT MIN(id) FROM notes WHERE topic_id = (SELECT MAX(id) FROM topics)"
+SELECT_FIRST_NOTE = "SELECT MIN(id) FROM notes WHERE topic_id = ?"
+SELECT_CHANGES = ("SELECT notes.id, notes.topic_id, topics.name, notes.name, notes.text, notes.timestamp FROM notes "
+                  "JOIN topics ON topics.id = notes.topic_id WHERE notes.id > ? ORDER BY notes.id LIMIT ?")
+CHANGE_POLL = 0.5 #Seconds between checks for notes saved by other server processes while waiting for changes
+
+
+# Seconds since the epoch for a DD/MM/YYYY HH:MM:SS timestamp, read as UTC
+def parse_epoch(date):
+    day, clock = date.split()
+    d, m, y = day.split('/')
+    hh, mm, ss = clock.split(':')
+    return calendar.timegm((int(y), int(m), int(d), int(hh), int(mm), int(ss), 0, 0, 0))
+
+
+# DD/MM/YYYY HH:MM:SS for seconds since the epoch, the other way round from parse_epoch
+def format_date(epoch):
+    return time.strftime("%d/%m/%Y %H:%M:%S", time.gmtime(epoch))
+
+
+# Notes in an SQLite database with indexes on topic and timestamp
+# Connections are pooled and handed to one request at a time, WAL mode lets readers
+# run while a note is written
+# The version of the store is the id of the newest note, so it is the same in every server process
+class SQLiteStorage(Storage):
+    def __init__(self, path):
+        self.path = path
+        self.idle = queue.SimpleQueue() #Connections not used by any request right now
+        self.lock = RWLock() #Only the write side is used, SQLite handles readers itself
+        self.changed = threading.Condition() #Wakes up wait_for_changes when this process saves notes
+        self.saves = 0
+        self.stopped = False
+        with self._conn() as conn:
+            had_search = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'notes_fts'").fetchone()
+            conn.executescript(SCHEMA)
+            if not had_search: #Database from before searchNotes, index the notes it already has
+                conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+            conn.commit()
+
+    # with self._conn() as conn: borrow a connection from the pool
+    @contextlib.contextmanager
+    def _conn(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = connect_sqlite(self.path)
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def save_note(self, topic, note, text, date):
+        return self.save_notes([(topic, note, text, date)])
+
+    def save_notes(self, notes):
+        with self._conn() as conn, self.lock.write():
+            with metrics.timer('sqlite_write'), conn: #One transaction, committed (and fsynced) when the block ends
+                conn.execute("BEGIN IMMEDIATE") #Take the write lock before looking up topics, other server processes may add them too
+                for topic, note, text, date in notes:
+                    insert_note(conn, topic, note, text, date)
+        with self.changed:
+            self.saves += 1
+            self.changed.notify_all()
+        return 0
+
+    def get_notes(self, topic):
+        with self._conn() as conn:
+            row = conn.execute(SELECT_TOPIC_ID, (topic,)).fetchone()
+            if row is None:
+                return None
+            return conn.execute(SELECT_NOTES, (row[0],)).fetchall()
+
+    # Pages are keyed on the note id so a page is one index range scan, however deep it is
+    def get_page(self, topic, after, limit, newest_first=False, max_bytes=1024 * 1024):
+        with self._conn() as conn:
+            row = conn.execute(SELECT_TOPIC_ID, (topic,)).fetchone()
+            if row is None:
+                return None
+            total = conn.execute(COUNT_NOTES, (row[0],)).fetchone()[0]
+            if after is not None and not (0 < after < 2 ** 63 and conn.execute(NOTE_IN_TOPIC, (after, row[0])).fetchone()):
+                raise InvalidCursor(after) #Cursors hold the id of a note of this topic
+            if newest_first:
+                rows = conn.execute(SELECT_PAGE_DESC, (row[0], (2 ** 63 - 1) if after is None else after, limit + 1))
+            else:
+                rows = conn.execute(SELECT_PAGE_ASC, (row[0], -1 if after is None else after, limit + 1))
+            notes = []
+            size = 0
+            last = None
+            more = False
+            for note_id, name, text, date in rows:
+                size += note_size(name, text, date)
+                if len(notes) >= limit or (notes and size > max_bytes):
+                    more = True
+                    break
+                notes.append((name, text, date))
+                last = note_id
+            rows.close()
+            return notes, last if more else None, total
+
+    # Range scans on the epoch indexes
+    def get_notes_between(self, topic, start, end, limit):
+        limit = -1 if limit is None else limit #No limit in SQLite
+        with self._conn() as conn:
+            if topic is None:
+                return conn.execute(SELECT_BETWEEN, (start, end, limit)).fetchall()
+            row = conn.execute(SELECT_TOPIC_ID, (topic,)).fetchone()
+            if row is None:
+                return None
+            return conn.execute(SELECT_TOPIC_BETWEEN, (topic, row[0], start, end, limit)).fetchall()
+
+    # Full-text search with SQLite's FTS5, every word is quoted so the query can't use FTS5 syntax
+    def search(self, query, limit):
+        words = tokenize(query)
+        if not words:
+            return []
+        with self._conn() as conn:
+            return conn.execute(SEARCH_NOTES, (' '.join(f'"{word}"' for word in words), limit)).fetchall()
+
+    def get_topics(self):
+        with self._conn() as conn:
+            return [row[0] for row in conn.execute(SELECT_TOPICS)]
+
+    def get_topic_counts(self):
+        with self._conn() as conn:
+            return conn.execute(COUNT_TOPIC_NOTES).fetchall()
+
+    def version(self):
+        with self._conn() as conn:
+            return conn.execute(SELECT_VERSION).fetchone()[0]
+
+    # A topic is created together with its first note, so the first note of the newest topic
+    # is the last version at which the topics changed
+    def get_topics_since(self, since):
+        with self._conn() as conn:
+            version = conn.execute(SELECT_VERSION).fetchone()[0]
+            topics_version = conn.execute(SELECT_TOPICS_VERSION).fetchone()[0] or 0
+            if topics_version <= since <= version:
+                return None
+            return version, [row[0] for row in conn.execute(SELECT_TOPICS)]
+
+    # Woken up right away by notes saved in this process, notes from other processes are
+    # noticed within CHANGE_POLL seconds
+    def wait_for_changes(self, since, timeout, limit):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.changed:
+                seen = self.saves
+            remaining = deadline - time.monotonic()
+            if self.version() != since or remaining <= 0 or self.stopped:
+                break
+            with self.changed:
+                self.changed.wait_for(lambda: self.saves != seen or self.stopped, min(remaining, CHANGE_POLL))
+        with self._conn() as conn:
+            version = conn.execute(SELECT_VERSION).fetchone()[0]
+            if since >= version:
+                return version, [], [], since > version #Newer than the database, it must have been replaced
+            rows = conn.execute(SELECT_CHANGES, (since, limit)).fetchall()
+            topics = [row[2] for row in rows if conn.execute(SELECT_FIRST_NOTE, (row[1],)).fetchone()[0] == row[0]]
+            return rows[-1][0], topics, [row[2:] for row in rows], False
+
+    def stop_waiting(self):
+        with self.changed:
+            self.stopped = True
+            self.changed.notify_all()
+
+    def lock_stats(self):
+        return self.lock.stats()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def connect_sqlite(path):
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL") #A committed note survives a power cut
+    return conn
+
+
+# Insert one note, caller handles the transaction
+# Returns False if date isn't a valid timestamp, the note is still inserted with no epoch
+def insert_note(conn, topic, note, text, date):
+    row = conn.execute(SELECT_TOPIC_ID, (topic,)).fetchone()
+    topic_id = row[0] if row is not None else conn.execute(INSERT_TOPIC, (topic,)).lastrowid
+    try:
+        epoch = parse_epoch(date)
+    except ValueError:
+        epoch = None
+    conn.execute(INSERT_NOTE, (topic_id, note, text, date, epoch))
+    return epoch is not None
+
+
+# Copy a database.xml (and any journals next to it) into an SQLite database
+# The file is streamed with iterparse and finished topics are dropped, so memory stays small
+# Returns (notes copied, notes without a valid timestamp among them)
+def migrate_xml_to_sqlite(xml_path, db_path, batch_size=10000, progress=None):
+    conn = connect_sqlite(db_path)
+    conn.execute("PRAGMA synchronous=OFF") #Nothing to lose if the migration dies, it can be run again
+    conn.executescript(SCHEMA)
+    if conn.execute("SELECT 1 FROM notes LIMIT 1").fetchone():
+        conn.close()
+        raise ValueError(f"{db_path} already contains notes")
+    if conn.execute(EPOCH_NOT_NULL).fetchone()[0]: #Empty table from before epoch could be NULL, make it again
+        conn.executescript("DROP TABLE notes;" + SCHEMA)
+    count = 0
+    undated = 0
+    start_gen = 0
+    conn.execute("BEGIN")
+    try:
+        if os.path.exists(xml_path):
+            topic = None
+            root = None
+            for event, elem in ET.iterparse(xml_path, events=('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                        start_gen = int(elem.get('journal', '0'))
+                    elif elem.tag == 'topic':
+                        topic = elem.get('name')
+                    continue
+                if elem.tag == 'note' and topic is not None:
+                    if not insert_note(conn, topic, elem.get('name'), elem.findtext('text', ''), elem.findtext('timestamp', '')):
+                        undated += 1
+                    count += 1
+                    if count % batch_size == 0:
+                        conn.execute("COMMIT")
+                        conn.execute("BEGIN")
+                        if progress:
+                            progress(count)
+                elif elem.tag == 'topic':
+                    topic = None
+                    root.remove(elem) #Done with this topic, let it be freed
+        def apply(entry):
+            nonlocal undated
+            if not insert_note(conn, entry['topic'], entry['note'], entry['text'], entry['date']):
+                undated += 1
+        count += replay_journals(xml_path, start_gen, apply)[1]
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        conn.close()
+        raise
+    conn.close()
+    return count, undated
@@ -0,0 +1,39 @@
+import json
+import os
+from bulk import import_notes, export_notes
+from storage import MANIFEST
+
+
+def write_jsonl(path, rows):
+    with open(path, 'w', encoding='utf-8') as f:
+        for topic, note in rows:
+            f.write(json.dumps({'topic': topic, 'note': note, 'text': 'x', 'date': '01/02/2023 10:00:00'}) + '\n')
+
+
+# Topics of a sharded database are read shard by shard, importing more notes must keep the manifest's order
+def test_sharded_import_keeps_topic_order(tmp_path):
+    directory = str(tmp_path / 'database.shards')
+    first = ['zeta', 'alpha', 'mid', 'beta', 'omega', 'gamma']
+    write_jsonl(tmp_path / 'a.jsonl', [(topic, 'n1') for topic in first])
+    write_jsonl(tmp_path / 'b.jsonl', [('new', 'n1'), ('alpha', 'n2')])
+    assert import_notes('xml-sharded', directory, str(tmp_path / 'a.jsonl'), 'jsonl', shards=4) == (6, 0)
+    assert import_notes('xml-sharded', directory, str(tmp_path / 'b.jsonl'), 'jsonl') == (2, 0)
+    with open(os.path.join(directory, MANIFEST), encoding='utf-8') as f:
+        assert json.load(f)['topics'] == first + ['new']
+
+    export_notes('xml-sharded', directory, str(tmp_path / 'out.jsonl'), 'jsonl')
+    with open(tmp_path / 'out.jsonl', encoding='utf-8') as f:
+        notes = [(row['topic'], row['note']) for row in map(json.loads, f)]
+    assert sorted(notes) == sorted([(topic, 'n1') for topic in first] + [('new', 'n1'), ('alpha', 'n2')])
+
+
+def test_import_skips_bad_rows(tmp_path):
+    path = str(tmp_path / 'database.xml')
+    with open(tmp_path / 'a.jsonl', 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'topic': 'T', 'note': 'ok', 'text': 'x', 'date': '31/12/2023 23:59:59'}) + '\n')
+        f.write(json.dumps({'topic': 'T', 'note': 'us date', 'text': 'x', 'date': '12/31/2023 23:59:59'}) + '\n')
+        f.write(json.dumps({'topic': '', 'note': 'no topic', 'text': 'x', 'date': '01/01/2023 00:00:00'}) + '\n')
+    rejected = []
+    assert import_notes('xml', path, str(tmp_path / 'a.jsonl'), 'jsonl',
+                        reject=lambda line, message: rejected.append(line)) == (1, 2)
+    assert rejected == [2, 3]
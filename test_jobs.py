@@ -0,0 +1,76 @@
+import threading
+import time
+from jobs import JobQueue
+from metrics import Metrics
+
+
+def wait_finished(jobs, job_id):
+    for i in range(200):
+        job = jobs.status(job_id)
+        if job['state'] in ('done', 'failed'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} didn't finish")
+
+
+def test_finished_jobs_expire_oldest_first():
+    jobs = JobQueue(workers=2, keep_seconds=0.3)
+    first = jobs.submit('first', lambda: 'one')
+    wait_finished(jobs, first)
+    time.sleep(0.2)
+    second = jobs.submit('second', lambda: 'two')
+    wait_finished(jobs, second)
+    time.sleep(0.15) #Only the first job is older than keep_seconds
+    third = jobs.submit('third', lambda: 'three')
+    assert jobs.status(first) is None
+    assert jobs.status(second)['result'] == 'two'
+    wait_finished(jobs, third)
+    assert [job_id for finished, job_id in jobs.finished] == [second, third]
+    jobs.shutdown()
+
+
+def test_stats_count_queued_and_running_jobs():
+    jobs = JobQueue(workers=1)
+    release = threading.Event()
+    blocked = jobs.submit('blocked', lambda: release.wait(5) and 'done')
+    waiting = jobs.submit('waiting', lambda: 'done')
+    for i in range(200):
+        if jobs.stats()['running']:
+            break
+        time.sleep(0.01)
+    assert jobs.stats() == {'queued': 1, 'running': 1, 'kept': 2}
+    metrics = Metrics()
+    metrics.add_source('jobs', jobs.stats)
+    assert metrics.snapshot()['jobs'] == {'queued': 1, 'running': 1, 'kept': 2}
+    assert 'notes_jobs_running 1\n' in metrics.prometheus()
+    release.set()
+    wait_finished(jobs, blocked)
+    wait_finished(jobs, waiting)
+    assert jobs.stats() == {'queued': 0, 'running': 0, 'kept': 2}
+    jobs.shutdown()
+
+
+def test_shutdown_waits_for_running_jobs_and_cancels_queued_ones(tmp_path):
+    jobs = JobQueue(workers=1, shared_path=str(tmp_path / 'jobs.db'))
+    saved = []
+    running = jobs.submit('running', lambda: time.sleep(0.3) or saved.append('running') or 'done')
+    queued = jobs.submit('queued', lambda: saved.append('queued') or 'done')
+    time.sleep(0.1)
+    started = time.monotonic()
+    jobs.shutdown(timeout=5)
+    assert time.monotonic() - started < 2 #Done once the running job is, not at the timeout
+    assert saved == ['running']
+    assert jobs.status(running)['state'] == 'done'
+    assert jobs.status(queued)['result'] == "Error: server stopped"
+
+
+def test_shutdown_gives_up_on_jobs_after_the_timeout():
+    jobs = JobQueue(workers=1)
+    release = threading.Event()
+    stuck = jobs.submit('stuck', lambda: release.wait(5) and 'done')
+    time.sleep(0.1)
+    started = time.monotonic()
+    jobs.shutdown(timeout=0.2)
+    assert time.monotonic() - started < 1
+    assert jobs.status(stuck)['result'] == "Error: server stopped before the job finished"
+    release.set()
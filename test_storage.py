@@ -0,0 +1,210 @@
+import pytest
+import math
+import random
+import sqlite3
+from collections import Counter
+from searchindex import SearchIndex, tokenize, NAME_WEIGHT
+from storage import (LazyXMLStorage, XMLStorage, SQLiteStorage, InvalidCursor, Note, notes_xml, parse_epoch,
+                     migrate_xml_to_sqlite, paginate)
+
+
+def write_database(path, topics):
+    with open(path, 'wb') as f:
+        f.write(notes_xml(0, [(name, [Note(name, *note) for note in notes]) for name, notes in topics]))
+
+
+# notes_xml writes a topic without notes as <topic name="E" />, the lazy engine must read, fill and
+# compact it without breaking the file
+def test_lazy_empty_topic_survives_save_and_compaction(tmp_path):
+    path = str(tmp_path / 'database.xml')
+    write_database(path, [('E', []), ('F', [('f1', 'text', '01/01/2023 10:00:00')])])
+    store = LazyXMLStorage(path)
+    assert store.get_notes('E') == []
+    assert store.get_notes('F') == [('f1', 'text', '01/01/2023 10:00:00')]
+    store.wait_durable(store.save_note('E', 'e1', 'first', '02/01/2023 10:00:00'))
+    store.close() #Folds the journal into database.xml
+
+    store = LazyXMLStorage(path)
+    assert store.get_topics() == ['E', 'F']
+    assert store.get_notes('E') == [('e1', 'first', '02/01/2023 10:00:00')]
+    assert store.get_notes('F') == [('f1', 'text', '01/01/2023 10:00:00')]
+    store.close()
+
+    store = XMLStorage(path)
+    assert store.get_notes('E') == [('e1', 'first', '02/01/2023 10:00:00')]
+    assert store.get_notes('F') == [('f1', 'text', '01/01/2023 10:00:00')]
+    store.close()
+
+
+def test_lazy_empty_topic_with_end_tag(tmp_path):
+    path = str(tmp_path / 'database.xml')
+    with open(path, 'wb') as f:
+        f.write(b'<data journal="0">\n<topic name="E"></topic>\n<topic name="G" />\n</data>\n')
+    store = LazyXMLStorage(path)
+    assert store.get_notes('E') == []
+    assert store.get_notes('G') == []
+    store.save_note('G', 'g1', 'text', '03/01/2023 10:00:00')
+    store.close()
+
+    store = LazyXMLStorage(path)
+    assert store.get_notes('E') == []
+    assert store.get_notes('G') == [('g1', 'text', '03/01/2023 10:00:00')]
+    store.close()
+
+
+# Startup only scans the topics, the time indexes come from the file (and the journal) on first use
+def test_lazy_time_index_is_built_on_first_use(tmp_path):
+    path = str(tmp_path / 'database.xml')
+    write_database(path, [('A', [('a1', 'text', '01/01/2023 10:00:00'), ('a2', 'text', 'not a date')]),
+                          ('B', [('b1', 'text', '03/01/2023 10:00:00')]), ('E', [])])
+    store = LazyXMLStorage(path)
+    store.save_note('A', 'a3', 'text', '02/01/2023 10:00:00')
+    assert store.times is None
+    assert store.get_topic_counts() == [('A', 3), ('B', 1), ('E', 0)] #From the layout, nothing read
+    assert store.cache_size == 0
+    start, end = parse_epoch('01/01/2023 00:00:00'), parse_epoch('31/01/2023 00:00:00')
+    assert [note[1] for note in store.get_notes_between(None, start, end, 10)] == ['a1', 'a3', 'b1']
+    store.save_note('B', 'b2', 'text', '01/01/2023 12:00:00')
+    assert store.get_notes_between('B', start, end, 10) == [('B', 'b2', 'text', '01/01/2023 12:00:00'),
+                                                            ('B', 'b1', 'text', '03/01/2023 10:00:00')]
+    assert store.get_notes_between('E', start, end, 10) == []
+    assert store.get_notes_between('Nope', start, end, 10) is None
+    store.close()
+
+
+# Like the time index, the search index is only built by the first search
+def test_lazy_search_index_is_built_on_first_use(tmp_path):
+    path = str(tmp_path / 'database.xml')
+    write_database(path, [('A', [('python', 'a note about servers', '01/01/2023 10:00:00')]),
+                          ('B', [('b1', 'python python', '02/01/2023 10:00:00')])])
+    store = LazyXMLStorage(path)
+    store.save_note('B', 'b2', 'python server', '03/01/2023 10:00:00')
+    assert store.search_index is None
+    assert [note[1] for note in store.search('python', 10)] == ['b1', 'python', 'b2'] #Same score, newer first
+    store.save_note('A', 'a2', 'Python', '04/01/2023 10:00:00')
+    assert [note[1] for note in store.search('python server', 10)] == ['b2']
+    assert len(store.search('python', 10)) == 4
+    store.close()
+
+
+# The pruned search must rank exactly like scoring every note containing all the words
+def test_search_index_matches_scoring_every_note():
+    rng = random.Random(7)
+    words = [f"w{i}" for i in range(200)]
+    weights = [1 / (i + 1) for i in range(200)]
+    index = SearchIndex()
+    notes = [] #Counter of every note, name words counted NAME_WEIGHT times
+    for number in range(5000):
+        name = ' '.join(rng.choices(words, weights, k=rng.randint(0, 3)))
+        text = ' '.join(rng.choices(words, weights, k=rng.randint(0, 15)))
+        index.add(name, text, number)
+        counts = Counter(tokenize(text))
+        for word in tokenize(name):
+            counts[word] += NAME_WEIGHT
+        notes.append(counts)
+    for i in range(300):
+        query = set(rng.choices(words, weights, k=rng.randint(1, 4)))
+        limit = rng.choice([1, 5, 20])
+        sizes = {word: sum(1 for counts in notes if counts[word]) for word in query}
+        ranked = []
+        for number, counts in enumerate(notes):
+            if all(counts[word] for word in query):
+                score = 0.0
+                for word in sorted(query, key=lambda word: sizes[word]):
+                    score += counts[word] * math.log(1 + len(notes) / sizes[word])
+                ranked.append((score, number))
+        ranked.sort(reverse=True)
+        assert index.search(' '.join(query), limit) == [number for score, number in ranked[:limit]]
+
+
+# A note with an empty or broken timestamp is copied without an epoch instead of stopping the migration,
+# also into a notes.db the server created (empty) before epoch could be NULL
+def test_migration_keeps_notes_without_valid_timestamp(tmp_path):
+    path = str(tmp_path / 'database.xml')
+    with open(path, 'wb') as f:
+        f.write(b'<data journal="0">\n<topic name="A">\n'
+                b'<note name="a1"><text>one</text><timestamp>01/01/2023 10:00:00</timestamp></note>\n'
+                b'<note name="a2"><text>two</text><timestamp /></note>\n'
+                b'<note name="a3"><text>three</text><timestamp>yesterday</timestamp></note>\n'
+                b'</topic>\n</data>\n')
+    db_path = str(tmp_path / 'notes.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, topic_id INTEGER NOT NULL, name TEXT NOT NULL, "
+                 "text TEXT NOT NULL, timestamp TEXT NOT NULL, epoch INTEGER NOT NULL)")
+    conn.close()
+    assert migrate_xml_to_sqlite(path, db_path) == (3, 2)
+    store = SQLiteStorage(db_path)
+    assert store.get_notes('A') == [('a1', 'one', '01/01/2023 10:00:00'), ('a2', 'two', ''),
+                                    ('a3', 'three', 'yesterday')]
+    start, end = parse_epoch('01/01/2023 00:00:00'), parse_epoch('31/01/2023 00:00:00')
+    assert store.get_notes_between('A', start, end, 10) == [('A', 'a1', 'one', '01/01/2023 10:00:00')]
+    assert [note[1] for note in store.search('three', 10)] == ['a3']
+    store.close()
+
+
+# Pages of a topic in the file are parsed from its part of the file, they must match paging
+# through all its notes, with and without the topic in the cache and with notes saved since
+def test_lazy_pages_read_only_what_they_need(tmp_path):
+    path = str(tmp_path / 'database.xml')
+    write_database(path, [('A', [(f'a{i}', f'text {i}' * (i % 3), f'0{i % 9 + 1}/01/2023 10:00:00') for i in range(40)]),
+                          ('B', [('b1', 'text', '01/01/2023 10:00:00')])])
+    store = LazyXMLStorage(path)
+    for i in range(5):
+        store.save_note('A', f'new{i}', 'text', '10/01/2023 10:00:00')
+    expected = store.get_notes('A')
+    store.cache.clear()
+    store.cache_size = 0
+    for cached in (False, True):
+        for newest_first in (False, True):
+            for limit, max_bytes in ((7, 1024 * 1024), (100, 1024 * 1024), (7, 300)):
+                for after in [None] + list(range(45)):
+                    assert (store.get_page('A', after, limit, newest_first, max_bytes) ==
+                            paginate(expected, after, limit, newest_first, max_bytes))
+        assert ('A' in store.cache) == cached
+        store.get_notes('A')
+    with pytest.raises(InvalidCursor):
+        store.get_page('A', 45, 10)
+    assert store.get_page('Nope', None, 10) is None
+    store.close()
+
+
+@pytest.fixture(params=['xml', 'xml-lazy', 'sqlite'])
+def three_notes(request, tmp_path):
+    if request.param == 'sqlite':
+        store = SQLiteStorage(str(tmp_path / 'notes.db'))
+    else:
+        path = str(tmp_path / 'database.xml')
+        write_database(path, [])
+        store = XMLStorage(path) if request.param == 'xml' else LazyXMLStorage(path)
+    for i in range(3):
+        store.wait_durable(store.save_note('T', f'n{i}', 'text', f'0{i + 1}/01/2023 10:00:00'))
+    store.save_note('Other', 'o', 'text', '01/01/2023 10:00:00')
+    yield store
+    store.close()
+
+
+def test_topic_counts(three_notes):
+    assert three_notes.get_topic_counts() == [('T', 3), ('Other', 1)]
+
+
+def test_pages_follow_cursors(three_notes):
+    notes, after, total = three_notes.get_page('T', None, 2)
+    assert [note[0] for note in notes] == ['n0', 'n1'] and total == 3
+    notes, after, total = three_notes.get_page('T', after, 2)
+    assert [note[0] for note in notes] == ['n2'] and after is None
+    notes, after, total = three_notes.get_page('T', None, 2, newest_first=True)
+    assert [note[0] for note in notes] == ['n2', 'n1']
+    notes, after, total = three_notes.get_page('T', after, 2, newest_first=True)
+    assert [note[0] for note in notes] == ['n0'] and after is None
+
+
+# Cursors come from clients, one that doesn't point at a note of the topic must not wrap around or crash
+@pytest.mark.parametrize('newest_first', [False, True])
+def test_cursor_out_of_range_is_invalid(three_notes, newest_first):
+    if isinstance(three_notes, SQLiteStorage):
+        out_of_range = (0, 4) #Cursors are note ids there, 4 is the note of topic Other
+    else:
+        out_of_range = (3,) #Cursors are positions in the topic
+    for after in (-1, -3, 10 ** 6, 2 ** 70) + out_of_range:
+        with pytest.raises(InvalidCursor):
+            three_notes.get_page('T', after, 2, newest_first=newest_first)
@@ -0,0 +1,148 @@
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+import requests
+import wikistub
+from metrics import Metrics
+from wiki import WikiLookup, UpstreamUnavailable
+
+PYTHON_URL = "https://en.wikipedia.org/wiki/Python"
+
+
+# Answers with a body shorter than its Content-Length, requests raises ChunkedEncodingError
+class TruncatingHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '100')
+        self.end_headers()
+        self.wfile.write(b'["Python", [')
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Starts HTTP servers on free ports, returns (server, API URL)
+@pytest.fixture
+def serve():
+    servers = []
+    def start(server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, f"http://localhost:{server.server_address[1]}/w/api.php"
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def stub_requests():
+    with wikistub.counter_lock:
+        return wikistub.counters['requests']
+
+
+def test_breaker_opens_then_half_opens_and_closes(serve):
+    stub, url = serve(wikistub.make_server(0, fail_rate=1.0))
+    wiki = WikiLookup(url, retries=0, breaker_failures=2, breaker_reset=0.2)
+    for i in range(2):
+        with pytest.raises(requests.HTTPError):
+            wiki.lookup('Python')
+    assert wiki.breaker.state() == 'open'
+    before = stub_requests()
+    with pytest.raises(UpstreamUnavailable):
+        wiki.lookup('Python')
+    assert stub_requests() == before #Rejected without asking Wikipedia
+
+    stub.RequestHandlerClass.fail_rate = 0.0
+    time.sleep(0.25)
+    assert wiki.breaker.state() == 'half-open'
+    assert wiki.lookup('Python') == PYTHON_URL
+    assert wiki.breaker.state() == 'closed'
+    assert wiki.stats()['breaker_rejected'] == 1
+
+
+def test_failed_trial_opens_the_breaker_again(serve):
+    stub, url = serve(wikistub.make_server(0, fail_rate=1.0))
+    wiki = WikiLookup(url, retries=0, breaker_failures=1, breaker_reset=0.2)
+    with pytest.raises(requests.HTTPError):
+        wiki.lookup('Python')
+    time.sleep(0.25)
+    with pytest.raises(requests.HTTPError): #The trial call
+        wiki.lookup('Python')
+    assert wiki.breaker.state() == 'open'
+    with pytest.raises(UpstreamUnavailable):
+        wiki.lookup('Python')
+
+
+def test_trial_with_truncated_body_does_not_stick_half_open(serve):
+    stub, url = serve(wikistub.make_server(0, fail_rate=1.0))
+    broken, broken_url = serve(ThreadingHTTPServer(('localhost', 0), TruncatingHandler))
+    wiki = WikiLookup(broken_url, retries=0, breaker_failures=1, breaker_reset=0.2)
+    with pytest.raises(requests.RequestException):
+        wiki.lookup('Python')
+    assert wiki.breaker.state() == 'open'
+    time.sleep(0.25)
+    with pytest.raises(requests.RequestException): #The trial call gets a cut off body too
+        wiki.lookup('Python')
+    assert wiki.breaker.state() == 'open'
+
+    stub.RequestHandlerClass.fail_rate = 0.0
+    wiki.api_url = url
+    time.sleep(0.25)
+    assert wiki.lookup('Python') == PYTHON_URL
+    assert wiki.breaker.state() == 'closed'
+
+
+def test_concurrent_misses_are_coalesced(serve):
+    stub, url = serve(wikistub.make_server(0, delay=0.3))
+    wiki = WikiLookup(url)
+    before = stub_requests()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(wiki.lookup('python '))) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [PYTHON_URL] * 10
+    assert stub_requests() - before == 1
+    stats = wiki.stats()
+    assert stats['misses'] == 1 and stats['coalesced'] == 9
+
+
+def test_cache_entries_expire(serve):
+    stub, url = serve(wikistub.make_server(0))
+    wiki = WikiLookup(url, ttl=0.6, negative_ttl=0.2)
+    before = stub_requests()
+    assert wiki.lookup('Python') == PYTHON_URL
+    assert wiki.lookup('PYTHON') == PYTHON_URL #Same entry, normalized
+    assert wiki.lookup('No such page') is None
+    assert wiki.lookup('No such page') is None
+    assert stub_requests() - before == 2
+    assert wiki.stats()['hits'] == 2
+
+    time.sleep(0.3) #Only the "no page" answer has expired
+    assert wiki.lookup('Python') == PYTHON_URL
+    assert wiki.lookup('No such page') is None
+    assert stub_requests() - before == 3
+    time.sleep(0.35)
+    assert wiki.lookup('Python') == PYTHON_URL
+    assert stub_requests() - before == 4
+
+
+def test_stats_reach_system_stats_and_metrics(serve):
+    stub, url = serve(wikistub.make_server(0, fail_rate=1.0))
+    wiki = WikiLookup(url, retries=0, breaker_failures=1, breaker_reset=60)
+    metrics = Metrics()
+    metrics.add_source('wiki', wiki.stats, counters=('hits', 'misses', 'upstream_errors', 'breaker_rejected'))
+    with pytest.raises(requests.HTTPError):
+        wiki.lookup('Python')
+    with pytest.raises(UpstreamUnavailable):
+        wiki.lookup('Python')
+    stats = metrics.snapshot()['wiki']
+    assert stats['breaker'] == 'open' and stats['upstream_errors'] == 2 and stats['breaker_rejected'] == 1
+    page = metrics.prometheus()
+    assert 'notes_wiki_breaker{state="open"} 1\n' in page
+    assert '# TYPE notes_wiki_upstream_errors_total counter\nnotes_wiki_upstream_errors_total 2\n' in page
+    assert 'notes_wiki_entries 0\n' in page
@@ -0,0 +1,38 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+# Notes sorted by timestamp (seconds since the epoch) for range queries
+# keys holds the timestamps in an array, refs whatever the storage needs to find the note.
+# Notes are nearly always saved in time order, so adding one is an append;
+# an older timestamp is inserted in its place.
+class TimeIndex:
+    def __init__(self):
+        self.keys = array('q')
+        self.refs = []
+
+    def add(self, epoch, ref):
+        if not self.keys or epoch >= self.keys[-1]:
+            self.keys.append(epoch)
+            self.refs.append(ref)
+        else:
+            pos = bisect_right(self.keys, epoch) #After notes with the same time, keeps save order
+            self.keys.insert(pos, epoch)
+            self.refs.insert(pos, ref)
+
+    # Fill an empty index from (epoch, ref) pairs with one sort instead of many inserts
+    def build(self, pairs):
+        pairs = sorted(pairs, key=lambda pair: pair[0]) #Stable, notes with the same time keep their order
+        self.keys = array('q', (epoch for epoch, ref in pairs))
+        self.refs = [ref for epoch, ref in pairs]
+
+    # refs of notes with start <= timestamp <= end, oldest first, at most limit of them
+    def between(self, start, end, limit=None):
+        first = bisect_left(self.keys, start)
+        last = bisect_right(self.keys, end)
+        if limit is not None:
+            last = min(last, first + limit)
+        return self.refs[first:last]
+
+    def __len__(self):
+        return len(self.keys)
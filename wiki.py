@@ -0,0 +1,195 @@
+import threading
+import time
+import random
+from collections import OrderedDict
+from concurrent.futures import Future
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import metrics
+
+WIKIPEDIA_API = "https://en.wikipedia.org/w/api.php" #URL for wikipedia API
+
+
+# Raised instead of calling Wikipedia while the circuit breaker is open
+class UpstreamUnavailable(Exception):
+    pass
+
+
+# Stops calls to an upstream that keeps failing
+# After failure_threshold failures in a row the breaker opens and calls fail right away.
+# After reset_timeout seconds one trial call is let through, if it works the breaker closes again.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None #When the breaker opened, None while closed
+        self.trial = False #A trial call is running while half open
+        self.rejected = 0
+
+    # Raise UpstreamUnavailable if calls are not allowed right now
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at >= self.reset_timeout and not self.trial:
+                self.trial = True #Half open, this call finds out if the upstream is back
+                return
+            self.rejected += 1
+            raise UpstreamUnavailable("Wikipedia is unavailable, try again later")
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if self.trial or time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+
+# Same topic in different case or spacing gives the same cache entry
+def normalize(topic):
+    return ' '.join(topic.split()).casefold()
+
+
+# Looks up the Wikipedia page for a topic through the opensearch API
+# Results are cached for ttl seconds, "no page" results for negative_ttl seconds,
+# and at most max_entries topics are kept (least recently used are dropped first).
+# When several threads miss on the same topic only one of them asks Wikipedia,
+# the others wait for its answer.
+# Requests reuse keep-alive connections from a pool of pool_size, give up after the
+# connect/read timeouts, are retried up to retries times with exponential backoff and
+# go through a circuit breaker.
+class WikiLookup:
+    def __init__(self, api_url=WIKIPEDIA_API, ttl=3600.0, negative_ttl=300.0, max_entries=1000,
+                 pool_size=10, connect_timeout=3.05, read_timeout=10.0, retries=2, backoff=0.2,
+                 breaker_failures=5, breaker_reset=30.0):
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        #One adapter holds the connection pool, every thread's session shares it
+        #pool_block makes a thread wait for a free connection instead of opening more than pool_size
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.sessions = threading.local()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.cache = OrderedDict() #normalized topic -> (expires, url or None)
+        self.inflight = {} #normalized topic -> Future of the request being made
+        self.stats_counts = {'hits': 0, 'misses': 0, 'coalesced': 0, 'upstream_errors': 0, 'retries': 0}
+
+    # URL of the page for topic, None if Wikipedia has no page for it
+    # Errors talking to Wikipedia are raised and not cached
+    def lookup(self, topic):
+        key = normalize(topic)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.cache.move_to_end(key)
+                    self.stats_counts['hits'] += 1
+                    return entry[1]
+                del self.cache[key] #Expired
+            future = self.inflight.get(key)
+            if future is not None: #Somebody is already asking Wikipedia
+                self.stats_counts['coalesced'] += 1
+                owner = False
+            else:
+                future = self.inflight[key] = Future()
+                self.stats_counts['misses'] += 1
+                owner = True
+        if not owner:
+            return future.result()
+        try:
+            url = self.fetch(topic)
+        except Exception as e:
+            with self.lock:
+                del self.inflight[key]
+                self.stats_counts['upstream_errors'] += 1
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.inflight[key]
+            self._store(key, url)
+        future.set_result(url)
+        return url
+
+    # Caller holds self.lock
+    def _store(self, key, url):
+        ttl = self.ttl if url is not None else self.negative_ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        self.cache[key] = (time.monotonic() + ttl, url)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+    # Sessions aren't documented as thread safe, so each thread has its own on top of the shared pool
+    def _session(self):
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self.sessions.session = session
+        return session
+
+    # Ask the opensearch API, returns the URL of the first result or None
+    def fetch(self, topic):
+        #Parameters for the API
+        PARAMS = {
+            "action": "opensearch",
+            "namespace": "0",
+            "search": topic,
+            "limit": "1",
+            "format": "json"
+        }
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                with metrics.timer('wikipedia_request'):
+                    response = self._session().get(url=self.api_url, params=PARAMS, timeout=self.timeout) #Get the response from the API
+            except requests.RequestException as e: #Also a body cut short, the trial call of a half open breaker must end
+                error = e
+            else:
+                if response.status_code == 429 or response.status_code >= 500: #Worth trying again
+                    error = requests.HTTPError(f"Wikipedia answered {response.status_code}", response=response)
+                else:
+                    self.breaker.success() #Wikipedia answered, even if it is an error it is up
+                    response.raise_for_status()
+                    data = response.json()
+                    if data[3]: #Check if there is a wikipedia page for the topic
+                        return data[3][0]
+                    return None
+            self.breaker.failure()
+            if attempt >= self.retries:
+                raise error
+            attempt += 1
+            with self.lock:
+                self.stats_counts['retries'] += 1
+            #Exponential backoff with jitter so retries from many threads don't arrive together
+            time.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.stats_counts)
+            result['entries'] = len(self.cache)
+        result['breaker'] = self.breaker.state()
+        result['breaker_rejected'] = self.breaker.rejected
+        return result
@@ -0,0 +1,87 @@
+import argparse
+import json
+import sys
+import threading
+import time
+import random
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for the Wikipedia opensearch API, so the server can be tested offline
+# Start it and run the server with --wikipedia-url http://localhost:3001/w/api.php
+# Topics used by multiclient.py have pages, anything else doesn't unless --all is given
+
+KNOWN_TOPICS = ["Python", "XML-RPC", "Distributed Systems", "Web Services", "Multithreading", "Topic"]
+
+counter_lock = threading.Lock()
+counters = {'requests': 0}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' #Keep connections open like the real API does
+    disable_nagle_algorithm = True #Headers and body are written separately, don't let them wait for an ACK
+    known = {topic.casefold(): topic for topic in KNOWN_TOPICS}
+    all_found = False
+    delay = 0.0
+    fail_rate = 0.0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats': #Number of API calls, to check how many lookups reached "Wikipedia"
+            with counter_lock:
+                self.send_json(dict(counters))
+            return
+        if url.path != '/w/api.php':
+            self.send_json({'error': 'not found'}, status=404)
+            return
+        with counter_lock:
+            counters['requests'] += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail_rate and random.random() < self.fail_rate: #Pretend Wikipedia is having trouble
+            self.send_json({'error': 'unavailable'}, status=503)
+            return
+        search = parse_qs(url.query).get('search', [''])[0]
+        title = self.known.get(' '.join(search.split()).casefold())
+        if title is None and self.all_found and search.strip():
+            title = search.strip()
+        if title is None:
+            self.send_json([search, [], [], []])
+        else:
+            self.send_json([search, [title], [""], ["https://en.wikipedia.org/wiki/" + title.replace(' ', '_')]])
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): #Quiet, the stub is used under load
+        pass
+
+
+def make_server(port=3001, delay=0.0, all_found=False, fail_rate=0.0):
+    handler = type('Handler', (StubHandler,), {'delay': delay, 'all_found': all_found, 'fail_rate': fail_rate})
+    return ThreadingHTTPServer(('localhost', port), handler)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Local stand-in for the Wikipedia opensearch API")
+    parser.add_argument('--port', type=int, default=3001, help="port to listen on (default 3001)")
+    parser.add_argument('--delay', type=float, default=0.0, help="seconds to wait before every answer (default 0)")
+    parser.add_argument('--all', action='store_true', help="every topic has a page")
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help="fraction of API calls answered with 503 Service Unavailable (default 0)")
+    args = parser.parse_args(argv)
+    with make_server(args.port, args.delay, args.all, args.fail_rate) as server:
+        print(f"Wikipedia stub running on port {args.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Wikipedia stub stopped")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])